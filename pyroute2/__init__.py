@@ -1,12 +1,24 @@
 
 from pyroute2.netlink.iproute import IPRSocket
 from pyroute2.netlink.iproute import IPRoute
+from pyroute2.netlink.iproute import SharedIPRoute
+from pyroute2.netlink.iproute import DirectIPRoute
+from pyroute2.netlink.nspool import NetNSPool
 from pyroute2.netlink.ipdb import IPDB
 from pyroute2.netlink.taskstats import TaskStats
 from pyroute2.iocore.iocore import IOCore
+try:
+    # Python 3 only
+    from pyroute2.netlink.aio import AsyncIPRoute
+    make_pep8_happy = AsyncIPRoute
+except ImportError:
+    pass
 
 make_pep8_happy = IPRSocket
 make_pep8_happy = IPRoute
+make_pep8_happy = SharedIPRoute
+make_pep8_happy = DirectIPRoute
+make_pep8_happy = NetNSPool
 make_pep8_happy = IPDB
 make_pep8_happy = TaskStats
 make_pep8_happy = IOCore
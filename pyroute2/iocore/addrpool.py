@@ -4,6 +4,12 @@ import threading
 class AddrPool(object):
     '''
     Address pool
+
+    Addresses are tracked with a bitmap of 64-bit cells, where
+    a set bit marks a free address. Indices of cells that have
+    free bits are kept in a stack, so alloc() and free() do not
+    depend on the pool occupancy: alloc() takes the cell from
+    the top of the stack and picks its lowest set bit.
     '''
     cell = 0xffffffffffffffff
 
@@ -17,46 +23,48 @@ class AddrPool(object):
         self.cell_size *= 8
         # calculate, how many ints we need to bitmap all addresses
         self.cells = int((maxaddr - minaddr) / self.cell_size + 1)
-        # initial array
-        self.addr_map = [self.cell]
         self.minaddr = minaddr
         self.maxaddr = maxaddr
         self.lock = threading.RLock()
+        # initial array
+        self.addr_map = []
+        # stack of cells with free addresses
+        self.free_cells = []
+        self._add_cell()
+
+    def _add_cell(self):
+        base = len(self.addr_map)
+        cell = self.cell
+        # mask out addresses beyond maxaddr in the last cell
+        size = self.maxaddr - self.minaddr + 1 - base * self.cell_size
+        if size < self.cell_size:
+            cell &= (1 << size) - 1
+        self.addr_map.append(cell)
+        self.free_cells.append(base)
 
     def alloc(self):
         with self.lock:
-            # iterate through addr_map
-            base = 0
-            for cell in self.addr_map:
-                if cell:
-                    # not allocated addr
-                    bit = 0
-                    while True:
-                        if (1 << bit) & self.addr_map[base]:
-                            self.addr_map[base] ^= 1 << bit
-                            break
-                        bit += 1
-                    ret = (base * self.cell_size + bit)
+            if not self.free_cells:
+                if len(self.addr_map) < self.cells:
+                    # create new cell to allocate address from
+                    self._add_cell()
+                else:
+                    raise KeyError('no free address available')
+            base = self.free_cells[-1]
+            cell = self.addr_map[base]
+            # the lowest set bit; bin() works also on Python 2.6
+            low = cell & -cell
+            bit = len(bin(low)) - 3
+            cell ^= low
+            self.addr_map[base] = cell
+            if not cell:
+                self.free_cells.pop()
+            ret = base * self.cell_size + bit
 
-                    if self.reverse:
-                        ret = self.maxaddr - ret
-                    else:
-                        ret = ret + self.minaddr
-
-                    if self.minaddr <= ret <= self.maxaddr:
-                        return ret
-                    else:
-                        self.free(ret)
-                        raise KeyError('no free address available')
-
-                base += 1
-            # no free address available
-            if len(self.addr_map) < self.cells:
-                # create new cell to allocate address from
-                self.addr_map.append(self.cell)
-                return self.alloc()
+            if self.reverse:
+                return self.maxaddr - ret
             else:
-                raise KeyError('no free address available')
+                return ret + self.minaddr
 
     def free(self, addr):
         with self.lock:
@@ -66,8 +74,12 @@ class AddrPool(object):
                 addr -= self.minaddr
             base = addr // self.cell_size
             bit = addr % self.cell_size
-            if len(self.addr_map) <= base:
+            if not 0 <= base < len(self.addr_map):
                 raise KeyError('address is not allocated')
-            if self.addr_map[base] & (1 << bit):
+            cell = self.addr_map[base]
+            if cell & (1 << bit):
                 raise KeyError('address is not allocated')
-            self.addr_map[base] ^= 1 << bit
+            if not cell:
+                # the cell gets a free address again
+                self.free_cells.append(base)
+            self.addr_map[base] = cell | (1 << bit)
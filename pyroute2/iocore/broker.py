@@ -1,3 +1,4 @@
+import logging
 import traceback
 import threading
 import socket
@@ -7,6 +8,8 @@ import os
 import io
 import uuid
 import ssl
+import errno
+from collections import deque
 
 from pyroute2.common import AF_PIPE
 from pyroute2.netlink import Marshal
@@ -22,9 +25,17 @@ from pyroute2.iocore import NLT_DGRAM
 from pyroute2.iocore.modules import modules
 from pyroute2.iocore.loop import IOLoop
 from pyroute2.iocore.addrpool import AddrPool
+from pyroute2.iocore.frame import envframe
+from pyroute2.iocore.frame import parse_frames
+from pyroute2.iocore.frame import encode_envelope
+from pyroute2.iocore.frame import encode_envmsg
+from pyroute2.iocore.frame import patch_envmsg
+from pyroute2.iocore.frame import envelope_route
 from pyroute2.iocore.utils import access
 
 C_ADDR_START = 3
+# seconds to keep masquerade records and packet ids
+CACHE_TIMEOUT = 60
 
 
 def _monkey_handshake(self):
@@ -60,42 +71,97 @@ ssl.SSLSocket.do_handshake = _monkey_handshake
 
 class PipeSocket(object):
     '''
-    Socket-like object for one-system IPC.
-
-    It is netlink-specific, since relies on length value
-    provided in the first four bytes of each message.
+    Socket-like object for one-system IPC: an end of AF_UNIX
+    SOCK_SEQPACKET socket pair.
+
+    The socket keeps message boundaries and writes are atomic,
+    so a message is received with one syscall. A message can
+    carry several envelopes in a row, the marshal parses them
+    all.
+
+    The kernel does not accept records larger than the send
+    buffer, so messages of `mtu` bytes or more are sent as
+    several records of `mtu` bytes and the rest. The receiver
+    collects them, until the envelope lengths add up, and till
+    then `recv()` returns None. Records of a message go one by
+    one, since the send lock is held for the whole message.
     '''
 
     family = AF_PIPE
+    type = socket.SOCK_SEQPACKET
+    bufsize = 131072
+    mtu = 65536
 
-    def __init__(self, rfd, wfd):
-        self.rfd = rfd
-        self.wfd = wfd
+    def __init__(self, sock):
+        self.sock = sock
+        for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+            sock.setsockopt(socket.SOL_SOCKET, option, self.bufsize)
+        self.lock = threading.Lock()
+        self.parts = bytearray()
+        self.offset = 0     # the first incomplete envelope in parts
 
-    def send(self, data):
-        os.write(self.wfd, data)
+    def send(self, data, flags=0):
+        '''
+        Send the message. With MSG_DONTWAIT a large message can be
+        sent partially, then the number of bytes sent is returned,
+        and the caller must send the rest, as on a stream.
+        '''
+        sent = 0
+        with self.lock:
+            if len(data) < self.mtu:
+                return self.sock.send(data, flags)
+            while sent < len(data):
+                try:
+                    sent += self.sock.send(data[sent:sent + self.mtu],
+                                           flags)
+                except socket.error as e:
+                    if not sent or e.errno not in (errno.EAGAIN,
+                                                   errno.ENOBUFS):
+                        raise
+                    break
+        return sent
 
     def recv(self, length=0, flags=0):
-        ret = os.read(self.rfd, 4)
-        length = struct.unpack('I', ret)[0]
-        ret += os.read(self.rfd, length - 4)
+        '''
+        Receive a record. Returns the message, b'' on EOF, or None,
+        if the message is not complete yet.
+        '''
+        data = self.sock.recv(self.mtu, flags)
+        if not self.parts and len(data) < self.mtu:
+            return data
+        if not data:
+            # EOF in the middle of a message
+            self.parts = bytearray()
+            self.offset = 0
+            return data
+        self.parts += data
+        while self.offset + 4 <= len(self.parts):
+            length = struct.unpack_from('I', self.parts, self.offset)[0]
+            if length < 4:
+                # broken envelope, let the marshal deal with it
+                self.offset = len(self.parts)
+                break
+            self.offset += length
+        if self.offset != len(self.parts):
+            return None
+        ret = bytes(self.parts)
+        self.parts = bytearray()
+        self.offset = 0
         return ret
 
     def getsockname(self):
-        return self.rfd, self.wfd
+        return self.sock.getsockname()
 
     def fileno(self):
-        return self.rfd
+        return self.sock.fileno()
 
     def close(self):
-        os.close(self.rfd)
-        os.close(self.wfd)
+        self.sock.close()
 
 
 def pairPipeSockets():
-    pipe0_r, pipe0_w = os.pipe()
-    pipe1_r, pipe1_w = os.pipe()
-    return PipeSocket(pipe0_r, pipe1_w), PipeSocket(pipe1_r, pipe0_w)
+    pair = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    return PipeSocket(pair[0]), PipeSocket(pair[1])
 
 
 class Link(object):
@@ -114,44 +180,11 @@ class Link(object):
 class Layer(object):
 
     def __init__(self, raw):
-        init = raw.tell()
         (self.length,
          self.mtype,
          self.flags,
          self.nonce,
-         self.pid) = struct.unpack('IHHII', raw.read(16))
-        raw.seek(init)
-
-
-class Cache(threading.Thread):
-
-    def __init__(self, stop_event):
-        threading.Thread.__init__(self)
-        self.stop_event = stop_event
-        self.maps = []
-        self.cb = {}
-
-    def register_map(self, m, cb=None):
-        self.maps.append(m)
-        if cb:
-            self.cb[id(m)] = cb
-
-    def unregister_map(self, m):
-        self.maps.remove(m)
-
-    def run(self):
-        while True:
-            # expire masquerade records
-            ts = time.time()
-            for m in self.maps:
-                for k in tuple(m.keys()):
-                    if (ts - m[k].ctime) > 60:
-                        del m[k]
-                        if self.cb.get(id(m)):
-                            self.cb[id(m)](k)
-            self.stop_event.wait(60)
-            if self.stop_event.is_set():
-                return
+         self.pid) = struct.unpack_from('IHHII', raw)
 
 
 class CacheRecord(object):
@@ -164,6 +197,275 @@ class CacheRecord(object):
         return self.data == mit
 
 
+class PacketIds(object):
+    '''
+    Bounded cache of recently seen packet ids, used to drop
+    duplicates, that come via several remote links.
+
+    Ids are kept in `buckets` sets, each one covers `timeout` /
+    `buckets` seconds; the oldest set is dropped as a whole when
+    a new one starts. A new set starts also when the current one
+    grows over its share of `maxsize`, so under a heavy load the
+    ids are kept for a shorter time, but the memory is bounded.
+    '''
+
+    def __init__(self, timeout=CACHE_TIMEOUT, maxsize=262144, buckets=6):
+        self.span = float(timeout) / buckets
+        self.limit = max(maxsize // buckets, 1)
+        self.buckets = deque([set()], maxlen=buckets)
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def __contains__(self, packet_id):
+        for bucket in self.buckets:
+            if packet_id in bucket:
+                return True
+        return False
+
+    def __len__(self):
+        return sum([len(x) for x in self.buckets])
+
+    def _rotate(self):
+        now = time.time()
+        steps = int((now - self.stamp) / self.span)
+        if steps:
+            self.stamp += steps * self.span
+        elif len(self.buckets[0]) >= self.limit:
+            self.stamp = now
+            steps = 1
+        for _ in range(min(steps, self.buckets.maxlen)):
+            self.buckets.appendleft(set())
+
+    def add(self, packet_id):
+        with self.lock:
+            self._rotate()
+            self.buckets[0].add(packet_id)
+
+    def check(self, packet_id):
+        '''
+        Register the packet id; return True, if it is already
+        registered
+        '''
+        with self.lock:
+            if packet_id in self:
+                return True
+            self._rotate()
+            self.buckets[0].add(packet_id)
+            return False
+
+
+def _u32(data, offset, cache):
+    if offset not in cache:
+        try:
+            cache[offset] = struct.unpack_from('I', data, offset)[0]
+        except struct.error:
+            cache[offset] = None
+    return cache[offset]
+
+
+class Subscriptions(object):
+    '''
+    u32 subscriptions of the broker clients
+
+    A subscription is a list of (offset, key, mask) keys, and a
+    buffer matches it, if for every key the u32 at the offset,
+    masked, equals the key. Keys with zero mask match anything.
+
+    Subscriptions are compiled into an index: they are grouped by
+    (offset, mask) of the first significant key and then by the
+    key value, so only matching candidates are checked, and every
+    u32 of the buffer is unpacked once.
+    '''
+
+    def __init__(self):
+        self.records = {}   # {cid: (socket, keys), ...}
+        self.lock = threading.Lock()
+        self.compiled = ((), {})
+
+    def __contains__(self, cid):
+        return cid in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, cid, sock, keys):
+        with self.lock:
+            self.records[cid] = (sock, tuple(keys))
+            self._compile()
+
+    def remove(self, cid):
+        with self.lock:
+            if self.records.pop(cid, None) is None:
+                return False
+            self._compile()
+            return True
+
+    def _compile(self):
+        wildcard = []
+        index = {}  # {(offset, mask): {key: [(sock, keys), ...]}}
+        for cid in sorted(self.records):
+            (sock, keys) = self.records[cid]
+            keys = [x for x in keys if x[2]]
+            if not keys:
+                wildcard.append(sock)
+                continue
+            (offset, key, mask) = keys[0]
+            group = index.setdefault((offset, mask), {})
+            group.setdefault(key, []).append((sock, tuple(keys[1:])))
+        # replace the whole structure, so match() does not lock
+        self.compiled = (tuple(wildcard), index)
+
+    def match(self, data):
+        '''
+        Return the set of sockets of the subscriptions, that match
+        the buffer: a client with several matching subscriptions
+        gets the buffer once.
+        '''
+        (wildcard, index) = self.compiled
+        ret = set(wildcard)
+        cache = {}
+        for (offset, mask), group in index.items():
+            value = _u32(data, offset, cache)
+            if value is None:
+                continue
+            for sock, keys in group.get(value & mask, ()):
+                for (koffset, key, kmask) in keys:
+                    kvalue = _u32(data, koffset, cache)
+                    if kvalue is None or kvalue & kmask != key:
+                        break
+                else:
+                    ret.add(sock)
+        return ret
+
+
+class WriteQueue(object):
+    '''
+    Bounded outgoing queue of a socket
+
+    Messages are sent with MSG_DONTWAIT; what the socket does not
+    accept, is queued and flushed from the I/O loop, when the
+    socket becomes writable. So a slow peer does not block the
+    broker.
+
+    When the queue grows over `high` bytes, new messages are
+    dropped (policy 'drop'), or the sender waits, until the queue
+    is flushed below `low` bytes (policy 'block'), but not longer
+    than `timeout` seconds. The loop thread itself never waits.
+    A partially sent message on a stream is always completed.
+
+    Counters: `depth` -- messages in the queue, `size` -- bytes,
+    `drops` -- dropped messages.
+    '''
+
+    def __init__(self, sock, ioloop, high=1048576, low=262144,
+                 policy='drop', timeout=3):
+        assert policy in ('drop', 'block')
+        self.sock = sock
+        self.ioloop = ioloop
+        self.high = high
+        self.low = low
+        self.policy = policy
+        self.timeout = timeout
+        self.stream = sock.type == socket.SOCK_STREAM
+        self.queue = deque()    # [[data, addr], ...]
+        self.size = 0
+        self.drops = 0
+        self.watching = False
+        self.lock = threading.Lock()
+        self.flushed = threading.Condition(self.lock)
+
+    @property
+    def depth(self):
+        return len(self.queue)
+
+    def _send(self, data, addr):
+        if addr is None:
+            return self.sock.send(data, socket.MSG_DONTWAIT)
+        else:
+            return self.sock.sendto(data, socket.MSG_DONTWAIT, addr)
+
+    def send(self, data, addr=None, policy=None):
+        '''
+        Send or queue the message; return False, if it is dropped.
+        `policy` overrides the queue policy for this message.
+        '''
+        policy = policy or self.policy
+        with self.lock:
+            sent = 0
+            if not self.queue:
+                try:
+                    sent = self._send(data, addr)
+                except socket.error as e:
+                    if e.errno not in (errno.EAGAIN, errno.ENOBUFS):
+                        raise
+                if sent == len(data):
+                    return True
+                if sent:
+                    # the stream has a part of the message already
+                    self._push(data[sent:], addr)
+                    return True
+            if self.size + len(data) > self.high:
+                if (policy == 'block' and
+                        threading.current_thread() is not self.ioloop):
+                    deadline = time.time() + self.timeout
+                    while self.size > self.low and self.queue:
+                        timeout = deadline - time.time()
+                        if timeout <= 0:
+                            break
+                        self.flushed.wait(timeout)
+                if self.size + len(data) > self.high and self.queue:
+                    self.drops += 1
+                    return False
+            self._push(data, addr)
+            return True
+
+    def _push(self, data, addr):
+        self.queue.append([data, addr])
+        self.size += len(data)
+        if not self.watching:
+            self.watching = True
+            self.ioloop.watch_write(self.sock, self.flush)
+
+    def flush(self):
+        '''
+        Send queued messages, until the socket accepts them.
+        Runs in the I/O loop thread.
+        '''
+        with self.lock:
+            while self.queue:
+                (data, addr) = self.queue[0]
+                try:
+                    sent = self._send(data, addr)
+                except socket.error as e:
+                    if e.errno in (errno.EAGAIN, errno.ENOBUFS):
+                        break
+                    # the socket is broken, the reader will handle it
+                    self.drops += len(self.queue)
+                    self.queue.clear()
+                    self.size = 0
+                    break
+                self.size -= sent
+                if sent < len(data):
+                    self.queue[0][0] = data[sent:]
+                    break
+                self.queue.popleft()
+            if self.size <= self.low:
+                self.flushed.notify_all()
+            if not self.queue and self.watching:
+                self.watching = False
+                self.ioloop.unwatch_write(self.sock)
+
+    def close(self):
+        with self.lock:
+            self.drops += len(self.queue)
+            self.queue.clear()
+            self.size = 0
+            self.flushed.notify_all()
+            if self.watching:
+                self.watching = False
+                self.ioloop.unwatch_write(self.sock)
+
+
 class MasqRecord(CacheRecord):
 
     def __init__(self, socket):
@@ -183,6 +485,13 @@ class MarshalEnv(Marshal):
 
 
 class IOBroker(object):
+    # outgoing queues, see `WriteQueue`; the policy is for the
+    # broadcast fan-out, unicast and forwarded envelopes always
+    # use 'block'
+    write_high = 1048576
+    write_low = 262144
+    write_policy = 'drop'
+
     def __init__(self,
                  addr=0x01000000,
                  broadcast=0xffffffff,
@@ -202,6 +511,9 @@ class IOBroker(object):
         self.local = {}
         self.links = {}
         self.remote = {}
+        self.remote_sockets = {}  # {socket: uid...}
+        # forwarding table, {(addr, socket type): uid...}
+        self.fib = {}
         self.discover = {}
         # fd lists for select()
         self._rlist = set()
@@ -209,12 +521,14 @@ class IOBroker(object):
         self._xlist = set()
         # routing
         self.masquerade = {}      # {int: MasqRecord()...}
-        self.packet_ids = {}      # {int: CacheRecord()...}
+        self.packet_ids = PacketIds()
         self.clients = set()      # set(socket, socket...)
         self.servers = set()      # set(socket, socket...)
         self.controls = set()     # set(socket, socket...)
+        self.pipes = set()        # local control pipes, framed
+        self.writers = {}         # {socket: WriteQueue()...}
         self.sockets = {}
-        self.subscribe = {}
+        self.subscribe = Subscriptions()
         self.providers = {}
         # modules = { IPRCMD_STOP: {'access': access.ADMIN,
         #                           'command': <function>},
@@ -230,11 +544,6 @@ class IOBroker(object):
             self.secret = os.urandom(15)
             self.secret += b'\xff'
         self.uuid = uuid.uuid4()
-        # masquerade cache expiration
-        self._expire_thread = Cache(self._stop_event)
-        self._expire_thread.register_map(self.masquerade, self.nonces.free)
-        self._expire_thread.register_map(self.packet_ids)
-        self._expire_thread.setDaemon(True)
         if ioloop:
             self.ioloop = ioloop
             self.standalone = False
@@ -244,6 +553,7 @@ class IOBroker(object):
         if control:
             self.add_client(control)
             self.controls.add(control)
+            self.pipes.add(control)
             self.ioloop.register(control, self.route, defer=True)
 
     def handle_connect(self, fd, event):
@@ -268,6 +578,36 @@ class IOBroker(object):
         client.send(ne.buf.getvalue())
         self.ioloop.register(client, self.route, defer=True)
 
+    def send(self, sock, data, addr=None, policy=None):
+        '''
+        Send data via the socket's write queue, see `WriteQueue`;
+        `policy` overrides `write_policy`. SSL sockets can not
+        send with MSG_DONTWAIT, so they are written directly.
+        '''
+        if isinstance(sock, ssl.SSLSocket):
+            return sock.send(data)
+        writer = self.writers.get(sock, None)
+        if writer is None:
+            writer = self.writers[sock] = WriteQueue(sock,
+                                                     self.ioloop,
+                                                     self.write_high,
+                                                     self.write_low,
+                                                     self.write_policy)
+        return writer.send(data, addr, policy)
+
+    def close_writer(self, sock):
+        writer = self.writers.pop(sock, None)
+        if writer is not None:
+            writer.close()
+
+    def write_stats(self):
+        '''
+        Return {socket: (depth, size, drops), ...} of the write
+        queues
+        '''
+        return dict([(sock, (w.depth, w.size, w.drops))
+                     for (sock, w) in tuple(self.writers.items())])
+
     def alloc_addr(self):
         return self.ports.alloc()
 
@@ -308,19 +648,13 @@ class IOBroker(object):
             rsp['attrs'] = [['IPR_ATTR_ERROR', traceback.format_exc()]]
 
         rsp.encode()
-        ne = envmsg()
-        ne['header']['sequence_number'] = nonce
-        ne['header']['pid'] = pid
-        ne['header']['type'] = NLMSG_TRANSPORT
-        ne['header']['flags'] = NLT_CONTROL | NLT_RESPONSE
-        ne['src'] = dst
-        ne['ttl'] = 16
-        ne['id'] = uuid.uuid4().bytes
-        ne['dport'] = sport
-        ne['sport'] = dport
-        ne['attrs'] = [['IPR_ATTR_CDATA', rsp.buf.getvalue()]]
-        ne.encode()
-        sock.send(ne.buf.getvalue())
+        self.send_envelope(sock, envframe(flags=NLT_CONTROL | NLT_RESPONSE,
+                                          nonce=nonce,
+                                          pid=pid,
+                                          src=dst,
+                                          dport=sport,
+                                          sport=dport,
+                                          data=rsp.buf.getvalue()))
 
         if self.shutdown_flag.is_set():
             self.shutdown()
@@ -336,6 +670,15 @@ class IOBroker(object):
             return self.unmasq(nonce, envelope)
         else:
             flags = envelope['header']['flags']
+            if flags & NLT_DGRAM:
+                key = (envelope['dst'], socket.SOCK_DGRAM)
+            else:
+                key = (envelope['dst'], socket.SOCK_STREAM)
+            uid = self.fib.get(key, None)
+            if uid is not None:
+                return self.remote[uid].gate(envelope, sock)
+
+            # unknown destination -- flood
             for (uid, link) in self.remote.items():
                 # by default, send packets only via SOCK_STREAM,
                 # and use SOCK_DGRAM only upon request
@@ -353,15 +696,71 @@ class IOBroker(object):
                 # in any other case -- send packet
                 self.remote[uid].gate(envelope, sock)
 
+    def learn_route(self, addr, uid):
+        '''
+        Register the broker address as reachable via the remote
+        link. Learned from connect announces and from source
+        addresses of envelopes, received via the link.
+        '''
+        if addr in (0, self.addr, self.broadcast):
+            return
+        link = self.remote.get(uid, None)
+        if link is not None:
+            self.fib[(addr, link.sock.type)] = uid
+
     def unmasq(self, nonce, envelope):
         target = self.masquerade[nonce]
         envelope['header']['sequence_number'] = \
             target.envelope['header']['sequence_number']
         envelope['header']['pid'] = \
             target.envelope['header']['pid']
-        envelope.reset()
-        envelope.encode()
-        target.socket.send(envelope.buf.getvalue())
+        self.send_envelope(target.socket, envelope)
+
+    def send_envelope(self, sock, envelope):
+        '''
+        Send the envelope: local pipes get compact frames,
+        other sockets -- full `envmsg`.
+
+        Unicast envelopes are requests, replies and ACKs, that
+        someone waits for, so the sender waits for the queue
+        to flush, and if it does not, the drop is logged.
+        '''
+        if sock in self.pipes:
+            data = encode_envelope(envelope)
+        else:
+            data = self.pack_envelope(envelope)
+        if not self.send(sock, data, policy='block'):
+            logging.warning('write queue overflow, envelope dropped: '
+                            'nonce %s, dst %s',
+                            envelope['header']['sequence_number'],
+                            envelope['dst'])
+
+    def pack_envelope(self, envelope):
+        '''
+        Return the envelope as `envmsg` buffer for remote links.
+        Received envelopes are not encoded again: the original
+        buffer is sent with the header fields patched.
+        '''
+        header = envelope['header']
+        if isinstance(envelope, envmsg):
+            return patch_envmsg(envelope.raw,
+                                header['sequence_number'],
+                                header['pid'],
+                                envelope['ttl'])
+        packet_id = uuid.uuid4().bytes
+        # the packet can return via another remote link
+        self.packet_ids.add(packet_id)
+        return encode_envmsg(header['flags'],
+                             header['sequence_number'],
+                             header['pid'],
+                             envelope['dst'],
+                             envelope['dport'],
+                             envelope['src'],
+                             envelope['sport'],
+                             envelope['ttl'],
+                             packet_id,
+                             envelope['data'],
+                             envelope['cname'])
 
     def route_data(self, sock, envelope):
         nonce = envelope['header']['sequence_number']
@@ -376,71 +775,60 @@ class IOBroker(object):
             self.unmasq(nonce, envelope)
 
         else:
-            # FIXME fix it, please, or kill with fire
-            # there should be no data repack
-            data = io.BytesIO(envelope.get_attr('IPR_ATTR_CDATA'))
-            for cid, u32 in self.subscribe.items():
-                self.filter_u32(u32, data)
-
-    def filter_u32(self, u32, data):
-        for offset, key, mask in u32['keys']:
-            data.seek(offset)
-            compare = struct.unpack('I', data.read(4))[0]
-            if compare & mask != key:
-                return
-        # envelope data
-        envelope = envmsg()
-        envelope['header']['type'] = NLMSG_TRANSPORT
-        envelope['attrs'] = [['IPR_ATTR_CDATA',
-                              data.getvalue()]]
-        envelope['id'] = uuid.uuid4().bytes
-        envelope.encode()
-        u32['socket'].send(envelope.buf.getvalue())
+            self.filter_u32(envelope.get_attr('IPR_ATTR_CDATA'))
+
+    def filter_u32(self, data):
+        '''
+        Send the buffer to all the matching subscribers. The
+        envelope is encoded once per kind: a frame for local
+        pipes and `envmsg` for other sockets.
+        '''
+        targets = self.subscribe.match(data)
+        if not targets:
+            return
+        envelope = envframe(data=data)
+        frame = None
+        packet = None
+        for sock in targets:
+            if sock in self.pipes:
+                if frame is None:
+                    frame = encode_envelope(envelope)
+                self.send(sock, frame)
+            else:
+                if packet is None:
+                    packet = self.pack_envelope(envelope)
+                self.send(sock, packet)
 
     def route_netlink(self, sock, raw):
-        data = io.BytesIO()
-        data.length = data.write(raw)
-        data.seek(8)
-        seq = struct.unpack('I', data.read(4))[0]
+        seq = struct.unpack_from('I', raw, 8)[0]
 
         # extract masq info
         target = self.masquerade.get(seq, None)
         if target is None:
-            for cid, u32 in self.subscribe.items():
-                self.filter_u32(u32, data)
+            self.filter_u32(raw)
         else:
+            # rewrite headers in place
+            data = bytearray(raw)
             offset = 0
-            while offset < data.length:
-                data.seek(offset)
-                (length,
-                 mtype,
-                 flags,
-                 seq,
-                 pid) = struct.unpack('IHHII', data.read(16))
-                data.seek(offset + 8)
-                data.write(struct.pack('II',
-                                       target.data.nonce,
-                                       target.data.pid))
+            while offset < len(data):
+                length = struct.unpack_from('I', data, offset)[0]
+                struct.pack_into('II', data, offset + 8,
+                                 target.data.nonce,
+                                 target.data.pid)
                 # skip to the next in chunk
+                if length < 16:
+                    break
                 offset += length
             # envelope data
-            envelope = envmsg()
-            envelope['header']['sequence_number'] = \
-                target.envelope['header']['sequence_number']
-            envelope['header']['pid'] = \
-                target.envelope['header']['pid']
-            envelope['header']['type'] = NLMSG_TRANSPORT
-            # envelope['dst'] = target.envelope['src']
-            envelope['src'] = target.envelope['dst']
-            envelope['ttl'] = 16
-            envelope['id'] = uuid.uuid4().bytes
-            envelope['dport'] = target.envelope['sport']
-            envelope['sport'] = target.envelope['dport']
-            envelope['attrs'] = [['IPR_ATTR_CDATA',
-                                  data.getvalue()]]
-            envelope.encode()
+            header = target.envelope['header']
+            envelope = envframe(nonce=header['sequence_number'],
+                                pid=header['pid'],
+                                src=target.envelope['dst'],
+                                dport=target.envelope['sport'],
+                                sport=target.envelope['dport'],
+                                data=bytes(data))
             # target
-            target.socket.send(envelope.buf.getvalue())
+            self.send_envelope(target.socket, envelope)
 
     def route(self, sock, raw):
         """
@@ -456,13 +844,28 @@ class IOBroker(object):
                 self.deregister_link(fd=sock)
             return
 
-        for envelope in self.marshal.parse(data, sock):
-            if envelope['id'] in self.packet_ids:
+        if sock in self.pipes:
+            # local frames, they have no packet id
+            envelopes = parse_frames(raw)
+        else:
+            envelopes = self.marshal.parse(data, sock)
+
+        for envelope in envelopes:
+            # local frames have no id, and replies to masqueraded
+            # requests go back by the unicast route, so only
+            # the rest can come twice
+            if envelope['id'] is None:
+                pass
+            elif (envelope['dst'] == 0 and
+                    envelope['header']['sequence_number'] in
+                    self.masquerade):
+                pass
+            elif self.packet_ids.check(envelope['id']):
                 # drop duplicated packets
                 continue
-            else:
-                # register packet id
-                self.packet_ids[envelope['id']] = CacheRecord(None)
+
+            if sock in self.remote_sockets:
+                self.learn_route(envelope['src'], self.remote_sockets[sock])
 
             if envelope['dst'] != self.addr:
                 # FORWARD
@@ -479,33 +882,56 @@ class IOBroker(object):
                     # transport packets
                     self.route_data(sock, envelope)
 
-    def gate_forward(self, envelope, sock):
-        # 2. register way back
+    def register_masq(self, nonce, masq):
+        self.masquerade[nonce] = masq
+        self.ioloop.schedule(CACHE_TIMEOUT, self.expire_masq, nonce)
+
+    def expire_masq(self, nonce):
+        if self.masquerade.pop(nonce, None) is not None:
+            self.nonces.free(nonce)
+
+    def gate_forward(self, envelope, sock, pipe=False):
+        # 1. register way back
         nonce = self.nonces.alloc()
         masq = MasqRecord(sock)
-        # copy envelope! original will be modified
-        masq.add_envelope(envelope.copy())
-        self.masquerade[nonce] = masq
+        # copy routing fields! original will be modified
+        masq.add_envelope(envelope_route(envelope))
+        self.register_masq(nonce, masq)
         envelope['header']['sequence_number'] = nonce
         envelope['header']['pid'] = os.getpid()
-        envelope.buf.seek(0)
-        envelope.encode()
-        # 3. return data
-        return envelope.buf.getvalue()
+        # 2. return data: local pipes take frames, other
+        # links -- the envelope
+        if pipe:
+            return encode_envelope(envelope)
+        return self.pack_envelope(envelope)
+
+    def gate_send(self, link_sock, envelope, sock, addr=None):
+        '''
+        Forward the envelope via the link socket, see
+        `gate_forward()`. Forwarded envelopes are requests and
+        replies, so they are sent as in `send_envelope()`.
+        '''
+        data = self.gate_forward(envelope, sock, link_sock in self.pipes)
+        if not self.send(link_sock, data, addr, policy='block'):
+            logging.warning('write queue overflow, forwarded envelope '
+                            'dropped: nonce %s, dst %s',
+                            envelope['header']['sequence_number'],
+                            envelope['dst'])
+            return False
+        return True
 
     def gate_untag(self, envelope, sock):
         # 1. get data
-        data = io.BytesIO(envelope.get_attr('IPR_ATTR_CDATA'))
+        data = bytearray(envelope.get_attr('IPR_ATTR_CDATA'))
         # 2. register way back
         nonce = self.nonces.alloc()
         masq = MasqRecord(sock)
-        masq.add_envelope(envelope.copy())
+        masq.add_envelope(envelope_route(envelope))
         masq.add_data(data)
-        self.masquerade[nonce] = masq
-        data.seek(8)
-        data.write(struct.pack('II', nonce, self.pid))
+        self.register_masq(nonce, masq)
+        struct.pack_into('II', data, 8, nonce, self.pid)
         # 3. return data
-        return data.getvalue()
+        return data
 
     def parse_control(self, data):
         data.seek(0)
@@ -522,6 +948,7 @@ class IOBroker(object):
         self.links[uid] = link
         if remote:
             self.remote[uid] = link
+            self.remote_sockets[sock] = uid
         else:
             self.local[port] = link
         return link
@@ -535,12 +962,17 @@ class IOBroker(object):
         link = self.links[uid]
 
         if not link.keep:
+            self.close_writer(link.sock)
             link.sock.close()
             self._rlist.remove(link.sock)
 
         del self.links[link.uid]
         if link.remote:
             del self.remote[link.uid]
+            self.remote_sockets.pop(link.sock, None)
+            for (key, uid) in tuple(self.fib.items()):
+                if uid == link.uid:
+                    del self.fib[key]
         else:
             del self.local[link.port]
         return link.sock
@@ -559,11 +991,12 @@ class IOBroker(object):
         self._rlist.remove(sock)
         self._wlist.remove(sock)
         self.clients.remove(sock)
+        self.pipes.discard(sock)
+        self.close_writer(sock)
         sock.close()
         return sock
 
     def start(self):
-        self._expire_thread.start()
         if self.standalone:
             self.ioloop.start()
 
@@ -572,7 +1005,6 @@ class IOBroker(object):
         for sock in self.servers:
             sock.close()
         # shutdown sequence
-        self._expire_thread.join()
         if self.standalone:
             self.ioloop.shutdown()
             self.ioloop.join()
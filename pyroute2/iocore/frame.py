@@ -0,0 +1,181 @@
+'''
+Compact local framing
+
+`IOCore` talks to its own broker via a socket pair, and this path
+does not need the full `envmsg` envelope: there is no multi-hop
+routing, so neither packet id nor TTL are used, and encoding and
+decoding the envelope as a netlink message with NLA is a waste.
+
+Local frames have a fixed header, packed and unpacked with one
+struct call, followed by the optional cname and the payload as
+is::
+
+    length   I   frame length, header included
+    type     H   NLMSG_FRAME
+    flags    H   NLT_* flags
+    nonce    I   sequence number
+    pid      I
+    dst      I
+    dport    I
+    src      I
+    sport    I
+    cname    H   cname length
+    reserved H
+
+The broker converts frames to `envmsg` and back, when a message
+goes to or comes from a remote link. Both directions avoid the
+generic NLA encoder: new envelopes are packed with `struct`, and
+received ones are forwarded as is, with the nonce, pid and TTL
+patched in the buffer.
+'''
+import struct
+
+from pyroute2.netlink import NLMSG_TRANSPORT
+
+NLMSG_FRAME = 0xd
+FRAME_HEADER = struct.Struct('IHHIIIIIIHH')
+FRAME_HEADER_LEN = FRAME_HEADER.size
+# envmsg: nlmsg header, dst, dport, src, sport, ttl, reserved, id
+ENVMSG_HEADER = struct.Struct('IHHIIIIIIHH16s')
+NLA_HEADER = struct.Struct('HH')
+IPR_ATTR_CDATA = 0
+IPR_ATTR_CNAME = 1
+
+
+class envframe(dict):
+    '''
+    Decoded local frame. Provides the subset of the `envmsg`
+    API, used by the broker and `IOCore`: header fields in
+    `['header']`, `dst`, `dport`, `src`, `sport`, `ttl`, `id`
+    and `get_attr()` for IPR_ATTR_CDATA and IPR_ATTR_CNAME.
+    '''
+
+    def __init__(self, flags=0, nonce=0, pid=0, dst=0, dport=0,
+                 src=0, sport=0, data=b'', cname=None):
+        dict.__init__(self)
+        self['header'] = {'type': NLMSG_TRANSPORT,
+                          'flags': flags,
+                          'sequence_number': nonce,
+                          'pid': pid}
+        self['dst'] = dst
+        self['dport'] = dport
+        self['src'] = src
+        self['sport'] = sport
+        self['ttl'] = 16
+        self['id'] = None
+        self['data'] = data
+        self['cname'] = cname
+
+    def get_attr(self, attr, default=None):
+        if attr == 'IPR_ATTR_CDATA':
+            return self['data']
+        elif attr == 'IPR_ATTR_CNAME' and self['cname'] is not None:
+            return self['cname']
+        return default
+
+    def copy(self):
+        ret = envframe()
+        ret.update(self)
+        ret['header'] = dict(self['header'])
+        return ret
+
+
+def encode_frame(flags, nonce, pid, dst, dport, src, sport,
+                 data, cname=None):
+    '''
+    Encode a local frame
+    '''
+    if cname is None:
+        cname = b''
+    elif not isinstance(cname, bytes):
+        cname = cname.encode('utf-8')
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return FRAME_HEADER.pack(FRAME_HEADER_LEN + len(cname) + len(data),
+                             NLMSG_FRAME, flags, nonce, pid,
+                             dst, dport, src, sport,
+                             len(cname), 0) + cname + data
+
+
+def encode_envelope(envelope):
+    '''
+    Encode an `envmsg` or `envframe` as a local frame
+    '''
+    header = envelope['header']
+    return encode_frame(header['flags'],
+                        header['sequence_number'],
+                        header['pid'],
+                        envelope['dst'],
+                        envelope['dport'],
+                        envelope['src'],
+                        envelope['sport'],
+                        envelope.get_attr('IPR_ATTR_CDATA'),
+                        envelope.get_attr('IPR_ATTR_CNAME'))
+
+
+def parse_frames(raw):
+    '''
+    Parse all the frames in the buffer
+    '''
+    ret = []
+    offset = 0
+    while offset + FRAME_HEADER_LEN <= len(raw):
+        (length, mtype, flags, nonce, pid, dst, dport,
+         src, sport, clen, reserved) = FRAME_HEADER.unpack_from(raw, offset)
+        if length < FRAME_HEADER_LEN + clen or offset + length > len(raw):
+            break
+        start = offset + FRAME_HEADER_LEN
+        cname = None
+        if clen:
+            cname = raw[start:start + clen].decode('utf-8')
+        ret.append(envframe(flags, nonce, pid, dst, dport, src, sport,
+                            raw[start + clen:offset + length], cname))
+        offset += length
+    return ret
+
+
+def envelope_route(envelope):
+    '''
+    Copy the routing fields of an envelope, without the payload
+    '''
+    header = envelope['header']
+    return envframe(header['flags'],
+                    header['sequence_number'],
+                    header['pid'],
+                    envelope['dst'],
+                    envelope['dport'],
+                    envelope['src'],
+                    envelope['sport'])
+
+
+def _nla(nla_type, data):
+    length = NLA_HEADER.size + len(data)
+    return (NLA_HEADER.pack(length, nla_type) + data +
+            b'\0' * ((4 - length % 4) % 4))
+
+
+def encode_envmsg(flags, nonce, pid, dst, dport, src, sport, ttl,
+                  packet_id, data, cname=None):
+    '''
+    Encode an `envmsg` with IPR_ATTR_CDATA and optional
+    IPR_ATTR_CNAME
+    '''
+    attrs = _nla(IPR_ATTR_CDATA, data)
+    if cname is not None:
+        if not isinstance(cname, bytes):
+            cname = cname.encode('utf-8')
+        attrs += _nla(IPR_ATTR_CNAME, cname + b'\0')
+    return ENVMSG_HEADER.pack(ENVMSG_HEADER.size + len(attrs),
+                              NLMSG_TRANSPORT, flags, nonce, pid,
+                              dst, dport, src, sport, ttl, 0,
+                              packet_id) + attrs
+
+
+def patch_envmsg(raw, nonce, pid, ttl):
+    '''
+    Copy a received `envmsg` buffer, rewriting nonce, pid and TTL
+    '''
+    buf = bytearray(raw)
+    struct.pack_into('II', buf, 8, nonce, pid)
+    struct.pack_into('H', buf, 32, ttl)
+    return buf
@@ -0,0 +1,128 @@
+'''
+Futures for asynchronous requests
+
+`IOCore.request_async()` and `Netlink.nlm_request_async()`
+return a `Future` instead of waiting for the reply, so one thread
+can keep many requests in flight::
+
+    from pyroute2.iocore.future import gather
+
+    futures = [ipr.nlm_request_async(msg, RTM_GETLINK)
+               for msg in msgs]
+    replies = gather(futures, timeout=5)
+
+The standard `concurrent.futures` is not available on Python 2,
+so here is a minimal compatible subset.
+'''
+import time
+import logging
+import threading
+import traceback
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+
+class Future(object):
+    '''
+    The result of an asynchronous request. On timeout `result()`
+    and `exception()` raise Queue.Empty, like `IOCore.get()`.
+    '''
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done.is_set()
+
+    def _wait(self, timeout):
+        if timeout is None:
+            # Python 2 can not interrupt wait() without a timeout
+            # Bug-Url: http://bugs.python.org/issue1360
+            while not self._done.is_set():
+                self._done.wait(0xffff)
+        elif not self._done.wait(timeout):
+            # Python 2.6 Event.wait() returns None
+            if not self._done.is_set():
+                raise Queue.Empty()
+
+    def result(self, timeout=None):
+        '''
+        Wait for the result; raise the request exception, if any
+        '''
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        return self._exception
+
+    def add_done_callback(self, callback):
+        '''
+        Call `callback(future)` when the future is done. If it is
+        done already, the callback runs immediately.
+        '''
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        self._run(callback)
+
+    def _run(self, callback):
+        try:
+            callback(self)
+        except:
+            logging.warning(traceback.format_exc())
+
+    def _finish(self, result, exception):
+        with self._lock:
+            if self._done.is_set():
+                return False
+            self._result = result
+            self._exception = exception
+            self._done.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for callback in callbacks:
+            self._run(callback)
+        return True
+
+    def set_result(self, result):
+        return self._finish(result, None)
+
+    def set_exception(self, exception):
+        return self._finish(None, exception)
+
+
+def gather(futures, timeout=None):
+    '''
+    Wait for all the futures and return the list of results.
+    The first exception is raised, after all the futures are
+    done. `timeout` is for all the futures together.
+    '''
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+    error = None
+    ret = []
+    for future in futures:
+        if deadline is not None:
+            timeout = max(deadline - time.time(), 0)
+        try:
+            ret.append(future.result(timeout))
+        except Queue.Empty:
+            raise
+        except Exception as e:
+            if error is None:
+                error = e
+            ret.append(None)
+    if error is not None:
+        raise error
+    return ret
@@ -1,14 +1,18 @@
+import sys
+import time
+import errno
+import threading
 import struct
 import copy
-import uuid
 import os
 import io
+import itertools
 
+from collections import deque
 from multiprocessing import Process
 from pyroute2.common import uuid32
 from pyroute2.common import debug
 from pyroute2.netlink import NLMSG_CONTROL
-from pyroute2.netlink import NLMSG_TRANSPORT
 from pyroute2.netlink import IPRCMD_ACK
 from pyroute2.netlink import IPRCMD_SERVE
 from pyroute2.netlink import IPRCMD_REGISTER
@@ -24,22 +28,34 @@ from pyroute2.netlink import IPRCMD_DISCOVER
 from pyroute2.netlink import IPRCMD_STOP
 from pyroute2.netlink import NLMSG_DONE
 from pyroute2.netlink import NLM_F_MULTI
+from pyroute2.netlink import NLM_F_DUMP_INTR
+from pyroute2.netlink import NetlinkError
+from pyroute2.netlink import NetlinkDumpInterrupted
 from pyroute2.netlink.generic import mgmtmsg
-from pyroute2.netlink.generic import envmsg
+from pyroute2.netlink.generic import nlmsg_base
 from pyroute2.iocore import NLT_CONTROL
 from pyroute2.iocore import NLT_RESPONSE
 from pyroute2.iocore import NLT_EXCEPTION
 from pyroute2.iocore.loop import IOLoop
 from pyroute2.iocore.broker import pairPipeSockets
-from pyroute2.iocore.broker import MarshalEnv
 from pyroute2.iocore.broker import IOBroker
 from pyroute2.iocore.addrpool import AddrPool
+from pyroute2.iocore.future import Future
+from pyroute2.iocore.listener import ListenerQueue
+from pyroute2.iocore.listener import deliver
+from pyroute2.iocore.frame import encode_frame
+from pyroute2.iocore.frame import parse_frames
 
 try:
     import Queue
 except ImportError:
     import queue as Queue
 _QUEUE_MAXSIZE = 4096
+# Python 2 can not interrupt Queue.get() without a timeout
+# Bug-Url: http://bugs.python.org/issue1360
+_WAIT_FOREVER = 0xffff if sys.version_info[0] < 3 else None
+# put into a request queue by the timer on the response timeout
+_TIMEOUT = object()
 
 try:
     import urlparse
@@ -47,11 +63,162 @@ except ImportError:
     import urllib.parse as urlparse
 
 
+def _end_of_reply(msg):
+    '''
+    True, if no more messages of the reply follow the message
+    '''
+    return ((msg['header'].get('error', None) is not None) or
+            (msg['header']['type'] == NLMSG_DONE) or
+            (not msg['header']['flags'] & NLM_F_MULTI))
+
+
+def _callback_seq(record):
+    return record[3]
+
+
+class AsyncReply(object):
+    '''
+    Listener of an asynchronous request. Looks like a queue for
+    the receive path, but instead of queueing collects the reply
+    and completes the future, like `IOCore.get()` would return.
+
+    If the future is completed before the reply ends -- on the
+    timeout or by `terminate()` -- the nonce is handed over to
+    a `DrainReply`, so it is not reused for another request,
+    while the rest of the reply can still come.
+    '''
+
+    def __init__(self, ioc, nonce, nonce_pool, terminate, timeout):
+        self.ioc = ioc
+        self.nonce = nonce
+        self.nonce_pool = nonce_pool
+        self.terminate = terminate
+        self.future = Future()
+        self.result = []
+        self.interrupted = False
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.timer = ioc.ioloop.schedule(timeout, self.put_nowait, _TIMEOUT)
+
+    def put_nowait(self, msg):
+        with self.lock:
+            if self.future.done():
+                return
+            if msg is _TIMEOUT:
+                return self.finish(Queue.Empty(), ended=False)
+
+            if (self.terminate is not None) and self.terminate(msg):
+                return self.finish(ended=_end_of_reply(msg))
+
+            # exceptions
+            if msg['header'].get('error', None) is not None:
+                return self.finish(msg['header']['error'])
+
+            # inconsistent dumps
+            if msg['header']['flags'] & NLM_F_DUMP_INTR:
+                self.interrupted = True
+
+            # RPC
+            if self.ioc.marshal is None:
+                data = msg.get('data', msg)
+            else:
+                data = msg
+
+            # Netlink
+            if (msg['header']['type'] != NLMSG_DONE):
+                self.result.append(data)
+
+            # wait for NLMSG_DONE if NLM_F_MULTI
+            if (self.terminate is None) and (
+                    (msg['header']['type'] == NLMSG_DONE) or
+                    (not msg['header']['flags'] & NLM_F_MULTI)):
+                return self.finish()
+
+    def deliver(self, msg):
+        self.put_nowait(msg)
+        return True
+
+    def finish(self, error=None, ended=True):
+        self.timer.cancel()
+        if ended:
+            self.ioc.listeners.pop(self.nonce, None)
+            self.nonce_pool.free(self.nonce)
+        else:
+            self.ioc.listeners[self.nonce] = DrainReply(self.ioc,
+                                                        self.nonce,
+                                                        self.nonce_pool,
+                                                        self.timeout)
+        if error is None and self.interrupted:
+            error = NetlinkDumpInterrupted(self.result)
+        if error is not None:
+            self.future.set_exception(error)
+        else:
+            self.future.set_result(self.result)
+
+
+class DrainReply(object):
+    '''
+    Listener of an abandoned request. The rest of the reply
+    still comes with the request nonce, so the nonce must not be
+    reused until the reply ends: the listener discards messages
+    and frees the nonce on NLMSG_DONE, error or a single part
+    reply. If no messages come for `timeout` seconds, the nonce
+    is freed anyway.
+    '''
+
+    def __init__(self, ioc, nonce, nonce_pool, timeout):
+        self.ioc = ioc
+        self.nonce = nonce
+        self.nonce_pool = nonce_pool
+        self.timeout = timeout
+        self.last = time.time()
+        self.done = False
+        self.lock = threading.Lock()
+        self.timer = ioc.ioloop.schedule(timeout, self.expire)
+
+    def deliver(self, msg):
+        self.last = time.time()
+        if msg is _TIMEOUT:
+            return True
+        if _end_of_reply(msg):
+            self.finish()
+        return True
+
+    def expire(self):
+        idle = time.time() - self.last
+        if idle < self.timeout:
+            self.timer = self.ioc.ioloop.schedule(self.timeout - idle,
+                                                  self.expire)
+        else:
+            self.finish()
+
+    def finish(self):
+        with self.lock:
+            if self.done:
+                return
+            self.done = True
+        self.timer.cancel()
+        if self.ioc.listeners.get(self.nonce) is self:
+            del self.ioc.listeners[self.nonce]
+        self.nonce_pool.free(self.nonce)
+
+
 class IOCore(object):
 
     marshal = None
     name = 'Core API'
     default_target = None
+    # I/O loop options, see IOLoop: edge-triggered mode and
+    # the number of threads to run callbacks; with more than
+    # one thread the broker and the parser run concurrently
+    edge_triggered = False
+    dispatch_workers = 1
+    # listener queues, see pyroute2.iocore.listener: the size
+    # and the overflow policy; `coalesce_key` is the default key
+    # function for the coalesce policy
+    queue_size = _QUEUE_MAXSIZE
+    queue_policy = 'drop_newest'
+    coalesce_key = None
 
     def __init__(self, debug=False, timeout=3, do_connect=False,
                  host=None, key=None, cert=None, ca=None,
@@ -62,12 +229,18 @@ class IOCore(object):
         self.default_dport = 0
         self.uids = set()
         self.listeners = {}     # {nonce: Queue(), ...}
-        self.callbacks = []     # [(predicate, callback, args), ...]
+        # callback records: (predicate, callback, args, seq), where
+        # seq is the registration order, kept across the tables
+        self.callbacks = []     # [record, ...]
+        # keyed callbacks, {key: (record, ...)}
+        self._cb_seq = itertools.count()
+        self.cb_cname = {}      # key: cname
+        self.cb_type = {}       # key: message type
+        self.cb_index = {}      # key: (message type, index)
         self.debug = debug
         self.cid = None
         self.cmd_nonce = AddrPool(minaddr=0xf, maxaddr=0xfffe)
         self.nonce = AddrPool(minaddr=0xffff, maxaddr=0xffffffff)
-        self.emarshal = MarshalEnv()
         self.save = None
         if self.marshal is not None:
             self.marshal.debug = debug
@@ -76,7 +249,8 @@ class IOCore(object):
         self._mirror = False
         self.host = host
 
-        self.ioloop = IOLoop()
+        self.ioloop = IOLoop(edge=self.edge_triggered,
+                             workers=self.dispatch_workers)
 
         self._brs, self.bridge = pairPipeSockets()
         # To fork or not to fork?
@@ -127,18 +301,15 @@ class IOCore(object):
 
     @debug
     def _route(self, sock, raw):
-        data = io.BytesIO()
-        data.length = data.write(raw)
-
-        for envelope in self.emarshal.parse(data, sock):
+        for envelope in parse_frames(raw):
 
             nonce = envelope['header']['sequence_number']
             flags = envelope['header']['flags']
             try:
-                buf = io.BytesIO()
-                buf.length = buf.write(envelope.
-                                       get_attr('IPR_ATTR_CDATA'))
-                buf.seek(0)
+                # on Python 3 BytesIO shares the initial value,
+                # so the payload is not copied
+                buf = io.BytesIO(envelope['data'])
+                buf.length = len(envelope['data'])
                 if ((flags & NLT_CONTROL) and
                         (flags & NLT_RESPONSE)):
                     msg = mgmtmsg(buf)
@@ -171,6 +342,10 @@ class IOCore(object):
         else:
             msgs = self.marshal.parse(data)
 
+        cname = None
+        if self.cb_cname:
+            cname = envelope.get_attr('IPR_ATTR_CNAME')
+
         for msg in msgs:
             try:
                 key = msg['header']['sequence_number']
@@ -178,13 +353,21 @@ class IOCore(object):
                 key = 0
 
             # 8<--------------------------------------------------------------
-            # message filtering
-            # right now it is simply iterating callback list
+            # message filtering: keyed callbacks are looked up,
+            # and only generic ones are iterated; all of them run
+            # in the registration order
             # .. _ioc-callbacks:
             skip = False
 
-            for cr in self.callbacks:
-                if cr[0](envelope, msg):
+            records = self.callbacks
+            if self.cb_cname or self.cb_type or self.cb_index:
+                keyed = self._keyed_callbacks(cname, msg)
+                if keyed:
+                    records = sorted(keyed + tuple(records),
+                                     key=_callback_seq)
+
+            for cr in records:
+                if cr[0] is None or cr[0](envelope, msg):
                     if cr[1](envelope, msg, *cr[2]) is not None:
                         skip = True
 
@@ -196,23 +379,17 @@ class IOCore(object):
                 key = 0
 
             if self._mirror and (key != 0):
-                # On Python 2.6 it can fail due to class fabrics
-                # in nlmsg definitions, so parse it again. It should
-                # not be much slower than copy.deepcopy()
-                if getattr(msg, 'raw', None) is not None:
-                    raw = io.BytesIO()
-                    raw.length = raw.write(msg.raw)
-                    new = self.marshal.parse(raw)[0]
+                # the message goes to two readers: clone it, that
+                # costs less than to parse it again
+                if isinstance(msg, nlmsg_base):
+                    new = msg.clone()
                 else:
                     new = copy.deepcopy(msg)
-                self.listeners[0].put_nowait(new)
+                deliver(self.listeners[0], new, self.queue_policy)
 
             if key in self.listeners:
-                try:
-                    self.listeners[key].put_nowait(msg)
-                except Queue.Full:
-                    # FIXME: log this
-                    pass
+                deliver(self.listeners[key], msg,
+                        self.queue_policy if key == 0 else 'block')
 
     def command(self, cmd, attrs=[], expect=None, addr=None):
         addr = addr or self.default_broker
@@ -319,10 +496,13 @@ class IOCore(object):
         Turn message mirroring on/off. When it is 'on', all
         received messages will be copied (mirrored) into the
         default 0 queue.
+
+        Mirrored messages are cloned, see `nlmsg_base.clone()`,
+        so the requester and the monitor can change them freely.
         '''
         self._mirror = operate
 
-    def monitor(self, operate=True):
+    def monitor(self, operate=True, size=None, policy=None, key=None):
         '''
         Create/destroy the default 0 queue. Netlink socket
         receives messages all the time, and there are many
@@ -331,9 +511,18 @@ class IOCore(object):
         changes. To start receiving these messages, call
         Netlink.monitor(). They can be fetched by
         Netlink.get(0) or just Netlink.get().
+
+        `size` and `policy` set up the queue, by default
+        `self.queue_size` and `self.queue_policy` are used;
+        `key` is the key function for the coalesce policy. See
+        `pyroute2.iocore.listener` for the policies and
+        `queue_stats()` for the counters.
         '''
         if operate and self.cid is None:
-            self.listeners[0] = Queue.Queue(maxsize=_QUEUE_MAXSIZE)
+            self.listeners[0] = ListenerQueue(size or self.queue_size,
+                                              policy or self.queue_policy,
+                                              key or self.coalesce_key,
+                                              self._timeout)
             self.cid = self.command(IPRCMD_SUBSCRIBE,
                                     [['IPR_ATTR_KEY', {'offset': 8,
                                                        'key': 0,
@@ -345,8 +534,31 @@ class IOCore(object):
             self.cid = None
             del self.listeners[0]
 
+    def queue_stats(self):
+        '''
+        Return counters of the listener queues, `{key: stats}`,
+        see `ListenerQueue.stats()`
+        '''
+        return dict((key, queue.stats()) for (key, queue)
+                    in tuple(self.listeners.items())
+                    if isinstance(queue, ListenerQueue))
+
+    def _keyed_callbacks(self, cname, msg):
+        ret = ()
+        if cname is not None:
+            ret += self.cb_cname.get(cname, ())
+        if self.cb_type or self.cb_index:
+            header = msg['header']
+            mtype = header.get('type', None)
+            ret += self.cb_type.get(mtype, ())
+            if self.cb_index:
+                ret += self.cb_index.get((mtype, msg.get('index', None)),
+                                         ())
+        return ret
+
     def register_callback(self, callback,
-                          predicate=lambda e, x: True, args=None):
+                          predicate=None, args=None,
+                          cname=None, msg_type=None, index=None):
         '''
         Register a callback to run on a message arrival.
 
@@ -356,6 +568,18 @@ class IOCore(object):
         the callback will be called. Upon False it will not.
         Args is a list or tuple of arguments.
 
+        Callbacks can be bound to a key: `cname` -- the envelope
+        cname, used by RPC; `msg_type` -- the message type, or
+        `msg_type` and `index` together. Keyed callbacks are found
+        by a hash lookup, so they cost nothing for other messages;
+        the predicate, if any, is checked after the key matches.
+        Callbacks without a key are called on every message, so
+        prefer keys when possible. Keyed or not, callbacks are
+        called in the registration order::
+
+            # RTM_NEWLINK messages for the interface index 1
+            ipr.register_callback(cb, msg_type=RTM_NEWLINK, index=1)
+
         Simplest example, assume ipr is the IPRoute() instance::
 
             # create a simplest callback that will print messages
@@ -382,43 +606,85 @@ class IOCore(object):
         '''
         if args is None:
             args = []
-        self.callbacks.append((predicate, callback, args))
+        record = (predicate, callback, args, next(self._cb_seq))
+        if cname is not None:
+            table, key = self.cb_cname, cname
+        elif msg_type is not None and index is not None:
+            table, key = self.cb_index, (msg_type, index)
+        elif msg_type is not None:
+            table, key = self.cb_type, msg_type
+        else:
+            self.callbacks.append(record)
+            return
+        # tables are read without locks, so replace the tuples
+        table[key] = table.get(key, ()) + (record, )
 
     def unregister_callback(self, callback):
         '''
         Remove the first reference to the function from the callback
         register
         '''
-        cb = tuple(self.callbacks)
-        for cr in cb:
+        found = None    # (record, table, key)
+        for cr in tuple(self.callbacks):
             if cr[1] == callback:
-                self.callbacks.pop(cb.index(cr))
-                return
+                found = (cr, None, None)
+                break
+        for table in (self.cb_cname, self.cb_type, self.cb_index):
+            for key, records in tuple(table.items()):
+                for cr in records:
+                    if cr[1] == callback and \
+                            (found is None or cr[3] < found[0][3]):
+                        found = (cr, table, key)
+                        break
+        if found is None:
+            return
+        (cr, table, key) = found
+        if table is None:
+            self.callbacks.remove(cr)
+            return
+        records = tuple([x for x in table[key] if x is not cr])
+        if records:
+            table[key] = records
+        else:
+            del table[key]
 
     @debug
     def get(self, key=0, raw=False, timeout=None, terminate=None,
-            nonce_pool=None):
+            nonce_pool=None, batch=False):
         '''
         Get a message from a queue
 
         * key -- message queue number
+        * batch -- for the queue 0, return all the queued messages
+          at once instead of one message per call
+
+        If any message of the reply has NLM_F_DUMP_INTR flag set,
+        NetlinkDumpInterrupted is raised after NLMSG_DONE.
+
+        Requests do not use this method: replies are collected
+        by the receive path, see `request_async()`.
         '''
+        if key == 0:
+            return self._get_monitor(timeout, batch)
+
         nonce_pool = nonce_pool or self.nonce
         queue = self.listeners[key]
         result = []
         e = None
-        timeout = (timeout or self._timeout) if (key != 0) else 0xffff
+        interrupted = False
+        # the response timeout is tracked by the I/O loop
+        # timer, so the queue is not polled
+        timer = self.ioloop.schedule(timeout or self._timeout,
+                                     self._expire_request, queue)
         while True:
-            # timeout should also be set to catch ctrl-c
-            # Bug-Url: http://bugs.python.org/issue1360
             try:
-                msg = queue.get(block=True, timeout=timeout)
-            except Queue.Empty as x:
-                e = x
-                if key == 0:
-                    continue
-                else:
-                    break
+                msg = queue.get(block=True, timeout=_WAIT_FOREVER)
+            except Queue.Empty:
+                continue
+
+            if msg is _TIMEOUT:
+                e = Queue.Empty()
+                break
 
             if (terminate is not None) and terminate(msg):
                 break
@@ -427,6 +693,10 @@ class IOCore(object):
             if msg['header'].get('error', None) is not None:
                 e = msg['header']['error']
 
+            # inconsistent dumps
+            if msg['header']['flags'] & NLM_F_DUMP_INTR:
+                interrupted = True
+
             # RPC
             if self.marshal is None:
                 data = msg.get('data', msg)
@@ -438,7 +708,7 @@ class IOCore(object):
                 result.append(data)
 
             # break the loop if any
-            if (key == 0) or (e is not None):
+            if e is not None:
                 break
 
             # wait for NLMSG_DONE if NLM_F_MULTI
@@ -447,44 +717,69 @@ class IOCore(object):
                     (not msg['header']['flags'] & NLM_F_MULTI)):
                 break
 
-        if key != 0:
-            # delete the queue
-            del self.listeners[key]
-            nonce_pool.free(key)
-            # get remaining messages from the queue and
-            # re-route them to queue 0 or drop
-            while not queue.empty():
-                msg = queue.get()
-                if 0 in self.listeners:
-                    self.listeners[0].put(msg)
+        timer.cancel()
+        # delete the queue
+        del self.listeners[key]
+        nonce_pool.free(key)
+        # get remaining messages from the queue and
+        # re-route them to queue 0 or drop
+        while not queue.empty():
+            msg = queue.get()
+            if msg is _TIMEOUT:
+                continue
+            if 0 in self.listeners:
+                deliver(self.listeners[0], msg, self.queue_policy)
 
         if e is not None:
             raise e
 
+        if interrupted:
+            raise NetlinkDumpInterrupted(result)
+
         return result
 
+    def _get_monitor(self, timeout, batch):
+        # one lock operation per batch; an error ends the batch,
+        # so no messages are lost when it is raised
+        msgs = self.listeners[0].get_batch(None if batch else 1, timeout,
+                                           lambda x: x['header'].get('error')
+                                           is not None)
+        result = []
+        for msg in msgs:
+            if msg['header'].get('error', None) is not None:
+                raise msg['header']['error']
+            # RPC
+            if self.marshal is None:
+                msg = msg.get('data', msg)
+            # Netlink
+            elif msg['header']['type'] == NLMSG_DONE:
+                continue
+            result.append(msg)
+        return result
+
+    def _expire_request(self, queue):
+        try:
+            queue.put_nowait(_TIMEOUT)
+        except Queue.Full:
+            # the queue is full, so the reader is busy;
+            # try again later
+            self.ioloop.schedule(1, self._expire_request, queue)
+
     @debug
     def push(self, host, msg,
              env_flags=None,
              nonce=0,
              cname=None):
         addr, port = host
-        envelope = envmsg()
-        envelope['header']['sequence_number'] = nonce
-        envelope['header']['pid'] = os.getpid()
-        envelope['header']['type'] = NLMSG_TRANSPORT
-        if env_flags is not None:
-            envelope['header']['flags'] = env_flags
-        envelope['dst'] = addr
-        envelope['src'] = self.default_broker
-        envelope['dport'] = port
-        envelope['ttl'] = 16
-        envelope['id'] = uuid.uuid4().bytes
-        envelope['attrs'] = [['IPR_ATTR_CDATA', msg]]
-        if cname is not None:
-            envelope['attrs'].append(['IPR_ATTR_CNAME', cname])
-        envelope.encode()
-        self.bridge.send(envelope.buf.getvalue())
+        self.bridge.send(encode_frame(env_flags or 0,
+                                      nonce,
+                                      os.getpid(),
+                                      addr,
+                                      port,
+                                      self.default_broker,
+                                      0,
+                                      msg,
+                                      cname))
 
     def request(self, msg,
                 env_flags=0,
@@ -495,13 +790,130 @@ class IOCore(object):
                 cname=None,
                 response_timeout=None,
                 terminate=None):
+        # the reply is collected by the receive path and comes
+        # as one batch; no per-message queue operations
+        return self.request_async(msg, env_flags, addr, port, nonce,
+                                  nonce_pool, cname, response_timeout,
+                                  terminate).result()
+
+    def request_stream(self, msg,
+                       env_flags=0,
+                       addr=None,
+                       port=None,
+                       nonce=None,
+                       nonce_pool=None,
+                       cname=None,
+                       response_timeout=None):
+        '''
+        Like `request()`, but return a generator of the reply
+        messages, that yields them as the parts of a multipart
+        reply arrive. The consumer can stop at any moment.
+
+        The reply queue is bounded and uses the `block` policy:
+        if the consumer is slow, the dispatcher waits for it,
+        so a dump of any size takes at most `queue_size`
+        messages of memory. `response_timeout` is the longest
+        wait for the next message, as well as for the consumer.
+        If the consumer does not take messages for longer, they
+        are dropped, and the iteration ends with NetlinkError
+        (ENOBUFS), like on a netlink socket overrun.
+
+        If the iteration is stopped before the reply ends, the
+        rest of the reply is discarded, see `DrainReply`.
+        '''
         nonce_pool = nonce_pool or self.nonce
         nonce = nonce or nonce_pool.alloc()
         port = port or self.default_dport
         addr = addr or self.default_broker
-        self.listeners[nonce] = Queue.Queue(maxsize=_QUEUE_MAXSIZE)
+        timeout = response_timeout or self._timeout
+        queue = ListenerQueue(self.queue_size, 'block', timeout=timeout)
+        self.listeners[nonce] = queue
         self.push((addr, port), msg, env_flags, nonce, cname)
-        return self.get(nonce,
-                        nonce_pool=nonce_pool,
-                        timeout=response_timeout,
-                        terminate=terminate)
+        return self._stream(queue, nonce, nonce_pool, timeout)
+
+    def _stream(self, queue, nonce, nonce_pool, timeout):
+        interrupted = False
+        done = False
+        batch = deque()
+        try:
+            while not done:
+                batch.extend(queue.get_batch(timeout=timeout))
+                if queue.dropped:
+                    raise NetlinkError(errno.ENOBUFS,
+                                       'stream overrun: %i messages lost'
+                                       % (queue.dropped))
+                while batch:
+                    msg = batch.popleft()
+                    # exceptions
+                    if msg['header'].get('error', None) is not None:
+                        # the error ends the reply
+                        done = True
+                        raise msg['header']['error']
+
+                    # inconsistent dumps
+                    if msg['header']['flags'] & NLM_F_DUMP_INTR:
+                        interrupted = True
+
+                    # wait for NLMSG_DONE if NLM_F_MULTI
+                    if (msg['header']['type'] == NLMSG_DONE) or \
+                            (not msg['header']['flags'] & NLM_F_MULTI):
+                        done = True
+
+                    if msg['header']['type'] != NLMSG_DONE:
+                        # RPC
+                        if self.marshal is None:
+                            yield msg.get('data', msg)
+                        # Netlink
+                        else:
+                            yield msg
+        finally:
+            if done:
+                self.listeners.pop(nonce, None)
+                nonce_pool.free(nonce)
+            else:
+                # the reply goes on, keep the nonce until it ends
+                drain = DrainReply(self, nonce, nonce_pool, timeout)
+                self.listeners[nonce] = drain
+                for msg in batch:
+                    drain.deliver(msg)
+            # release the dispatcher, if it waits for the queue
+            while not queue.empty():
+                msg = queue.get_nowait()
+                if not done:
+                    drain.deliver(msg)
+
+        if interrupted:
+            raise NetlinkDumpInterrupted()
+
+    def request_async(self, msg,
+                      env_flags=0,
+                      addr=None,
+                      port=None,
+                      nonce=None,
+                      nonce_pool=None,
+                      cname=None,
+                      response_timeout=None,
+                      terminate=None):
+        '''
+        Like `request()`, but do not wait for the reply: return
+        a `Future`, that is completed by the receive path. The
+        response timeout is tracked by the I/O loop timer.
+
+        The nonce is freed when the reply ends, see `AsyncReply`;
+        right away -- only if the request is not sent.
+        '''
+        nonce_pool = nonce_pool or self.nonce
+        nonce = nonce or nonce_pool.alloc()
+        port = port or self.default_dport
+        addr = addr or self.default_broker
+        reply = AsyncReply(self, nonce, nonce_pool, terminate,
+                           response_timeout or self._timeout)
+        self.listeners[nonce] = reply
+        try:
+            self.push((addr, port), msg, env_flags, nonce, cname)
+        except:
+            reply.timer.cancel()
+            self.listeners.pop(nonce, None)
+            nonce_pool.free(nonce)
+            raise
+        return reply.future
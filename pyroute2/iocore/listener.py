@@ -0,0 +1,196 @@
+'''
+Listener queues
+
+`IOCore` delivers messages to per-request and monitoring queues
+from the dispatcher thread. A queue is bounded, and when the
+reader does not keep up, the overflow policy decides what to do:
+
+* `block` -- make the dispatcher wait for free space, up to
+  `timeout` seconds, then drop the message; please note, that
+  the dispatcher serves all the listeners
+* `drop_newest` -- drop the new message (default)
+* `drop_oldest` -- drop the oldest queued message
+* `coalesce` -- a new message replaces a queued one with the same
+  key, returned by the `key` function; if there is no such
+  message and the queue is full, the new one is dropped. `None`
+  key means the message is never coalesced
+
+All drops are counted, see `ListenerQueue.stats()`.
+
+Readers can fetch messages one by one with `get()`, or all the
+queued ones at once with `get_batch()`, that takes the queue
+lock only once per batch.
+
+A plain `Queue` can still be used as a listener, but it has no
+overflow policy: `deliver()` drops new messages, when it is full,
+and logs the drop.
+'''
+import sys
+import time
+import logging
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+# Python 2 can not interrupt Condition.wait() without a timeout
+# Bug-Url: http://bugs.python.org/issue1360
+_WAIT_FOREVER = 0xffff if sys.version_info[0] < 3 else None
+
+POLICY_BLOCK = 'block'
+POLICY_DROP_NEWEST = 'drop_newest'
+POLICY_DROP_OLDEST = 'drop_oldest'
+POLICY_COALESCE = 'coalesce'
+POLICIES = (POLICY_BLOCK,
+            POLICY_DROP_NEWEST,
+            POLICY_DROP_OLDEST,
+            POLICY_COALESCE)
+
+
+class ListenerQueue(Queue.Queue):
+    '''
+    Bounded queue with an overflow policy. The dispatcher uses
+    `deliver()`; readers use the standard `get()` or
+    `get_batch()`.
+    '''
+
+    def __init__(self, maxsize=4096, policy=POLICY_DROP_NEWEST,
+                 key=None, timeout=3):
+        if policy not in POLICIES:
+            raise ValueError('unknown queue policy: %s' % (policy, ))
+        if policy == POLICY_COALESCE and key is None:
+            raise ValueError('coalesce policy requires a key function')
+        Queue.Queue.__init__(self, maxsize)
+        self.policy = policy
+        self.key = key
+        self.timeout = timeout
+        self.pending = {}   # coalesce: {key: [msg, key], ...}
+        self.queued = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.blocked = 0
+        self.high = 0
+
+    def _put(self, item):
+        if self.policy == POLICY_COALESCE:
+            key = self.key(item)
+            item = [item, key]
+            if key is not None:
+                self.pending[key] = item
+        self.queue.append(item)
+        self.queued += 1
+        self.high = max(self.high, len(self.queue))
+
+    def _get(self):
+        item = self.queue.popleft()
+        if self.policy == POLICY_COALESCE:
+            if self.pending.get(item[1]) is item:
+                del self.pending[item[1]]
+            item = item[0]
+        return item
+
+    def deliver(self, msg):
+        '''
+        Put the message, applying the overflow policy. Returns
+        False, if the message was dropped.
+        '''
+        if self.policy == POLICY_BLOCK:
+            try:
+                self.put_nowait(msg)
+            except Queue.Full:
+                self.blocked += 1
+                try:
+                    self.put(msg, True, self.timeout)
+                except Queue.Full:
+                    self.dropped += 1
+                    return False
+            return True
+
+        with self.mutex:
+            if self.policy == POLICY_COALESCE:
+                key = self.key(msg)
+                if key in self.pending:
+                    self.pending[key][0] = msg
+                    self.coalesced += 1
+                    return True
+            if 0 < self.maxsize <= self._qsize():
+                self.dropped += 1
+                if self.policy != POLICY_DROP_OLDEST:
+                    return False
+                self._get()
+                self.unfinished_tasks -= 1
+            self._put(msg)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+            return True
+
+    def get_batch(self, maxitems=None, timeout=None, until=None):
+        '''
+        Wait for messages and return a list of all the queued
+        ones, but not more than `maxitems`. If `until(msg)` is
+        true, the batch ends with that message. Raises
+        Queue.Empty on timeout.
+        '''
+        with self.not_empty:
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while not self._qsize():
+                if timeout is None:
+                    self.not_empty.wait(_WAIT_FOREVER)
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Queue.Empty()
+                self.not_empty.wait(remaining)
+            ret = []
+            while self._qsize() and len(ret) != maxitems:
+                ret.append(self._get())
+                if until is not None and until(ret[-1]):
+                    break
+            self.not_full.notify_all()
+            return ret
+
+    def stats(self):
+        '''
+        Return the queue counters:
+
+        * size, maxsize, policy -- the current state
+        * queued -- messages put into the queue
+        * dropped -- messages lost due to the overflow
+        * coalesced -- messages, that replaced queued ones
+        * blocked -- times the dispatcher waited for free space
+        * high -- the highest queue depth seen
+        '''
+        with self.mutex:
+            return {'size': self._qsize(),
+                    'maxsize': self.maxsize,
+                    'policy': self.policy,
+                    'queued': self.queued,
+                    'dropped': self.dropped,
+                    'coalesced': self.coalesced,
+                    'blocked': self.blocked,
+                    'high': self.high}
+
+
+def deliver(listener, msg, policy=POLICY_DROP_NEWEST):
+    '''
+    Deliver the message to a listener. `ListenerQueue` and other
+    listeners with `deliver()` apply their own policy. A plain
+    `Queue` supports only `drop_newest`; `policy` is the one
+    requested for the listener, and if it can not be applied,
+    the drop warning says so. Returns False, if the message was
+    dropped.
+    '''
+    if isinstance(listener, ListenerQueue) or \
+            not isinstance(listener, Queue.Queue):
+        return listener.deliver(msg)
+    try:
+        listener.put_nowait(msg)
+        return True
+    except Queue.Full:
+        if policy == POLICY_DROP_NEWEST:
+            logging.warning('listener queue overflow, message dropped')
+        else:
+            logging.warning('listener queue overflow, message dropped: '
+                            'plain Queue does not support the %s policy, '
+                            'use ListenerQueue', policy)
+        return False
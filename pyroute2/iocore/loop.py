@@ -1,9 +1,12 @@
 import os
+import time
 import socket
 import select
 import logging
 import traceback
 import threading
+from multiprocessing import Pool
+from pyroute2.iocore.timer import TimerWheel
 try:
     import Queue
 except ImportError:
@@ -11,61 +14,219 @@ except ImportError:
 
 
 class IOLoop(threading.Thread):
-    def __init__(self):
+    '''
+    I/O loop: poll registered file descriptors and run callbacks.
+
+    Callbacks of fds, registered with `defer=True`, get received
+    buffers and run in the "Buffers queue" thread, not to block
+    the loop.
+
+    By default the loop is level-triggered and reads one buffer
+    per wakeup. With `edge=True` deferred fds are polled with
+    EPOLLET, and every wakeup drains the fd until there is no more
+    data, so the buffers are handed to the queue thread as one
+    batch. Not to starve other fds, a batch is limited by `batch`
+    buffers; an fd that is not drained is picked up again on the
+    next iteration of the loop.
+
+    With `workers` > 1 deferred callbacks run in several queue
+    threads, sharded by fd: buffers from one fd are processed in
+    order, while different fds are processed concurrently. So the
+    callbacks, registered for different fds, must be thread-safe.
+
+    A deferred fd can be registered with a `parse()` function,
+    that transforms every buffer before the callback. With
+    `processes` > 0 the loop starts a process pool, and parse()
+    runs there, so it must be picklable, as well as its results.
+    The queue thread waits for the pool, keeping the order.
+
+    `schedule()` runs a callback after a delay. Timers are kept
+    in a timer wheel and run in the loop thread, so they must be
+    quick and must not block.
+
+    `watch_write()` adds EPOLLOUT to the fd mask and runs the
+    callback in the loop thread, when the fd becomes writable;
+    it is used to flush outgoing queues of non-blocking sends.
+    '''
+    edge = False
+    batch = 64
+    workers = 1
+    processes = 0
+
+    def __init__(self, edge=None, batch=None, workers=None, processes=None):
         threading.Thread.__init__(self, name="IOLoop")
+        if edge is not None:
+            self.edge = edge
+        if batch is not None:
+            self.batch = batch
+        if workers is not None:
+            self.workers = workers
+        if processes is not None:
+            self.processes = processes
+        self.pool = None
+        self.timers = TimerWheel()
+        self._deadline = None
+        if self.processes:
+            self.pool = Pool(self.processes)
         fd, self.control = os.pipe()
         self._stop_flag = False
         self.fds = {}
+        self.masks = {}     # {fdno: epoll mask, ...}
+        self.writers = {}   # {fdno: callback, ...}
+        # fds, left not drained due to the batch limit
+        self._ready = set()
         self.poll = select.epoll()
         self.register(fd, lambda fd, event: os.read(fd, 1))
-        self.buffers = Queue.Queue()
-        self._dequeue_thread = threading.Thread(target=self._dequeue,
-                                                name='Buffers queue')
+        self.buffers = []
+        self._dequeue_threads = []
+        for x in range(max(self.workers, 1)):
+            queue = Queue.Queue()
+            thread = threading.Thread(target=self._dequeue,
+                                      args=(queue, ),
+                                      name='Buffers queue %i' % x)
+            thread.setDaemon(True)
+            self.buffers.append(queue)
+            self._dequeue_threads.append(thread)
         self.setDaemon(True)
-        self._dequeue_thread.setDaemon(True)
 
-    def _dequeue(self):
+    def _dequeue(self, queue):
         while True:
-            cb, fd, data, argv, kwarg = self.buffers.get()
+            cb, fd, batch, parse, argv, kwarg = queue.get()
 
             if self._stop_flag:
                 break
 
+            if parse is not None:
+                try:
+                    if self.pool is not None:
+                        batch = self.pool.map(parse, batch)
+                    else:
+                        batch = [parse(x) for x in batch]
+                except:
+                    logging.warning(traceback.format_exc())
+                    continue
+
+            for data in batch:
+                try:
+                    cb(fd, data, *argv, **kwarg)
+                except:
+                    logging.warning(traceback.format_exc())
+
+    def _drain(self, fd, fdno, poller):
+        batch = []
+        while True:
             try:
-                cb(fd, data, *argv, **kwarg)
-            except:
-                logging.warning(traceback.format_exc())
+                data = fd.recv(16384)
+            except OSError:
+                data = ''
+            # None: a part of a message, see PipeSocket
+            if data is not None:
+                batch.append(data)
+                if not data:
+                    break
+            # SSL sockets can have buffered data, invisible to poll
+            pending = getattr(fd, 'pending', None)
+            if not ((pending is not None and pending()) or poller.poll(0)):
+                break
+            if len(batch) >= self.batch:
+                self._ready.add(fdno)
+                break
+        return batch
 
     def shutdown(self):
         self._stop_flag = True
         self.reload()
-        self.buffers.put((None, None, None, None, None))
-        self._dequeue_thread.join()
+        for queue in self.buffers:
+            queue.put((None, None, None, None, None, None))
+        for thread in self._dequeue_threads:
+            thread.join()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
 
     def reload(self):
         os.write(self.control, b's')
 
-    def register(self, fd, cb, argv=[], kwarg={}, defer=False):
+    def schedule(self, delay, callback, *argv, **kwarg):
+        '''
+        Call `callback(*argv, **kwarg)` in the loop thread in
+        `delay` seconds. Returns a `Timer`, that can be cancelled
+        with `cancel()`.
+        '''
+        with self.timers.lock:
+            timer = self.timers.schedule(delay, callback, *argv, **kwarg)
+            # wake up the loop, if it sleeps longer
+            wake = self._deadline is None or timer.expires < self._deadline
+        if wake:
+            self.reload()
+        return timer
+
+    def register(self, fd, cb, argv=[], kwarg={}, defer=False, parse=None):
         if isinstance(fd, int):
             fdno = fd
         else:
             fdno = fd.fileno()
         assert fdno != self.control
-
+        mask = select.EPOLLIN
         if defer:
+            # all the buffers of the fd go to the same queue thread
+            queue = self.buffers[fdno % len(self.buffers)]
+
+        if defer and self.edge:
+            poller = select.poll()
+            poller.register(fdno, select.POLLIN)
+
+            def wrap(fd, event, *argv, **kwarg):
+                queue.put((cb, fd, self._drain(fd, fdno, poller),
+                           parse, argv, kwarg))
+            self.fds[fdno] = [wrap, fd, argv, kwarg]
+            mask |= select.EPOLLET
+        elif defer:
             def wrap(fd, event, *argv, **kwarg):
                 try:
                     data = fd.recv(16384)
                 except OSError:
                     data = ''
-                self.buffers.put((cb, fd, data, argv, kwarg))
+                if data is None:
+                    return
+                queue.put((cb, fd, [data], parse, argv, kwarg))
             self.fds[fdno] = [wrap, fd, argv, kwarg]
         else:
             self.fds[fdno] = [cb, fd, argv, kwarg]
 
-        self.poll.register(fdno, select.EPOLLIN)
+        if fdno in self.writers:
+            mask |= select.EPOLLOUT
+        self.masks[fdno] = mask
+        self.poll.register(fdno, mask)
         self.reload()
 
+    def watch_write(self, fd, cb):
+        '''
+        Call `cb()` in the loop thread every time the fd is
+        writable, until `unwatch_write()`
+        '''
+        fdno = fd.fileno()
+        self.writers[fdno] = cb
+        if fdno in self.masks:
+            self.poll.modify(fdno, self.masks[fdno] | select.EPOLLOUT)
+        else:
+            self.poll.register(fdno, select.EPOLLOUT)
+
+    def unwatch_write(self, fd):
+        try:
+            fdno = fd.fileno()
+        except socket.error:
+            return
+        if self.writers.pop(fdno, None) is None:
+            return
+        try:
+            if fdno in self.masks:
+                self.poll.modify(fdno, self.masks[fdno])
+            else:
+                self.poll.unregister(fdno)
+        except (IOError, OSError, ValueError):
+            pass
+
     def unregister(self, fd):
         try:
             fdno = fd.fileno()
@@ -76,24 +237,60 @@ class IOLoop(threading.Thread):
 
         if fdno in self.fds:
             del self.fds[fdno]
+            self.masks.pop(fdno, None)
+            self.writers.pop(fdno, None)
             self.poll.unregister(fdno)
             self.reload()
             return True
 
         return False
 
+    def start(self):
+        # start the workers here, not in run(): shutdown() can
+        # be called before the loop thread gets to run
+        for thread in self._dequeue_threads:
+            thread.start()
+        threading.Thread.start(self)
+
     def run(self):
-        self._dequeue_thread.start()
         while True:
+            with self.timers.lock:
+                self._deadline = deadline = self.timers.next_expiry()
+            if self._ready:
+                timeout = 0
+            elif deadline is None:
+                timeout = -1
+            else:
+                timeout = max(deadline * self.timers.tick - time.time(), 0)
             try:
-                fds = self.poll.poll()
+                fds = self.poll.poll(timeout)
             except IOError:
                 continue
 
             if self._stop_flag:
                 break
 
+            if deadline is not None:
+                self.timers.expire()
+
+            if self._ready:
+                # edge-triggered fds, that have data left
+                fds = dict(fds)
+                for fdno in self._ready:
+                    fds.setdefault(fdno, select.EPOLLIN)
+                self._ready.clear()
+                fds = fds.items()
+
             for (fdno, event) in fds:
+                if event & select.EPOLLOUT:
+                    try:
+                        self.writers[fdno]()
+                    except KeyError:
+                        pass
+                    except:
+                        logging.warning(traceback.format_exc())
+                    if not event & ~select.EPOLLOUT:
+                        continue
                 try:
                     rc = self.fds[fdno]
                     rc[0](rc[1], event, *rc[2], **rc[3])
@@ -34,8 +34,7 @@ def command(broker, sock, env, cmd, rsp):
     if url in broker.providers:
         new_sock = broker.providers[url]
         established = True
-        gate = lambda d, s:\
-            new_sock.send(broker.gate_forward(d, s))
+        gate = lambda d, s: broker.gate_send(new_sock, d, s)
 
     elif target.scheme == 'netlink':
         res = target.path.split("/")
@@ -47,8 +46,7 @@ def command(broker, sock, env, cmd, rsp):
 
     elif target.scheme == 'udp':
         (new_sock, addr) = get_socket(url, server=False)
-        gate = lambda d, s:\
-            new_sock.sendto(broker.gate_forward(d, s), addr)
+        gate = lambda d, s: broker.gate_send(new_sock, d, s, addr)
         remote = True
 
     else:
@@ -76,8 +74,7 @@ def command(broker, sock, env, cmd, rsp):
         msg.decode()
         peer = msg.get_attr('IPR_ATTR_ADDR')
 
-        gate = lambda d, s:\
-            new_sock.send(broker.gate_forward(d, s))
+        gate = lambda d, s: broker.gate_send(new_sock, d, s)
 
     port = broker.alloc_addr()
     link = broker.register_link(uid=uid,
@@ -86,6 +83,8 @@ def command(broker, sock, env, cmd, rsp):
                                 established=established,
                                 remote=remote)
     link.gate = gate
+    if remote:
+        broker.learn_route(peer, uid)
     broker.discover[target.path] = port
     rsp['attrs'].append(['IPR_ATTR_UUID', uid])
     rsp['attrs'].append(['IPR_ATTR_ADDR', peer])
@@ -8,11 +8,11 @@ level = access.ANY
 
 def command(broker, sock, env, cmd, rsp):
     cid = broker._cid.pop()
-    broker.subscribe[cid] = {'socket': sock,
-                             'keys': []}
+    keys = []
     for key in cmd.get_attrs('IPR_ATTR_KEY'):
         target = (key['offset'],
                   key['key'],
                   key['mask'])
-        broker.subscribe[cid]['keys'].append(target)
+        keys.append(target)
+    broker.subscribe.add(cid, sock, keys)
     rsp['attrs'].append(['IPR_ATTR_CID', cid])
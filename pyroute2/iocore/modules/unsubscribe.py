@@ -8,6 +8,5 @@ level = access.ANY
 
 def command(broker, sock, env, cmd, rsp):
     cid = cmd.get_attr('IPR_ATTR_CID')
-    if cid in broker.subscribe:
-        del broker.subscribe[cid]
+    if broker.subscribe.remove(cid):
         broker._cid.append(cid)
@@ -0,0 +1,164 @@
+'''
+Hierarchical timer wheel
+
+Timers are kept in several wheels of slots. The first wheel
+has a slot per tick, every next one -- a slot per full turn of
+the previous wheel. A timer is put into the slot by its expiry
+time, and when the previous wheel completes a turn, timers of
+the next slot are cascaded down. So `schedule()` and `cancel()`
+take constant time, and `expire()` costs depend on the number
+of expired timers, not on the number of scheduled ones.
+
+The wheel does not run by itself, it is driven by `IOLoop`.
+'''
+import math
+import time
+import logging
+import threading
+import traceback
+
+
+class Timer(object):
+    '''
+    Scheduled call; use `cancel()` to remove it
+    '''
+    __slots__ = ('wheel', 'expires', 'callback', 'argv', 'kwarg', 'slot')
+
+    def __init__(self, wheel, expires, callback, argv, kwarg):
+        self.wheel = wheel
+        self.expires = expires
+        self.callback = callback
+        self.argv = argv
+        self.kwarg = kwarg
+        self.slot = None
+
+    def cancel(self):
+        '''
+        Cancel the timer. Returns False, if the timer is already
+        expired or cancelled.
+        '''
+        with self.wheel.lock:
+            if self.slot is None:
+                return False
+            self.slot.discard(self)
+            self.slot = None
+            self.wheel.count -= 1
+            return True
+
+
+class TimerWheel(object):
+    '''
+    Timer wheel with `tick` resolution in seconds. With default
+    sizes (8, 6, 6, 6 bits) and 0.1s tick timers up to 77 days
+    are supported; longer ones are cascaded at the end of the
+    last wheel and rescheduled.
+    '''
+
+    def __init__(self, tick=0.1, bits=(8, 6, 6, 6)):
+        self.tick = tick
+        self.bits = bits
+        self.shifts = []
+        shift = 0
+        for b in bits:
+            self.shifts.append(shift)
+            shift += b
+        self.span = 1 << shift
+        self.wheels = [[set() for x in range(1 << b)] for b in bits]
+        self.lock = threading.RLock()
+        self.now = self.ticks(time.time())
+        self.count = 0
+
+    def ticks(self, ts):
+        return int(ts / self.tick)
+
+    def schedule(self, delay, callback, *argv, **kwarg):
+        '''
+        Call `callback(*argv, **kwarg)` in `delay` seconds
+        '''
+        ts = time.time()
+        with self.lock:
+            if not self.count:
+                # nothing to cascade, so just catch up the time
+                self.now = max(self.now, self.ticks(ts))
+            expires = max(int(math.ceil((ts + delay) / self.tick)),
+                          self.now + 1)
+            timer = Timer(self, expires, callback, argv, kwarg)
+            self._add(timer)
+            self.count += 1
+            return timer
+
+    def _add(self, timer):
+        delta = timer.expires - self.now
+        if delta >= self.span:
+            # out of range: park in the last slot reachable
+            expires = self.now + self.span - 1
+        else:
+            expires = timer.expires
+        for bits, shift, wheel in zip(self.bits, self.shifts, self.wheels):
+            if delta < (1 << (shift + bits)) or wheel is self.wheels[-1]:
+                slot = wheel[(expires >> shift) & ((1 << bits) - 1)]
+                break
+        slot.add(timer)
+        timer.slot = slot
+
+    def _cascade(self, level):
+        shift = self.shifts[level]
+        index = (self.now >> shift) & ((1 << self.bits[level]) - 1)
+        slot = self.wheels[level][index]
+        timers = tuple(slot)
+        slot.clear()
+        for timer in timers:
+            self._add(timer)
+        return index
+
+    def next_expiry(self):
+        '''
+        Return the tick, when `expire()` should be called next
+        time, or None, if there are no timers. Looks forward not
+        farther than the end of the first wheel turn.
+        '''
+        with self.lock:
+            if not self.count:
+                return None
+            wheel = self.wheels[0]
+            size = len(wheel)
+            for tick in range(self.now + 1,
+                              self.now + size - (self.now % size) + 1):
+                if wheel[tick % size]:
+                    return tick
+            # next cascade
+            return tick
+
+    def expire(self, ts=None):
+        '''
+        Advance the wheel up to the time `ts` and run expired
+        timers. Returns the number of expired timers.
+        '''
+        target = self.ticks(ts or time.time())
+        expired = []
+        with self.lock:
+            if not self.count:
+                self.now = max(self.now, target)
+            while self.now < target and self.count:
+                self.now += 1
+                # when a wheel completes a turn, cascade the next
+                # slot of the upper wheel
+                for level in range(1, len(self.wheels)):
+                    if self.now & ((1 << self.shifts[level]) - 1):
+                        break
+                    if self._cascade(level):
+                        break
+                slot = self.wheels[0][self.now & (len(self.wheels[0]) - 1)]
+                for timer in slot:
+                    timer.slot = None
+                expired.extend(slot)
+                self.count -= len(slot)
+                slot.clear()
+            if not self.count:
+                self.now = max(self.now, target)
+        for timer in expired:
+            try:
+                timer.callback(*timer.argv, **timer.kwarg)
+            except:
+                logging.warning(traceback.format_exc())
+        return len(expired)
@@ -9,24 +9,46 @@ from pyroute2.netlink.generic import nlmsg
 from pyroute2.netlink.generic import NetlinkDecodeError
 from pyroute2.netlink.generic import NetlinkHeaderDecodeError
 from pyroute2.netlink.generic import NETLINK_GENERIC
+from pyroute2.netlink.generic import NLMSG_ALIGN
 
 
 class NetlinkError(Exception):
     '''
     Base netlink error
+
+    If the socket has extended ACK enabled, the kernel can
+    provide a text message and the offset of the offending
+    attribute within the original request. They are stored
+    as `extack` and `offset`, or None if not provided.
     '''
-    def __init__(self, code, msg=None):
+    def __init__(self, code, msg=None, offset=None):
+        self.extack = msg
+        self.offset = offset
         msg = msg or os.strerror(code)
         super(NetlinkError, self).__init__(code, msg)
         self.code = code
 
 
+class NetlinkDumpInterrupted(Exception):
+    '''
+    The kernel marked the dump with NLM_F_DUMP_INTR: the
+    table was changed during the dump, so the result can be
+    inconsistent. The partial result is saved as `result`,
+    the number of already done retries -- as `retries`.
+    '''
+    def __init__(self, result=None, retries=0):
+        super(NetlinkDumpInterrupted, self).__init__('dump interrupted')
+        self.result = result
+        self.retries = retries
+
+
 # Netlink message flags values (nlmsghdr.flags)
 #
 NLM_F_REQUEST = 1    # It is request message.
 NLM_F_MULTI = 2    # Multipart message, terminated by NLMSG_DONE
 NLM_F_ACK = 4    # Reply with ack, with zero or error code
 NLM_F_ECHO = 8    # Echo this request
+NLM_F_DUMP_INTR = 0x10    # Dump was inconsistent due to sequence change
 # Modifiers to GET request
 NLM_F_ROOT = 0x100    # specify tree    root
 NLM_F_MATCH = 0x200    # return all matching
@@ -37,6 +59,9 @@ NLM_F_REPLACE = 0x100    # Override existing
 NLM_F_EXCL = 0x200    # Do not touch, if it exists
 NLM_F_CREATE = 0x400    # Create, if it does not exist
 NLM_F_APPEND = 0x800    # Add to end of list
+# Flags for NLMSG_ERROR
+NLM_F_CAPPED = 0x100    # Original request payload was not echoed
+NLM_F_ACK_TLVS = 0x200    # Extended ACK attributes are included
 
 NLMSG_NOOP = 0x1    # Nothing
 NLMSG_ERROR = 0x2    # Error
@@ -47,6 +72,19 @@ NLMSG_TRANSPORT = 0xf    # Custom message type for NL as a transport
 NLMSG_MIN_TYPE = 0x10    # < 0x10: reserved control messages
 NLMSG_MAX_LEN = 0xffff  # Max message length
 
+# Netlink socket options
+SOL_NETLINK = 270
+NETLINK_ADD_MEMBERSHIP = 1
+NETLINK_DROP_MEMBERSHIP = 2
+NETLINK_CAP_ACK = 10    # Do not echo the request payload in errors
+NETLINK_EXT_ACK = 11    # Provide extended ACK attributes
+
+# Extended ACK attributes (NLMSGERR_ATTR_*)
+NLMSGERR_ATTR_UNUSED = 0
+NLMSGERR_ATTR_MSG = 1    # Error message string
+NLMSGERR_ATTR_OFFS = 2    # Offset of the invalid attribute
+NLMSGERR_ATTR_COOKIE = 3    # Arbitrary subsystem specific cookie
+
 mtypes = {1: 'NLMSG_NOOP',
           2: 'NLMSG_ERROR',
           3: 'NLMSG_DONE',
@@ -123,10 +161,7 @@ class Marshal(object):
 
                 error = None
                 if msg_type == NLMSG_ERROR:
-                    data.seek(offset + 16)
-                    code = abs(struct.unpack('i', data.read(4))[0])
-                    if code > 0:
-                        error = NetlinkError(code)
+                    error = self.parse_error(data, offset, length)
                     data.seek(offset)
 
                 msg_class = self.msg_map.get(msg_type, nlmsg)
@@ -150,6 +185,45 @@ class Marshal(object):
 
             return result
 
+    def parse_error(self, data, offset, length):
+        '''
+        Decode NLMSG_ERROR payload and return NetlinkError
+        or None for positive ACKs.
+
+        With NLM_F_CAPPED only the original header is echoed
+        back; with NLM_F_ACK_TLVS extended ACK attributes follow
+        the echoed request.
+        '''
+        data.seek(offset + 6)
+        flags = struct.unpack('H', data.read(2))[0]
+        data.seek(offset + 16)
+        code = abs(struct.unpack('i', data.read(4))[0])
+        if code == 0:
+            return None
+
+        text = None
+        position = None
+        if flags & NLM_F_ACK_TLVS:
+            if flags & NLM_F_CAPPED:
+                nla_offset = offset + 36
+            else:
+                orig_length = struct.unpack('I', data.read(4))[0]
+                nla_offset = offset + 20 + NLMSG_ALIGN(orig_length)
+            while nla_offset + 4 <= offset + length:
+                data.seek(nla_offset)
+                (nla_length,
+                 nla_type) = struct.unpack('HH', data.read(4))
+                if nla_length < 4:
+                    break
+                value = data.read(nla_length - 4)
+                if nla_type == NLMSGERR_ATTR_MSG:
+                    text = value.rstrip(b'\0').decode('utf-8', 'replace')
+                elif nla_type == NLMSGERR_ATTR_OFFS:
+                    position = struct.unpack('I', value[:4])[0]
+                nla_offset += NLMSG_ALIGN(nla_length)
+
+        return NetlinkError(code, text, position)
+
     def fix_message(self, msg):
         pass
 
@@ -172,7 +246,15 @@ sockets = AddrPool(minaddr=0x0,
 class NetlinkSocket(socket.socket):
     '''
     Generic netlink socket
+
+    By default the socket asks the kernel for capped and extended
+    ACKs: error replies do not carry the original request back,
+    but can carry the error message and the offset of the invalid
+    attribute, see `NetlinkError`. Set `cap_ack` or `ext_ack` to
+    False before bind() to disable it.
     '''
+    cap_ack = True
+    ext_ack = True
 
     def __init__(self, family=NETLINK_GENERIC, port=None):
         socket.socket.__init__(self, socket.AF_NETLINK,
@@ -185,8 +267,21 @@ class NetlinkSocket(socket.socket):
         self.marshal = None
         self.bound = False
 
+    def setup_ack(self):
+        '''
+        Set NETLINK_CAP_ACK and NETLINK_EXT_ACK socket options.
+        Old kernels do not support them, so errors are ignored.
+        '''
+        for option, value in ((NETLINK_CAP_ACK, self.cap_ack),
+                              (NETLINK_EXT_ACK, self.ext_ack)):
+            try:
+                self.setsockopt(SOL_NETLINK, option, int(bool(value)))
+            except socket.error:
+                pass
+
     def bind(self, groups=0):
         self.groups = groups
+        self.setup_ack()
         # if we have pre-defined port, use it strictly
         if self.fixed:
             socket.socket.bind(self, (self.pid + (self.port << 22),
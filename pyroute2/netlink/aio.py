@@ -0,0 +1,600 @@
+'''
+Asyncio netlink clients
+=======================
+
+`IPRoute` methods block the calling thread until the reply
+comes, so an asyncio application has to run every call in a
+thread. `AsyncIPRoute` provides the same methods, but they
+return futures, that can be awaited::
+
+    import asyncio
+    from pyroute2 import AsyncIPRoute
+
+    async def main():
+        ip = AsyncIPRoute()
+        try:
+            (lo, ) = await ip.link_lookup(ifname='lo')
+            await ip.link('set', index=lo, state='up')
+            print(await ip.get_routes(table=254))
+        finally:
+            ip.release()
+
+    asyncio.run(main())
+
+Create the clients in coroutines, or pass the event loop as the
+`loop` argument. The kernel socket is registered in the event
+loop, and replies are dispatched to the request futures by the
+sequence number. No threads are started. Several requests can be
+in flight at once; dumps are queued and sent one by one, since
+the kernel runs only one dump per socket.
+
+The module requires Python 3.5+. It does not use the `async`
+syntax, so the package still compiles on Python 2, where
+`AsyncIPRoute` is not exported.
+'''
+import io
+import errno
+import socket
+import struct
+import asyncio
+import logging
+from socket import AF_UNSPEC
+from collections import deque
+
+from pyroute2.netlink import NetlinkSocket
+from pyroute2.netlink import NetlinkDumpInterrupted
+from pyroute2.netlink import SOL_NETLINK
+from pyroute2.netlink import NETLINK_ADD_MEMBERSHIP
+from pyroute2.netlink import NETLINK_DROP_MEMBERSHIP
+from pyroute2.netlink import NLMSG_DONE
+from pyroute2.netlink import NLM_F_DUMP
+from pyroute2.netlink import NLM_F_MULTI
+from pyroute2.netlink import NLM_F_REQUEST
+from pyroute2.netlink import NLM_F_DUMP_INTR
+from pyroute2.netlink.client import NetlinkClient
+from pyroute2.netlink.iproute import IPRouteMixin
+from pyroute2.netlink.iproute import MarshalRtnl
+from pyroute2.netlink.iproute import RTNL_GROUPS
+from pyroute2.netlink.iproute import RTM_GETLINK
+from pyroute2.netlink.iproute import RTM_GETROUTE
+from pyroute2.netlink.generic import NETLINK_ROUTE
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+_BACKLOG_MAXSIZE = 4096
+_RECV_BUFSIZE = 65536
+
+
+def _running_loop():
+    # get_event_loop() is deprecated outside of a running loop,
+    # and Python 3.5 and 3.6 have no get_running_loop()
+    get_running_loop = getattr(asyncio, 'get_running_loop', None)
+    if get_running_loop is None:
+        return asyncio.get_event_loop()
+    try:
+        return get_running_loop()
+    except RuntimeError:
+        raise RuntimeError('no running event loop, pass the loop')
+
+
+def _end_of_reply(msg):
+    return (msg['header'].get('error', None) is not None or
+            msg['header']['type'] == NLMSG_DONE or
+            not msg['header']['flags'] & NLM_F_MULTI)
+
+
+class AsyncDrain(object):
+    '''
+    Listener of an abandoned request: the rest of the reply
+    still comes with the request nonce, and if it is a dump, the
+    next dump can not start before it ends. Discards the messages
+    until the reply ends, or no messages come for `timeout`
+    seconds, then frees the nonce and starts the next dump.
+    '''
+
+    def __init__(self, client, nonce, dump, timeout):
+        self.client = client
+        self.nonce = nonce
+        self.dump = dump
+        self.timeout = timeout
+        self.timer = client.loop.call_later(timeout, self.finish)
+
+    def put(self, msg):
+        self.timer.cancel()
+        if _end_of_reply(msg):
+            return self.finish()
+        self.timer = self.client.loop.call_later(self.timeout, self.finish)
+
+    def finish(self):
+        client = self.client
+        self.timer.cancel()
+        if client.requests.get(self.nonce) is self:
+            del client.requests[self.nonce]
+        if self.dump:
+            client.next_dump()
+
+    def cancel(self):
+        self.timer.cancel()
+
+
+class AsyncRequest(object):
+    '''
+    Netlink request in flight. Collects the reply as
+    `NetlinkClient._collect()` does, and completes the future.
+    '''
+
+    def __init__(self, client, data, terminate, timeout, retries, dump):
+        self.client = client
+        self.data = data
+        self.terminate = terminate
+        self.timeout = timeout
+        self.retries = retries
+        self.dump = dump
+        self.future = client.loop.create_future()
+        self.nonce = None
+        self.timer = None
+        self.attempt = 0
+        self.result = []
+        self.interrupted = False
+
+    def send(self):
+        client = self.client
+        self.nonce = client.alloc_nonce(self)
+        self.result = []
+        self.interrupted = False
+        struct.pack_into('I', self.data, 8, self.nonce)
+        self.timer = client.loop.call_later(self.timeout,
+                                            self.finish,
+                                            Queue.Empty(),
+                                            False)
+        try:
+            client.sock.sendto(self.data, (0, 0))
+        except socket.error as e:
+            self.finish(e)
+
+    def put(self, msg):
+        if (self.terminate is not None) and self.terminate(msg):
+            return self.finish(ended=_end_of_reply(msg))
+
+        # exceptions
+        if msg['header'].get('error', None) is not None:
+            return self.finish(msg['header']['error'])
+
+        # inconsistent dumps
+        if msg['header']['flags'] & NLM_F_DUMP_INTR:
+            self.interrupted = True
+
+        if msg['header']['type'] != NLMSG_DONE:
+            self.result.append(msg)
+
+        # wait for NLMSG_DONE if NLM_F_MULTI
+        if (self.terminate is None) and (
+                (msg['header']['type'] == NLMSG_DONE) or
+                (not msg['header']['flags'] & NLM_F_MULTI)):
+            self.finish()
+
+    def finish(self, error=None, ended=True):
+        client = self.client
+        self.timer.cancel()
+        if error is None and self.interrupted:
+            if self.attempt < self.retries and not self.future.done():
+                client.requests.pop(self.nonce, None)
+                self.attempt += 1
+                return self.send()
+            error = NetlinkDumpInterrupted(self.result, self.attempt)
+        client.last_dump_retries = self.attempt
+        self.release(ended)
+        if self.future.done():
+            # cancelled by the caller
+            return
+        if error is not None:
+            return self.future.set_exception(error)
+        for msg in self.result:
+            # reset message buffer, make it ready for encoding back
+            msg.reset()
+            del msg['header']
+        self.future.set_result(self.result)
+
+    def release(self, ended):
+        '''
+        Free the nonce and start the next dump; if the reply did
+        not end, leave it to `AsyncDrain`
+        '''
+        client = self.client
+        if not ended:
+            client.requests[self.nonce] = AsyncDrain(client,
+                                                     self.nonce,
+                                                     self.dump,
+                                                     self.timeout)
+            return
+        client.requests.pop(self.nonce, None)
+        if self.dump:
+            client.next_dump()
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.future.cancel()
+
+
+class AsyncStream(object):
+    '''
+    Async iterator of reply messages, see
+    `AsyncNetlink.nlm_stream()`. The messages of one or more
+    requests are yielded in the order they arrive::
+
+        async for route in ip.iter_routes(table=254):
+            ...
+
+    The socket is read by the event loop, not by the iterator,
+    so the messages are buffered until they are taken. `close()`
+    drops the buffer, and the rest of the reply is discarded.
+    '''
+
+    def __init__(self, client):
+        self.loop = client.loop
+        self.buffer = deque()
+        self.waiter = None
+        self.parts = 0
+        self.error = None
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        future = self.loop.create_future()
+        self.waiter = future
+        self.wakeup()
+        return future
+
+    def wakeup(self):
+        future = self.waiter
+        if future is None or future.done():
+            return
+        if self.buffer:
+            future.set_result(self.buffer.popleft())
+        elif isinstance(self.error, asyncio.CancelledError):
+            future.cancel()
+        elif self.error is not None:
+            future.set_exception(self.error)
+        elif not self.parts:
+            future.set_exception(StopAsyncIteration())
+        else:
+            return
+        self.waiter = None
+
+    def put(self, msg):
+        if not self.closed:
+            self.buffer.append(msg)
+            self.wakeup()
+
+    def part_done(self, future):
+        self.parts -= 1
+        if self.error is None:
+            if future.cancelled():
+                self.error = asyncio.CancelledError()
+            elif future.exception() is not None:
+                self.error = future.exception()
+        self.wakeup()
+
+    def close(self):
+        '''
+        Stop the iteration
+        '''
+        self.closed = True
+        self.buffer.clear()
+        if self.waiter is not None:
+            self.waiter.cancel()
+            self.waiter = None
+
+
+class AsyncStreamRequest(AsyncRequest):
+    '''
+    Netlink request, that passes the reply messages to an
+    `AsyncStream` as they arrive. Yielded messages can not be
+    taken back, so interrupted dumps are not retried, and the
+    timeout is counted from the last message.
+    '''
+
+    def __init__(self, client, data, timeout, dump, stream, match):
+        AsyncRequest.__init__(self, client, data, None, timeout, 0, dump)
+        self.stream = stream
+        self.match = match
+        stream.parts += 1
+        self.future.add_done_callback(stream.part_done)
+
+    def put(self, msg):
+        self.timer.cancel()
+        self.timer = self.client.loop.call_later(self.timeout,
+                                                 self.finish,
+                                                 Queue.Empty(),
+                                                 False)
+        if msg['header'].get('error', None) is not None:
+            return self.finish(msg['header']['error'])
+
+        if msg['header']['flags'] & NLM_F_DUMP_INTR:
+            self.interrupted = True
+
+        done = (msg['header']['type'] == NLMSG_DONE) or \
+            (not msg['header']['flags'] & NLM_F_MULTI)
+
+        if msg['header']['type'] != NLMSG_DONE and \
+                (self.match is None or self.match(msg)):
+            msg.reset()
+            del msg['header']
+            self.stream.put(msg)
+
+        if done:
+            self.finish()
+
+    def finish(self, error=None, ended=True):
+        self.timer.cancel()
+        if error is None and self.interrupted:
+            error = NetlinkDumpInterrupted()
+        self.release(ended)
+        if self.future.done():
+            return
+        if error is not None:
+            return self.future.set_exception(error)
+        self.future.set_result(None)
+
+
+class AsyncNetlink(NetlinkClient):
+    '''
+    Netlink client for asyncio. `nlm_request()` returns a
+    future of the reply; broadcast messages are received with
+    `monitor()` and `get()`. The socket is served by the event
+    loop `loop`, by default -- by the running one, so outside of
+    a coroutine the loop must be passed.
+    '''
+
+    def __init__(self, timeout=3, loop=None):
+        NetlinkClient.__init__(self, timeout)
+        self.loop = loop or _running_loop()
+        self.sock = NetlinkSocket(self.family)
+        self.sock.bind(0)
+        self.sock.setblocking(False)
+        self.portid = self.sock.getsockname()[0]
+        self.parser = self.marshal()
+        self.nonce = 0xff
+        self.requests = {}      # {nonce: AsyncRequest(), ...}
+        self.dumps = deque()    # dumps, waiting for the socket
+        self.dumping = None
+        self.broadcast = deque(maxlen=_BACKLOG_MAXSIZE)
+        self.waiters = deque()
+        self.monitoring = False
+        self.loop.add_reader(self.sock.fileno(), self.recv)
+
+    def release(self):
+        '''
+        Close the socket and cancel the pending requests
+        '''
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+        requests = list(self.requests.values()) + list(self.dumps)
+        self.requests.clear()
+        self.dumps.clear()
+        for request in requests:
+            request.cancel()
+        for future in self.waiters:
+            future.cancel()
+        self.waiters.clear()
+
+    def monitor(self, operate=True):
+        '''
+        Start or stop receiving broadcast messages
+        '''
+        if operate == self.monitoring:
+            return
+        option = NETLINK_ADD_MEMBERSHIP if operate \
+            else NETLINK_DROP_MEMBERSHIP
+        for group in range(32):
+            if self.groups & (1 << group):
+                self.sock.setsockopt(SOL_NETLINK, option, group + 1)
+        self.monitoring = operate
+        if not operate:
+            self.broadcast.clear()
+
+    def get(self):
+        '''
+        Get broadcast messages: returns a future of the list
+        of messages, received since the last call. Use
+        `asyncio.wait_for()` to limit the time.
+        '''
+        future = self.loop.create_future()
+        self.waiters.append(future)
+        self.wakeup()
+        return future
+
+    def wakeup(self):
+        while self.broadcast and self.waiters:
+            future = self.waiters.popleft()
+            if future.done():
+                continue
+            future.set_result(list(self.broadcast))
+            self.broadcast.clear()
+
+    def alloc_nonce(self, request):
+        while True:
+            self.nonce = self.nonce % 0xffffffff + 1
+            if self.nonce not in self.requests:
+                self.requests[self.nonce] = request
+                return self.nonce
+
+    def next_dump(self):
+        self.dumping = None
+        while self.dumps:
+            request = self.dumps.popleft()
+            if request.future.done():
+                continue
+            self.dumping = request
+            request.send()
+            break
+
+    def recv(self):
+        '''
+        Read all the pending datagrams and dispatch the
+        messages: replies -- to the requests, multicast messages --
+        to `broadcast`, if monitoring is on, or drop them. Late
+        unicast replies are dropped as well.
+        '''
+        while True:
+            try:
+                raw, (pid, groups) = self.sock.recvfrom(_RECV_BUFSIZE)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                elif e.errno == errno.ENOBUFS:
+                    logging.warning('netlink socket overrun')
+                    continue
+                raise
+            data = io.BytesIO()
+            data.length = data.write(raw)
+            for msg in self.parser.parse(data):
+                nonce = msg['header'].get('sequence_number', 0)
+                # notifications, caused by our own requests, carry
+                # the request nonce, so check the multicast groups
+                request = None if groups else self.requests.get(nonce)
+                if request is not None:
+                    request.put(msg)
+                elif self.monitoring and (groups or not nonce):
+                    # late unicast replies are not events
+                    self.broadcast.append(msg)
+        self.wakeup()
+
+    def nlm_request(self, msg, msg_type,
+                    msg_flags=NLM_F_DUMP | NLM_F_REQUEST,
+                    terminate=None, response_timeout=None,
+                    dump_retries=None):
+        '''
+        Send netlink request and return a future of the reply.
+        The message is encoded right away, so the object can be
+        reused after the call. Interrupted dumps are handled as
+        in `Netlink.nlm_request()`.
+        '''
+        if dump_retries is None:
+            dump_retries = self.dump_retries
+        request = AsyncRequest(self,
+                               self._encode(msg, msg_type, msg_flags),
+                               terminate,
+                               response_timeout or self._timeout,
+                               dump_retries,
+                               msg_flags & NLM_F_DUMP)
+        self._send(request)
+        return request.future
+
+    def _encode(self, msg, msg_type, msg_flags):
+        msg['header']['sequence_number'] = 0
+        msg['header']['pid'] = self.portid
+        msg['header']['type'] = msg_type
+        msg['header']['flags'] = msg_flags
+        msg.reset()
+        msg.encode()
+        return bytearray(msg.buf.getvalue())
+
+    def _send(self, request):
+        if not request.dump:
+            request.send()
+        else:
+            self.dumps.append(request)
+            if self.dumping is None:
+                self.next_dump()
+
+    def nlm_request_batch(self, requests, response_timeout=None):
+        '''
+        Send several requests and return a future of the list
+        of replies, see `Netlink.nlm_request_batch()`
+        '''
+        return asyncio.gather(*[self.nlm_request(msg, msg_type, msg_flags,
+                                                 None, response_timeout)
+                                for (msg, msg_type, msg_flags)
+                                in requests])
+
+    def nlm_stream(self, msg, msg_type,
+                   msg_flags=NLM_F_DUMP | NLM_F_REQUEST,
+                   response_timeout=None):
+        '''
+        Send netlink request and return an async iterator of the
+        reply messages, see `AsyncStream`. Interrupted dumps are
+        handled as in `Netlink.nlm_stream()`.
+        '''
+        return self._stream(AsyncStream(self), msg, msg_type, msg_flags,
+                            response_timeout)
+
+    def _stream(self, stream, msg, msg_type, msg_flags,
+                response_timeout=None, match=None):
+        '''
+        Send a request, that yields the reply messages, accepted
+        by `match()`, to the stream, and return the stream
+        '''
+        self._send(AsyncStreamRequest(self,
+                                      self._encode(msg, msg_type, msg_flags),
+                                      response_timeout or self._timeout,
+                                      msg_flags & NLM_F_DUMP,
+                                      stream,
+                                      match))
+        return stream
+
+    def _then(self, func, *results):
+        '''
+        Return a future of `func(*results)`, where results are
+        futures
+        '''
+        ret = self.loop.create_future()
+
+        def done(future):
+            if ret.done():
+                return
+            if future.cancelled():
+                return ret.cancel()
+            if future.exception() is not None:
+                return ret.set_exception(future.exception())
+            try:
+                ret.set_result(func(*future.result()))
+            except Exception as e:
+                ret.set_exception(e)
+
+        asyncio.gather(*results).add_done_callback(done)
+        return ret
+
+
+class AsyncIPRoute(IPRouteMixin, AsyncNetlink):
+    '''
+    RTNL client for asyncio with `IPRoute` methods. All the
+    methods return futures::
+
+        links = await ip.get_links()
+        await ip.addr('add', index, address='10.0.0.1', mask=24)
+
+    Call `monitor()` to receive broadcast messages and await
+    `get()` to fetch them. The `iter_*()` methods return async
+    iterators, see `AsyncStream`.
+
+    The class provides no remote connections, no callbacks and no
+    message mirroring, use `IPRoute` for that.
+    '''
+    marshal = MarshalRtnl
+    family = NETLINK_ROUTE
+    groups = RTNL_GROUPS
+    # the mixin goes first in the MRO
+    _then = AsyncNetlink._then
+
+    def iter_links(self, *argv, **kwarg):
+        '''
+        Like `get_links()`, but return an async iterator
+        '''
+        stream = AsyncStream(self)
+        for (msg, msg_flags) in self._links_query(argv, kwarg):
+            self._stream(stream, msg, RTM_GETLINK, msg_flags)
+        return stream
+
+    def iter_routes(self, family=AF_UNSPEC, **kwarg):
+        '''
+        Like `get_routes()`, but return an async iterator
+        '''
+        (msg, msg_flags, match) = self._routes_query(family, kwarg)
+        return self._stream(AsyncStream(self), msg, RTM_GETROUTE, msg_flags,
+                            match=match)
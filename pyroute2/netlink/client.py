@@ -1,9 +1,19 @@
 from pyroute2.netlink import Marshal
 import os
+from pyroute2.netlink import NLMSG_DONE
 from pyroute2.netlink import NLM_F_DUMP
+from pyroute2.netlink import NLM_F_MULTI
 from pyroute2.netlink import NLM_F_REQUEST
+from pyroute2.netlink import NLM_F_DUMP_INTR
+from pyroute2.netlink import NetlinkDumpInterrupted
 from pyroute2.netlink.generic import NETLINK_GENERIC
 from pyroute2.iocore.iocore import IOCore
+from pyroute2.iocore.future import Future
+from pyroute2.iocore.future import gather
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
 
 
 class Netlink(IOCore):
@@ -31,6 +41,7 @@ class Netlink(IOCore):
     groups = 0
     marshal = Marshal
     name = 'Netlink API'
+    dump_retries = 3
 
     def __init__(self, debug=False, timeout=3, do_connect=True,
                  host=None, key=None, cert=None, ca=None, addr=None,
@@ -38,34 +49,311 @@ class Netlink(IOCore):
         self.default_target = '/%i/%i' % (self.family, self.groups)
         host = host or 'netlink://'
         host = '%s%s' % (host, self.default_target)
+        self.last_dump_retries = 0
         IOCore.__init__(self, debug, timeout, do_connect,
                         host, key, cert, ca, addr, fork)
 
     def nlm_request(self, msg, msg_type,
                     msg_flags=NLM_F_DUMP | NLM_F_REQUEST,
-                    terminate=None, response_timeout=None):
+                    terminate=None, response_timeout=None,
+                    dump_retries=None):
         '''
         Send netlink request, filling common message
         fields, and wait for response.
+
+        If the kernel reports that the dump was interrupted by
+        concurrent changes (NLM_F_DUMP_INTR), the request is
+        repeated up to `dump_retries` times (`self.dump_retries`
+        by default) to get a consistent snapshot; after that
+        NetlinkDumpInterrupted is raised. The number of retries
+        of the last request is saved in `self.last_dump_retries`.
+        '''
+        if dump_retries is None:
+            dump_retries = self.dump_retries
+        retries = 0
+        while True:
+            nonce = self.nonce.alloc()
+            msg['header']['sequence_number'] = nonce
+            msg['header']['pid'] = os.getpid()
+            msg['header']['type'] = msg_type
+            msg['header']['flags'] = msg_flags
+            msg.reset()
+            msg.encode()
+
+            try:
+                result = self.request(msg.buf.getvalue(),
+                                      addr=self.default_peer,
+                                      nonce=nonce,
+                                      nonce_pool=self.nonce,
+                                      terminate=terminate,
+                                      response_timeout=response_timeout)
+            except NetlinkDumpInterrupted as e:
+                if retries >= dump_retries:
+                    self.last_dump_retries = e.retries = retries
+                    raise
+                retries += 1
+                continue
+            self.last_dump_retries = retries
+            break
+
+        for msg in result:
+            # reset message buffer, make it ready for encoding back
+            msg.reset()
+            if not self.debug:
+                del msg['header']
+
+        return result
+
+    def nlm_request_async(self, msg, msg_type,
+                          msg_flags=NLM_F_DUMP | NLM_F_REQUEST,
+                          terminate=None, response_timeout=None,
+                          dump_retries=None):
+        '''
+        Send netlink request and return a `Future` of the reply,
+        see `pyroute2.iocore.future`. The message is encoded
+        right away, so the object can be reused after the call.
+        Interrupted dumps are repeated as in `nlm_request()`.
+        '''
+        if dump_retries is None:
+            dump_retries = self.dump_retries
+        future = Future()
+
+        def send(retries):
+            nonce = self.nonce.alloc()
+            msg['header']['sequence_number'] = nonce
+            msg['header']['pid'] = os.getpid()
+            msg['header']['type'] = msg_type
+            msg['header']['flags'] = msg_flags
+            msg.reset()
+            msg.encode()
+            reply = self.request_async(msg.buf.getvalue(),
+                                       addr=self.default_peer,
+                                       nonce=nonce,
+                                       nonce_pool=self.nonce,
+                                       terminate=terminate,
+                                       response_timeout=response_timeout)
+            reply.add_done_callback(lambda x: done(x, retries))
+
+        def resend(retries):
+            try:
+                send(retries)
+            except Exception as e:
+                future.set_exception(e)
+
+        def done(reply, retries):
+            e = reply.exception()
+            if isinstance(e, NetlinkDumpInterrupted):
+                if retries < dump_retries:
+                    # the callback runs in the receive path, and
+                    # send() can block on the bridge, so repeat
+                    # the dump from the loop thread
+                    self.ioloop.schedule(0, resend, retries + 1)
+                    return
+                e.retries = retries
+            if e is not None:
+                return future.set_exception(e)
+            result = reply.result()
+            for msg in result:
+                msg.reset()
+                if not self.debug:
+                    del msg['header']
+            future.set_result(result)
+
+        send(0)
+        return future
+
+    def nlm_request_batch(self, requests, response_timeout=None):
+        '''
+        Send several requests back to back and wait for all the
+        replies. `requests` is a list of (msg, msg_type, msg_flags)
+        tuples, they should not be dumps. Returns the list of the
+        replies in the same order; if some requests fail, the
+        first error is raised, after all the replies are received.
+        '''
+        futures = [self.nlm_request_async(msg, msg_type, msg_flags,
+                                          response_timeout=response_timeout)
+                   for (msg, msg_type, msg_flags) in requests]
+        return gather(futures)
+
+    def nlm_stream(self, msg, msg_type,
+                   msg_flags=NLM_F_DUMP | NLM_F_REQUEST,
+                   response_timeout=None):
+        '''
+        Send netlink request and return a generator of the reply
+        messages, see `IOCore.request_stream()`. A big dump does
+        not have to fit into memory, and the iteration can be
+        stopped at any moment.
+
+        Messages can not be taken back after they are yielded,
+        so interrupted dumps are not retried: if the kernel marks
+        the dump with NLM_F_DUMP_INTR, NetlinkDumpInterrupted is
+        raised after the last message.
         '''
         nonce = self.nonce.alloc()
         msg['header']['sequence_number'] = nonce
         msg['header']['pid'] = os.getpid()
         msg['header']['type'] = msg_type
         msg['header']['flags'] = msg_flags
+        msg.reset()
         msg.encode()
+        stream = self.request_stream(msg.buf.getvalue(),
+                                     addr=self.default_peer,
+                                     nonce=nonce,
+                                     nonce_pool=self.nonce,
+                                     response_timeout=response_timeout)
+        return self._strip(stream)
+
+    def _strip(self, stream):
+        for msg in stream:
+            # reset message buffer, make it ready for encoding back
+            msg.reset()
+            if not self.debug:
+                del msg['header']
+            yield msg
 
-        result = self.request(msg.buf.getvalue(),
-                              addr=self.default_peer,
-                              nonce=nonce,
-                              nonce_pool=self.nonce,
-                              terminate=terminate,
-                              response_timeout=response_timeout)
+
+class NetlinkClient(object):
+    '''
+    Base class for threadless netlink clients. Provides
+    `nlm_request()` compatible with `Netlink`, so the same
+    mixins, like `IPRouteMixin`, can be used with it.
+
+    Derived classes must implement `_request()`, that sends
+    one request and returns the reply, see `_collect()`.
+    '''
+    family = NETLINK_GENERIC
+    groups = 0
+    marshal = Marshal
+    dump_retries = 3
+
+    def __init__(self, timeout=3):
+        self._timeout = timeout
+        self.last_dump_retries = 0
+
+    def nlm_request(self, msg, msg_type,
+                    msg_flags=NLM_F_DUMP | NLM_F_REQUEST,
+                    terminate=None, response_timeout=None,
+                    dump_retries=None):
+        '''
+        Send netlink request, filling common message
+        fields, and wait for response.
+
+        Interrupted dumps are handled as in `Netlink.nlm_request()`.
+        Unlike `Netlink`, messages are returned without headers.
+        '''
+        if dump_retries is None:
+            dump_retries = self.dump_retries
+        retries = 0
+        while True:
+            try:
+                result = self._request(msg, msg_type, msg_flags,
+                                       terminate, response_timeout)
+            except NetlinkDumpInterrupted as e:
+                if retries >= dump_retries:
+                    self.last_dump_retries = e.retries = retries
+                    raise
+                retries += 1
+                continue
+            self.last_dump_retries = retries
+            break
 
         for msg in result:
             # reset message buffer, make it ready for encoding back
             msg.reset()
-            if not self.debug:
+            del msg['header']
+
+        return result
+
+    def nlm_request_batch(self, requests, response_timeout=None):
+        '''
+        Compatible with `Netlink.nlm_request_batch()`. The
+        requests are pipelined, if the transport implements
+        `_request_batch()`, otherwise they are sent one by one.
+        '''
+        result = self._request_batch(requests,
+                                     response_timeout or self._timeout)
+        for reply in result:
+            for msg in reply:
+                msg.reset()
                 del msg['header']
+        return result
+
+    def nlm_stream(self, msg, msg_type,
+                   msg_flags=NLM_F_DUMP | NLM_F_REQUEST,
+                   response_timeout=None):
+        '''
+        Compatible with `Netlink.nlm_stream()`, but the reply is
+        received as a whole before the iteration, so it does not
+        save memory.
+        '''
+        return iter(self.nlm_request(msg, msg_type, msg_flags,
+                                     response_timeout=response_timeout))
+
+    def _request(self, msg, msg_type, msg_flags, terminate, timeout):
+        raise NotImplementedError()
+
+    def _request_batch(self, requests, timeout):
+        '''
+        Send the requests and return the list of replies, see
+        `nlm_request_batch()`. Derived classes can override it
+        to send all the requests before reading the replies.
+        '''
+        return [self._request(msg, msg_type, msg_flags, None, timeout)
+                for (msg, msg_type, msg_flags) in requests]
+
+    def _collect_batch(self, gets):
+        '''
+        Collect replies of pipelined requests, one `get()` per
+        request. Errors are raised after all the replies are
+        read, so they do not stay in the socket; timeouts are
+        raised at once.
+        '''
+        error = None
+        ret = []
+        for get in gets:
+            try:
+                ret.append(self._collect(get, None))
+            except Queue.Empty:
+                raise
+            except Exception as e:
+                if error is None:
+                    error = e
+                ret.append(None)
+        if error is not None:
+            raise error
+        return ret
+
+    def _collect(self, get, terminate):
+        '''
+        Collect the reply; `get()` must return the next message
+        of the reply or raise Queue.Empty on timeout.
+        '''
+        result = []
+        interrupted = False
+        while True:
+            msg = get()
+
+            if (terminate is not None) and terminate(msg):
+                break
+
+            # exceptions
+            if msg['header'].get('error', None) is not None:
+                raise msg['header']['error']
+
+            # inconsistent dumps
+            if msg['header']['flags'] & NLM_F_DUMP_INTR:
+                interrupted = True
+
+            if msg['header']['type'] != NLMSG_DONE:
+                result.append(msg)
+
+            # wait for NLMSG_DONE if NLM_F_MULTI
+            if (terminate is None) and (
+                    (msg['header']['type'] == NLMSG_DONE) or
+                    (not msg['header']['flags'] & NLM_F_MULTI)):
+                break
+
+        if interrupted:
+            raise NetlinkDumpInterrupted(result)
 
         return result
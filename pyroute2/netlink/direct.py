@@ -0,0 +1,245 @@
+'''
+Direct netlink clients
+======================
+
+A request of `IPRoute` travels through an envelope and a pipe to
+the in-process broker, that rewrites the header and sends it to
+the kernel; the reply goes back through the masquerade cache,
+one more envelope and the I/O loop thread. That is the price of
+remote connections, callbacks and mirroring.
+
+`NetlinkDirect` has none of that: it owns a kernel socket and
+performs all the I/O synchronously in the calling thread. No
+broker, no envelopes, no helper threads. See also
+`pyroute2.netlink.iproute.DirectIPRoute`.
+'''
+import io
+import time
+import select
+import threading
+from functools import partial
+from collections import deque
+
+from pyroute2.netlink import NetlinkSocket
+from pyroute2.netlink import SOL_NETLINK
+from pyroute2.netlink import NETLINK_ADD_MEMBERSHIP
+from pyroute2.netlink import NETLINK_DROP_MEMBERSHIP
+from pyroute2.netlink import NLMSG_DONE
+from pyroute2.netlink import NLM_F_DUMP
+from pyroute2.netlink import NLM_F_MULTI
+from pyroute2.netlink.client import NetlinkClient
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+_BACKLOG_MAXSIZE = 4096
+_RECV_BUFSIZE = 65536
+# get() waits for the socket without the lock, but a message can
+# be received by a request in another thread, so check it that often
+_GET_SLICE = 0.2
+
+
+def _end_of_reply(msg):
+    return (msg['header'].get('error', None) is not None or
+            msg['header']['type'] == NLMSG_DONE or
+            not msg['header']['flags'] & NLM_F_MULTI)
+
+
+class NetlinkDirect(NetlinkClient):
+    '''
+    Threadless netlink client, that talks to the kernel socket
+    directly from the calling thread. Provides `nlm_request()`
+    compatible with the `Netlink` class, as well as `monitor()`,
+    `get()` and `release()`.
+
+    All the socket I/O is serialized with a lock, so an instance
+    can be used from several threads, but they will wait for each
+    other; for parallel requests use one instance per thread.
+
+    If a request ends before its reply does, e.g. on a timeout,
+    the rest of the reply is discarded as it comes; the next dump
+    waits for it, since the kernel runs one dump per socket, and
+    if it does not come, the socket is opened again.
+    '''
+
+    def __init__(self, timeout=3):
+        NetlinkClient.__init__(self, timeout)
+        self._open()
+        self.parser = self.marshal()
+        # requests are serialized, so a counter is enough; unlike
+        # a pool, it does not reuse the nonce of a timed out request
+        self.nonce = 0xff
+        self.lock = threading.RLock()
+        self.broadcast = deque(maxlen=_BACKLOG_MAXSIZE)
+        self.current = {}   # {nonce: deque(), ...}, requests in flight
+        self.ended = set()      # nonces of the complete replies
+        self.draining = set()   # nonces of the abandoned replies
+        self.monitoring = False
+
+    def _open(self):
+        self.sock = NetlinkSocket(self.family)
+        self.sock.bind(0)
+        self.portid = self.sock.getsockname()[0]
+
+    def _reopen(self):
+        '''
+        Replace the socket, that has an abandoned reply in it
+        '''
+        self.sock.close()
+        self._open()
+        self.draining.clear()
+        if self.monitoring:
+            for group in range(32):
+                if self.groups & (1 << group):
+                    self.sock.setsockopt(SOL_NETLINK,
+                                         NETLINK_ADD_MEMBERSHIP,
+                                         group + 1)
+
+    def release(self):
+        '''
+        Close the socket
+        '''
+        with self.lock:
+            self.sock.close()
+
+    def monitor(self, operate=True):
+        '''
+        Start or stop receiving broadcast messages
+        '''
+        with self.lock:
+            if operate == self.monitoring:
+                return
+            option = NETLINK_ADD_MEMBERSHIP if operate \
+                else NETLINK_DROP_MEMBERSHIP
+            for group in range(32):
+                if self.groups & (1 << group):
+                    self.sock.setsockopt(SOL_NETLINK, option, group + 1)
+            self.monitoring = operate
+            if not operate:
+                self.broadcast.clear()
+
+    def get(self, timeout=None):
+        '''
+        Get broadcast messages. Like `IOCore.get()`, returns a
+        list. Blocks until at least one message is received or
+        raises Queue.Empty on timeout. The lock is not held while
+        waiting, so requests from other threads are not blocked.
+        '''
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            with self.lock:
+                if self.broadcast:
+                    ret = list(self.broadcast)
+                    self.broadcast.clear()
+                    return ret
+            wait = _GET_SLICE
+            if timeout is not None:
+                wait = min(deadline - time.time(), wait)
+                if wait <= 0:
+                    raise Queue.Empty()
+            if select.select((self.sock, ), (), (), wait)[0]:
+                with self.lock:
+                    try:
+                        self._recv(0)
+                    except Queue.Empty:
+                        # received by another thread
+                        pass
+
+    def _recv(self, timeout):
+        '''
+        Receive one datagram and sort the messages: replies to
+        the current requests go to their queues in `current`,
+        multicast messages -- to `broadcast`, if monitoring is on,
+        everything else is dropped.
+        '''
+        if timeout is not None:
+            ready = select.select((self.sock, ), (), (), timeout)[0]
+            if not ready:
+                raise Queue.Empty()
+        raw, (pid, groups) = self.sock.recvfrom(_RECV_BUFSIZE)
+        data = io.BytesIO()
+        data.length = data.write(raw)
+        for msg in self.parser.parse(data):
+            nonce = msg['header'].get('sequence_number', 0)
+            # notifications, caused by our own requests, carry the
+            # request nonce, so check the multicast groups too
+            replies = None if groups else self.current.get(nonce)
+            if replies is not None:
+                replies.append(msg)
+                if _end_of_reply(msg):
+                    self.ended.add(nonce)
+            elif not groups and nonce in self.draining:
+                if _end_of_reply(msg):
+                    self.draining.discard(nonce)
+            elif self.monitoring and (groups or not nonce):
+                # late unicast replies are not events
+                self.broadcast.append(msg)
+
+    def _drain(self, timeout):
+        '''
+        Discard the rest of the abandoned replies
+        '''
+        while self.draining:
+            try:
+                self._recv(timeout)
+            except Queue.Empty:
+                self._reopen()
+
+    def _release(self):
+        '''
+        Forget the requests in flight; the replies, that did not
+        end, are discarded as they come
+        '''
+        for nonce in self.current:
+            if nonce not in self.ended:
+                self.draining.add(nonce)
+        self.current.clear()
+        self.ended.clear()
+
+    def _get_reply(self, nonce, timeout):
+        replies = self.current[nonce]
+        while not replies:
+            self._recv(timeout)
+        return replies.popleft()
+
+    def _send(self, msg, msg_type, msg_flags):
+        self.nonce = nonce = self.nonce % 0xffffffff + 1
+        msg['header']['sequence_number'] = nonce
+        msg['header']['pid'] = self.portid
+        msg['header']['type'] = msg_type
+        msg['header']['flags'] = msg_flags
+        msg.reset()
+        msg.encode()
+        self.sock.sendto(msg.buf.getvalue(), (0, 0))
+        # the reply is read only in this thread, under the lock
+        self.current[nonce] = deque()
+        return nonce
+
+    def _request(self, msg, msg_type, msg_flags, terminate, timeout):
+        timeout = timeout or self._timeout
+        with self.lock:
+            if msg_flags & NLM_F_DUMP:
+                self._drain(timeout)
+            try:
+                nonce = self._send(msg, msg_type, msg_flags)
+                return self._collect(lambda: self._get_reply(nonce,
+                                                             timeout),
+                                     terminate)
+            finally:
+                self._release()
+
+    def _request_batch(self, requests, timeout):
+        '''
+        Send all the requests, then collect the replies; they
+        are sorted by the sequence number
+        '''
+        with self.lock:
+            try:
+                nonces = [self._send(*x) for x in requests]
+                return self._collect_batch([partial(self._get_reply,
+                                                    nonce, timeout)
+                                            for nonce in nonces])
+            finally:
+                self._release()
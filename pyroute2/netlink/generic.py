@@ -78,6 +78,18 @@ class NotInitialized(Exception):
     pass
 
 
+def _clone(value, parent):
+    if isinstance(value, nlmsg_base):
+        return value.clone(parent)
+    elif isinstance(value, list):
+        return [_clone(x, parent) for x in value]
+    elif isinstance(value, tuple):
+        return tuple(_clone(x, parent) for x in value)
+    elif isinstance(value, dict):
+        return dict((x, _clone(y, parent)) for (x, y) in value.items())
+    return value
+
+
 class nlmsg_base(dict):
     '''
     Netlink base class. You do not need to inherit it directly, unless
@@ -162,6 +174,21 @@ class nlmsg_base(dict):
         ret.decode()
         return ret
 
+    def clone(self, parent=None):
+        '''
+        Return an independent copy of the decoded message. Unlike
+        `copy()`, the message is not parsed again: the decoded
+        objects are copied, so nothing is shared with the
+        original, but immutable values.
+        '''
+        ret = dict.__new__(type(self))
+        ret.__dict__.update(self.__dict__)
+        ret.parent = parent
+        ret.value = _clone(self.value, ret)
+        for (key, value) in self.items():
+            dict.__setitem__(ret, key, _clone(value, ret))
+        return ret
+
     def reset(self, buf=None):
         if isinstance(buf, basestring):
             b = io.BytesIO()
@@ -1754,7 +1754,7 @@ class IPDB(object):
         '''
         while not self._stop:
             try:
-                messages = self.nl.get()
+                messages = self.nl.get(batch=True)
             except:
                 continue
             for msg in messages:
@@ -26,12 +26,12 @@ threaded vs. threadless architecture
 Please note, that objects of `IPRoute` class implicitly starts
 several threads:
 
-* I/O Loop -- main thread that performs all Netlink I/O and clusterization
+* I/O Loop -- main thread that performs all Netlink I/O and clusterization;
+  it also runs timers: response timeouts and the masquerade cache
+  expiration (`IPRoute` objects can be connected together, and in this
+  case header masquerading should be performed on netlink packets)
 * Main thread -- thread that reassembles messages and parses them into
   dict-like structures
-* Cache thread -- `IPRoute` objects can be connected together, and in
-  this case header masquerading should be performed on netlink packets;
-  the thread performs masquerade cache expiration
 
 In most cases it should be ok, `IPRoute` uses no daemonic threads and
 explicit `release()` call is provided to stop all the threads. Beside
@@ -40,10 +40,22 @@ of that, the architecture provides packet buffering.
 But if you do not like implicit threads, you can use simplest
 threadless RTNetlink interface, `IPRSocket`.
 
+If you need many RTNL clients in one process, e.g. one per worker
+thread, use `SharedIPRoute`: it provides the same methods as
+`IPRoute`, but all the instances share one RTNL socket and one
+I/O loop.
+
+If you need no threads at all, but want the same methods, use
+`DirectIPRoute`: it talks to the kernel socket synchronously from
+the calling thread.
+
 classes
 -------
 '''
 
+import errno
+import struct
+import threading
 from socket import htons
 from socket import AF_INET
 from socket import AF_INET6
@@ -59,7 +71,12 @@ from pyroute2.netlink import NLM_F_ACK
 from pyroute2.netlink import NLM_F_DUMP
 from pyroute2.netlink import NLM_F_CREATE
 from pyroute2.netlink import NLM_F_EXCL
+from pyroute2.netlink import IPRCMD_SUBSCRIBE
+from pyroute2.netlink import IPRCMD_UNSUBSCRIBE
+from pyroute2.netlink import NetlinkError
 from pyroute2.netlink.client import Netlink
+from pyroute2.netlink.mux import NetlinkMuxClient
+from pyroute2.netlink.direct import NetlinkDirect
 from pyroute2.netlink.generic import NETLINK_ROUTE
 from pyroute2.netlink.rtnl.tcmsg import tcmsg
 from pyroute2.netlink.rtnl.tcmsg import get_htb_parameters
@@ -197,6 +214,39 @@ def transform_handle(handle):
     return handle
 
 
+def rtnl_object_key(msg):
+    '''
+    Return the identity of the object, that an RTNL event is
+    about, or None. Used as the key function to coalesce
+    monitoring events, see `pyroute2.iocore.listener`.
+    '''
+    mtype = msg['header']['type']
+    if mtype in (RTM_NEWLINK, RTM_DELLINK):
+        return ('link', msg['index'])
+    elif mtype in (RTM_NEWADDR, RTM_DELADDR):
+        return ('addr', msg['family'], msg['index'], msg['prefixlen'],
+                msg.get_attr('IFA_ADDRESS'))
+    elif mtype in (RTM_NEWROUTE, RTM_DELROUTE):
+        return ('route', msg['family'], msg.get_attr('RTA_TABLE'),
+                msg['dst_len'], msg.get_attr('RTA_DST'), msg['tos'],
+                msg.get_attr('RTA_PRIORITY'))
+    elif mtype in (RTM_NEWNEIGH, RTM_DELNEIGH):
+        return ('neigh', msg['family'], msg['ifindex'],
+                msg.get_attr('NDA_DST'))
+    return None
+
+
+def _pick_links(links, indices):
+    '''
+    Select interfaces from a dump in the order of `indices`
+    '''
+    links = dict((x['index'], x) for x in links)
+    try:
+        return [links[x] for x in indices]
+    except KeyError:
+        raise NetlinkError(errno.ENODEV)
+
+
 class MarshalRtnl(Marshal):
     msg_map = {RTM_NEWLINK: ifinfmsg,
                RTM_DELLINK: ifinfmsg,
@@ -291,113 +341,26 @@ class IPRSocket(NetlinkSocket):
         NetlinkSocket.bind(self, groups)
 
 
-class IPRoute(Netlink):
+class IPRouteMixin(object):
     '''
-    You can think of this class in some way as of plain old iproute2
-    utility.
-
-    It is an old-style library, that provides access to rtnetlink as is.
-    It helps you to retrieve and change almost all the data, available
-    through rtnetlink::
-
-        from pyroute2 import IPRoute
-        ipr = IPRoute()
-            # lookup interface by name
-        dev = ipr.link_lookup(ifname='tap0')[0]
-            # bring it down
-        ipr.link('set', dev, state='down')
-            # change interface MAC address and rename it
-        ipr.link('set', dev, address='00:11:22:33:44:55', ifname='vpn')
-            # add primary IP address
-        ipr.addr('add', dev, address='10.0.0.1', mask=24)
-            # add secondary IP address
-        ipr.addr('add', dev, address='10.0.0.2', mask=24)
-            # bring it up
-        ipr.link('set', dev, state='up')
-
-    *Usage*
-
-    IPRoute objects allows not only simple monitoring or querying
-    of RT netlink, but also clusterization of IPRoute instances.
-    Simple local sample:
-
-        >>> from pyroute2 import IPRoute
-        >>> from pprint import pprint
-        >>> ip = IPRoute()
-        >>> ip.monitor()
-        >>> pprint(ip.get())
-        [{'attrs': [('RTA_TABLE', 255),
-                    ('RTA_DST', 'ff02::1:2'),
-                    ('RTA_OIF', 3),
-                    ('RTA_PRIORITY', 0),
-                    ('RTA_CACHEINFO', {'rta_clntref': 1,
-                                       'rta_error': 0,
-                                       'rta_expires': 0,
-                                       'rta_id': 0,
-                                       'rta_lastuse': 0,
-                                       'rta_ts': 0,
-                                       'rta_tsage': 0,
-                                       'rta_used': 0})],
-          'dst_len': 128,
-          'event': 'RTM_NEWROUTE',
-          'family': 10,
-          'flags': 512,
-          'header': {'error': None,
-                     'flags': 0,
-                     'host': 'netlink://16',
-                     'length': 108,
-                     'pid': 0,
-                     'sequence_number': 0,
-                     'type': 24},
-          'proto': 0,
-          'scope': 0,
-          'src_len': 0,
-          'table': 255,
-          'tos': 0,
-          'type': 1}]
-        >>>
-
-    IPRoute objects have many methods to get the information
-    about Linux network objects:
-
-        >>> pprint(ip.get_routes()[0])
-        {'attrs': [('RTA_TABLE', 254),
-                   ('RTA_GATEWAY', '10.34.131.254'),
-                   ('RTA_OIF', 2)],
-         'dst_len': 0,
-         'event': 'RTM_NEWROUTE',
-         'family': 2,
-         'flags': 0,
-         'proto': 4,
-         'scope': 0,
-         'src_len': 0,
-         'table': 254,
-         'tos': 0,
-         'type': 1}
-        >>> pprint(ip.get_neighbors()[0])
-        {'attrs': [('NDA_DST', 'ff02::2'),
-                   ('NDA_LLADDR', '33:33:00:00:00:02'),
-                   ('NDA_PROBES', 0),
-                   ('NDA_CACHEINFO', {'ndm_confirmed': 309550224,
-                                      'ndm_refcnt': 0,
-                                      'ndm_updated': 309544224,
-                                      'ndm_used': 309544224})],
-         'event': 'RTM_NEWNEIGH',
-         'family': 10,
-         'flags': 0,
-         'ifindex': 33554432,
-         'ndm_type': 64,
-         'state': 0}
-        >>>
-
-    But IPRoute objects start additional threads to implement
-    transparent authentication, message reassembling and so on.
-    Sometimes it can become an overkill for simple projects, in
-    these cases consider usage of IPRSocket.
+    RTNL listing and configuration methods. The class is not
+    intended to be used directly: it is mixed into classes that
+    provide the transport, i.e. `nlm_request()` method, like
+    `IPRoute`.
+
+    Results are post-processed via `_then()`, so the methods
+    work also with transports, that return futures instead of
+    replies, see `pyroute2.netlink.aio`. Transports should also
+    provide `nlm_request_batch()`.
     '''
-    marshal = MarshalRtnl
-    family = NETLINK_ROUTE
-    groups = RTNL_GROUPS
+    links_batch_max = 64
+
+    def _then(self, func, *results):
+        '''
+        Return `func(*results)`. Asynchronous transports
+        override it to call `func` when the results are ready.
+        '''
+        return func(*results)
 
     # 8<---------------------------------------------------------------
     #
@@ -414,7 +377,8 @@ class IPRoute(Netlink):
         if index is None:
             return ret
         else:
-            return [x for x in ret if x['index'] == index]
+            return self._then(lambda ret: [x for x in ret
+                                           if x['index'] == index], ret)
 
     def get_filters(self, index=0, handle=0, parent=0):
         '''
@@ -450,18 +414,50 @@ class IPRoute(Netlink):
 
             interfaces = [1, 2, 3]
             ip.get_links(*interfaces)
+
+        Requests for several indices are sent back to back,
+        not waiting for the replies. If there are more than
+        `links_batch_max` indices, one dump is requested and
+        filtered instead. Unknown indices raise NetlinkError
+        (ENODEV) in both cases.
+        '''
+        if len(argv) < 2 or 'all' in argv:
+            result = []
+            for (msg, msg_flags) in self._links_query(argv, kwarg):
+                result.append(self.nlm_request(msg, RTM_GETLINK, msg_flags))
+            return self._then(lambda *x: [y for z in x for y in z], *result)
+
+        if len(argv) > self.links_batch_max:
+            # one dump costs less than that many requests
+            msg = ifinfmsg()
+            msg['family'] = kwarg.get('family', AF_UNSPEC)
+            return self._then(lambda x: _pick_links(x, argv),
+                              self.nlm_request(msg, RTM_GETLINK))
+
+        # send all the requests at once, not waiting for replies
+        requests = [(msg, RTM_GETLINK, msg_flags) for (msg, msg_flags)
+                    in self._links_query(argv, kwarg)]
+        return self._then(lambda x: [y for z in x for y in z],
+                          self.nlm_request_batch(requests))
+
+    def iter_links(self, *argv, **kwarg):
         '''
-        result = []
-        links = argv or ['all']
+        Like `get_links()`, but return a generator, that yields
+        interfaces as the reply parts arrive, see `nlm_stream()`
+        '''
+        for (msg, msg_flags) in self._links_query(argv, kwarg):
+            for link in self.nlm_stream(msg, RTM_GETLINK, msg_flags):
+                yield link
+
+    def _links_query(self, argv, kwarg):
         msg_flags = NLM_F_REQUEST | NLM_F_DUMP
-        for index in links:
+        for index in argv or ['all']:
             msg = ifinfmsg()
             msg['family'] = kwarg.get('family', AF_UNSPEC)
             if index != 'all':
                 msg['index'] = index
                 msg_flags = NLM_F_REQUEST
-            result.extend(self.nlm_request(msg, RTM_GETLINK, msg_flags))
-        return result
+            yield (msg, msg_flags)
 
     def get_neighbors(self, family=AF_UNSPEC):
         '''
@@ -471,6 +467,15 @@ class IPRoute(Netlink):
         msg['family'] = family
         return self.nlm_request(msg, RTM_GETNEIGH)
 
+    def iter_neighbors(self, family=AF_UNSPEC):
+        '''
+        Like `get_neighbors()`, but return a generator, see
+        `nlm_stream()`
+        '''
+        msg = ndmsg()
+        msg['family'] = family
+        return self.nlm_stream(msg, RTM_GETNEIGH)
+
     def get_addr(self, family=AF_UNSPEC):
         '''
         Get all addresses.
@@ -506,7 +511,31 @@ class IPRoute(Netlink):
             ip.get_routes(family=AF_INET6)  # get only IPv6 routes
             ip.get_routes(table=254)  # get routes from 254 table
         '''
+        (msg, msg_flags, match) = self._routes_query(family, kwarg)
+        routes = self.nlm_request(msg, RTM_GETROUTE, msg_flags)
+        return self._then(lambda routes: [x for x in routes if match(x)],
+                          routes)
 
+    def iter_routes(self, family=AF_UNSPEC, **kwarg):
+        '''
+        Like `get_routes()`, but return a generator, that yields
+        routes as the reply parts arrive, see `nlm_stream()`.
+        Walking a big table takes memory only for one part, and
+        the iteration can be stopped at any moment::
+
+            for route in ip.iter_routes(table=254):
+                if route.get_attr('RTA_GATEWAY') == gateway:
+                    break
+        '''
+        (msg, msg_flags, match) = self._routes_query(family, kwarg)
+        return (x for x in self.nlm_stream(msg, RTM_GETROUTE, msg_flags)
+                if match(x))
+
+    def _routes_query(self, family, kwarg):
+        '''
+        Return the request, its flags and the filter for the
+        replies
+        '''
         msg_flags = NLM_F_DUMP | NLM_F_REQUEST
         msg = rtmsg()
         msg['family'] = family
@@ -527,10 +556,11 @@ class IPRoute(Netlink):
             if kwarg[key] is not None:
                 msg['attrs'].append([nla, kwarg[key]])
 
-        routes = self.nlm_request(msg, RTM_GETROUTE, msg_flags)
-        return [x for x in routes
-                if x.get_attr('RTA_TABLE') == table or
-                kwarg.get('table', None) is None]
+        def match(route):
+            return route.get_attr('RTA_TABLE') == table or \
+                kwarg.get('table', None) is None
+
+        return (msg, msg_flags, match)
     # 8<---------------------------------------------------------------
 
     # 8<---------------------------------------------------------------
@@ -546,21 +576,24 @@ class IPRoute(Netlink):
         Get default routes
         '''
         # according to iproute2/ip/iproute.c:print_route()
-        return [x for x in self.get_routes(family, table=table)
-                if (x.get_attr('RTA_DST', None) is None and
-                    x['dst_len'] == 0)]
+        def select(routes):
+            return [x for x in routes
+                    if (x.get_attr('RTA_DST', None) is None and
+                        x['dst_len'] == 0)]
+
+        return self._then(select, self.get_routes(family, table=table))
 
     def link_up(self, index):
         '''
         Switch an interface up unconditionally.
         '''
-        self.link('set', index=index, state='up')
+        return self.link('set', index=index, state='up')
 
     def link_down(self, index):
         '''
         Switch an interface down unconditilnally.
         '''
-        self.link('set', index=index, state='down')
+        return self.link('set', index=index, state='down')
 
     def link_rename(self, index, name):
         '''
@@ -568,13 +601,13 @@ class IPRoute(Netlink):
         in the `DOWN` state in order to be renamed, otherwise you
         will get an error.
         '''
-        self.link('set', index=index, ifname=name)
+        return self.link('set', index=index, ifname=name)
 
     def link_remove(self, index):
         '''
         Remove an interface
         '''
-        self.link('delete', index=index)
+        return self.link('delete', index=index)
 
     def link_lookup(self, **kwarg):
         '''
@@ -588,18 +621,29 @@ class IPRoute(Netlink):
             ip.link_lookup(operstate="UP")
 
         Please note, that link_lookup() returns list, not one
-        value.
+        value. Addresses are compared case-insensitive.
         '''
-        name = tuple(kwarg.keys())[0]
-        value = kwarg[name]
+        (name, value) = self._lookup_key(kwarg)
+
+        def select(links):
+            return [k['index'] for k in
+                    [i for i in links if 'attrs' in i] if
+                    [l for l in k['attrs'] if l[0] == name and l[1] == value]]
 
+        return self._then(select, self.get_links())
+
+    def _lookup_key(self, kwarg):
+        '''
+        Return the NLA name and value of a `link_lookup()` call;
+        the kernel reports addresses in lower case
+        '''
+        (name, value) = tuple(kwarg.items())[0]
         name = str(name).upper()
         if not name.startswith('IFLA_'):
             name = 'IFLA_%s' % (name)
-
-        return [k['index'] for k in
-                [i for i in self.get_links() if 'attrs' in i] if
-                [l for l in k['attrs'] if l[0] == name and l[1] == value]]
+        if name == 'IFLA_ADDRESS' and value is not None:
+            value = value.lower()
+        return (name, value)
     # 8<---------------------------------------------------------------
 
     # 8<---------------------------------------------------------------
@@ -1008,3 +1052,311 @@ class IPRoute(Netlink):
         return self.nlm_request(msg, msg_type=command,
                                 msg_flags=msg_flags)
     # 8<---------------------------------------------------------------
+
+
+def _type_key(msg_type, mask=0xffff):
+    # the broker compares native u32 words at the offset, and
+    # the message type is the first u16 of the word
+    return {'offset': 4,
+            'key': struct.unpack('I', struct.pack('HH', msg_type, 0))[0],
+            'mask': struct.unpack('I', struct.pack('HH', mask, 0))[0]}
+
+
+class LinkResolver(object):
+    '''
+    Interface name and address cache of an `IPRoute` object,
+    see `IPRoute.link_cache()`.
+
+    The maps are updated from `RTM_NEWLINK` and `RTM_DELLINK`
+    messages: the resolver subscribes to them in the broker and
+    uses keyed callbacks, so neither the monitoring queue nor
+    the mirroring are required. The replies to own requests of
+    the `IPRoute` object update the cache as well.
+
+    If a name is not in the cache, and `fallback` is True, the
+    interface is requested from the kernel by name.
+    '''
+
+    def __init__(self, ipr, fallback=True):
+        self.ipr = ipr
+        self.fallback = fallback
+        self.lock = threading.Lock()
+        self.links = {}         # {index: (ifname, address), ...}
+        self.by_name = {}       # {ifname: index, ...}
+        self.by_address = {}    # {address: set([index, ...]), ...}
+        ipr.register_callback(self.update, msg_type=RTM_NEWLINK)
+        ipr.register_callback(self.update, msg_type=RTM_DELLINK)
+        # RTM_NEWLINK and RTM_DELLINK differ in the lowest bit
+        self.cid = ipr.command(IPRCMD_SUBSCRIBE,
+                               [['IPR_ATTR_KEY',
+                                 _type_key(RTM_NEWLINK, 0xfffe)]],
+                               expect='IPR_ATTR_CID')
+        # the reply passes the callbacks, so it fills the cache
+        ipr.get_links()
+
+    def close(self):
+        self.ipr.command(IPRCMD_UNSUBSCRIBE, [['IPR_ATTR_CID', self.cid]])
+        # registered twice, for both message types
+        self.ipr.unregister_callback(self.update)
+        self.ipr.unregister_callback(self.update)
+
+    def _remove(self, index):
+        if index not in self.links:
+            return
+        (ifname, address) = self.links.pop(index)
+        if self.by_name.get(ifname) == index:
+            del self.by_name[ifname]
+        indices = self.by_address.get(address)
+        if indices is not None:
+            indices.discard(index)
+            if not indices:
+                del self.by_address[address]
+
+    def update(self, envelope, msg):
+        '''
+        Callback: update the maps from a link message
+        '''
+        index = msg['index']
+        with self.lock:
+            self._remove(index)
+            if msg['header']['type'] == RTM_DELLINK:
+                return
+            ifname = msg.get_attr('IFLA_IFNAME')
+            address = msg.get_attr('IFLA_ADDRESS')
+            self.links[index] = (ifname, address)
+            self.by_name[ifname] = index
+            self.by_address.setdefault(address, set()).add(index)
+
+    def lookup(self, name, value):
+        '''
+        Resolve IFLA_IFNAME or IFLA_ADDRESS to the list of
+        indices. Returns None for other NLA. The value should be
+        normalized as in `IPRouteMixin._lookup_key()`.
+        '''
+        if name == 'IFLA_ADDRESS':
+            with self.lock:
+                return sorted(self.by_address.get(value, ()))
+        elif name != 'IFLA_IFNAME':
+            return None
+        with self.lock:
+            if value in self.by_name:
+                return [self.by_name[value]]
+        if not self.fallback:
+            return []
+        # one interface, not a dump
+        msg = ifinfmsg()
+        msg['attrs'] = [['IFLA_IFNAME', value]]
+        try:
+            self.ipr.nlm_request(msg, RTM_GETLINK, NLM_F_REQUEST)
+        except NetlinkError as e:
+            if e.code == 19:    # ENODEV
+                return []
+            raise
+        with self.lock:
+            return [self.by_name[value]] if value in self.by_name else []
+
+
+class IPRoute(IPRouteMixin, Netlink):
+    '''
+    You can think of this class in some way as of plain old iproute2
+    utility.
+
+    It is an old-style library, that provides access to rtnetlink as is.
+    It helps you to retrieve and change almost all the data, available
+    through rtnetlink::
+
+        from pyroute2 import IPRoute
+        ipr = IPRoute()
+            # lookup interface by name
+        dev = ipr.link_lookup(ifname='tap0')[0]
+            # bring it down
+        ipr.link('set', dev, state='down')
+            # change interface MAC address and rename it
+        ipr.link('set', dev, address='00:11:22:33:44:55', ifname='vpn')
+            # add primary IP address
+        ipr.addr('add', dev, address='10.0.0.1', mask=24)
+            # add secondary IP address
+        ipr.addr('add', dev, address='10.0.0.2', mask=24)
+            # bring it up
+        ipr.link('set', dev, state='up')
+
+    *Usage*
+
+    IPRoute objects allows not only simple monitoring or querying
+    of RT netlink, but also clusterization of IPRoute instances.
+    Simple local sample:
+
+        >>> from pyroute2 import IPRoute
+        >>> from pprint import pprint
+        >>> ip = IPRoute()
+        >>> ip.monitor()
+        >>> pprint(ip.get())
+        [{'attrs': [('RTA_TABLE', 255),
+                    ('RTA_DST', 'ff02::1:2'),
+                    ('RTA_OIF', 3),
+                    ('RTA_PRIORITY', 0),
+                    ('RTA_CACHEINFO', {'rta_clntref': 1,
+                                       'rta_error': 0,
+                                       'rta_expires': 0,
+                                       'rta_id': 0,
+                                       'rta_lastuse': 0,
+                                       'rta_ts': 0,
+                                       'rta_tsage': 0,
+                                       'rta_used': 0})],
+          'dst_len': 128,
+          'event': 'RTM_NEWROUTE',
+          'family': 10,
+          'flags': 512,
+          'header': {'error': None,
+                     'flags': 0,
+                     'host': 'netlink://16',
+                     'length': 108,
+                     'pid': 0,
+                     'sequence_number': 0,
+                     'type': 24},
+          'proto': 0,
+          'scope': 0,
+          'src_len': 0,
+          'table': 255,
+          'tos': 0,
+          'type': 1}]
+        >>>
+
+    IPRoute objects have many methods to get the information
+    about Linux network objects:
+
+        >>> pprint(ip.get_routes()[0])
+        {'attrs': [('RTA_TABLE', 254),
+                   ('RTA_GATEWAY', '10.34.131.254'),
+                   ('RTA_OIF', 2)],
+         'dst_len': 0,
+         'event': 'RTM_NEWROUTE',
+         'family': 2,
+         'flags': 0,
+         'proto': 4,
+         'scope': 0,
+         'src_len': 0,
+         'table': 254,
+         'tos': 0,
+         'type': 1}
+        >>> pprint(ip.get_neighbors()[0])
+        {'attrs': [('NDA_DST', 'ff02::2'),
+                   ('NDA_LLADDR', '33:33:00:00:00:02'),
+                   ('NDA_PROBES', 0),
+                   ('NDA_CACHEINFO', {'ndm_confirmed': 309550224,
+                                      'ndm_refcnt': 0,
+                                      'ndm_updated': 309544224,
+                                      'ndm_used': 309544224})],
+         'event': 'RTM_NEWNEIGH',
+         'family': 10,
+         'flags': 0,
+         'ifindex': 33554432,
+         'ndm_type': 64,
+         'state': 0}
+        >>>
+
+    But IPRoute objects start additional threads to implement
+    transparent authentication, message reassembling and so on.
+    Sometimes it can become an overkill for simple projects, in
+    these cases consider usage of IPRSocket.
+
+    The monitoring queue is bounded. If events can come faster
+    than they are read, choose the overflow policy::
+
+        ip.monitor(size=16384, policy='coalesce')
+
+    With 'coalesce' a new event replaces the queued one for the
+    same link, address, route or neighbour. Lost and coalesced
+    events are counted, see `queue_stats()`.
+    '''
+    marshal = MarshalRtnl
+    family = NETLINK_ROUTE
+    groups = RTNL_GROUPS
+    coalesce_key = staticmethod(rtnl_object_key)
+    resolver = None
+
+    def link_cache(self, operate=True, fallback=True):
+        '''
+        Turn the link resolver cache on or off. With the cache
+        `link_lookup()` by `ifname` or `address` is a dictionary
+        lookup instead of a full dump, see `LinkResolver`::
+
+            ip.link_cache()
+            for name in names:
+                ip.link_lookup(ifname=name)
+
+        With `fallback` names, missing in the cache, are
+        requested from the kernel one by one.
+
+        The cache is updated asynchronously, so a hit can be stale:
+        until the `RTM_NEWLINK` or `RTM_DELLINK` message of a change
+        is processed, the lookup returns the old index, and a
+        removed or renamed interface can still be found.
+        '''
+        if operate and self.resolver is None:
+            self.resolver = LinkResolver(self, fallback)
+        elif not operate and self.resolver is not None:
+            self.resolver.close()
+            self.resolver = None
+
+    def link_lookup(self, **kwarg):
+        if self.resolver is not None and len(kwarg) == 1:
+            (name, value) = self._lookup_key(kwarg)
+            ret = self.resolver.lookup(name, value)
+            if ret is not None:
+                return ret
+        return IPRouteMixin.link_lookup(self, **kwarg)
+    link_lookup.__doc__ = IPRouteMixin.link_lookup.__doc__
+
+
+class SharedIPRoute(IPRouteMixin, NetlinkMuxClient):
+    '''
+    Lightweight RTNL client with `IPRoute` methods. All the
+    instances within one process and one network namespace share
+    one RTNL socket and one I/O loop, so an instance costs neither
+    threads nor file descriptors::
+
+        from pyroute2 import SharedIPRoute
+
+        def worker():
+            ip = SharedIPRoute()
+            try:
+                return ip.link_lookup(ifname='lo')
+            finally:
+                ip.release()
+
+    Replies are dispatched to the instances by the sequence number.
+    Broadcast messages are delivered to all the instances that
+    called `monitor()`, use `get()` to fetch them.
+
+    The class provides no remote connections, no callbacks and no
+    message mirroring, use `IPRoute` for that.
+    '''
+    marshal = MarshalRtnl
+    family = NETLINK_ROUTE
+    groups = RTNL_GROUPS
+
+
+class DirectIPRoute(IPRouteMixin, NetlinkDirect):
+    '''
+    Threadless RTNL client with `IPRoute` methods. Every instance
+    owns one RTNL socket and performs all the I/O in the calling
+    thread, bypassing the broker::
+
+        from pyroute2 import DirectIPRoute
+
+        ip = DirectIPRoute()
+        try:
+            print(ip.link_lookup(ifname='lo'))
+        finally:
+            ip.release()
+
+    Call `monitor()` to receive broadcast messages and `get()`
+    to fetch them.
+
+    The class provides no remote connections, no callbacks and no
+    message mirroring, use `IPRoute` for that.
+    '''
+    marshal = MarshalRtnl
+    family = NETLINK_ROUTE
+    groups = RTNL_GROUPS
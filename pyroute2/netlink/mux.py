@@ -0,0 +1,413 @@
+'''
+Shared netlink sockets
+======================
+
+Every `IPRoute` object starts its own I/O loop, broker, pipes
+and threads. If an application needs many RTNL clients in one
+process -- e.g., one per worker thread -- it is much cheaper to
+share one kernel socket between them.
+
+`NetlinkMux` is such a shared socket. There is only one mux per
+netlink family, marshal class and network namespace in the process,
+and all the muxes share one I/O loop. Replies are dispatched to
+the clients by the sequence number, and broadcast messages are
+copied to every client that called `monitor()`.
+
+A mux can be opened also in another network namespace, see
+`pyroute2.netlink.nspool.NetNSPool`.
+
+`NetlinkMuxClient` is a lightweight client handle: no sockets and
+no threads of its own, just a reference to the mux. See also
+`pyroute2.netlink.iproute.SharedIPRoute`.
+'''
+import io
+import time
+import threading
+from functools import partial
+
+from pyroute2.netlink import Marshal
+from pyroute2.netlink import NetlinkSocket
+from pyroute2.netlink import SOL_NETLINK
+from pyroute2.netlink import NETLINK_ADD_MEMBERSHIP
+from pyroute2.netlink import NETLINK_DROP_MEMBERSHIP
+from pyroute2.netlink import NLMSG_DONE
+from pyroute2.netlink import NLM_F_DUMP
+from pyroute2.netlink import NLM_F_MULTI
+from pyroute2.netlink.netns import netns_id
+from pyroute2.netlink.netns import netns_call
+from pyroute2.netlink.client import NetlinkClient
+from pyroute2.iocore.loop import IOLoop
+from pyroute2.iocore.addrpool import AddrPool
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+_QUEUE_MAXSIZE = 4096
+
+
+def parse_buffer(marshal, raw):
+    '''
+    Parse a (groups, buffer) pair, see `MuxReader`, with a new
+    marshal instance. A module level function, so it can be run
+    in the I/O loop process pool.
+    '''
+    if not raw:
+        return (0, [])
+    (groups, raw) = raw
+    data = io.BytesIO()
+    data.length = data.write(raw)
+    return (groups, marshal().parse(data))
+
+
+def _end_of_reply(msg):
+    return (msg['header'].get('error', None) is not None or
+            msg['header']['type'] == NLMSG_DONE or
+            not msg['header']['flags'] & NLM_F_MULTI)
+
+
+class MuxReader(object):
+    '''
+    The mux socket, as the I/O loop reads it: `recv()` returns
+    (groups, buffer), so the router can tell multicast messages
+    from unicast ones.
+    '''
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def recv(self, bufsize):
+        (data, (pid, groups)) = self.sock.recvfrom(bufsize)
+        return (groups, data)
+
+
+class MuxReply(Queue.Queue):
+    '''
+    Reply queue of a request; `complete` tells if the last
+    message, taken with `get_reply()`, ends the reply. Until the
+    request is sent, there is nothing to wait for.
+    '''
+    complete = True
+
+    def get_reply(self, timeout):
+        msg = self.get(block=True, timeout=timeout)
+        self.complete = _end_of_reply(msg)
+        return msg
+
+
+class MuxDrain(object):
+    '''
+    Listener of an abandoned request, see `NetlinkMux.close()`.
+    The rest of the reply still comes with the request nonce, so
+    the nonce and the dump lock are kept, until the reply ends,
+    or no messages come for `timeout` seconds.
+    '''
+
+    def __init__(self, mux, nonce, dump, timeout):
+        self.mux = mux
+        self.nonce = nonce
+        self.dump = dump
+        self.timeout = timeout
+        self.last = time.time()
+        self.done = False
+        self.lock = threading.Lock()
+        self.timer = NetlinkMux._ioloop.schedule(timeout, self.expire)
+
+    def put(self, msg):
+        self.last = time.time()
+        if _end_of_reply(msg):
+            self.finish()
+
+    def expire(self):
+        idle = time.time() - self.last
+        if idle < self.timeout:
+            self.timer = NetlinkMux._ioloop.schedule(self.timeout - idle,
+                                                     self.expire)
+        else:
+            self.finish()
+
+    def finish(self):
+        with self.lock:
+            if self.done:
+                return
+            self.done = True
+        self.timer.cancel()
+        mux = self.mux
+        if mux.listeners.get(self.nonce) is self:
+            del mux.listeners[self.nonce]
+        mux.nonce.free(self.nonce)
+        if self.dump:
+            mux.dump_lock.release()
+
+
+class NetlinkMux(object):
+    '''
+    Netlink socket, shared by many clients in one process.
+
+    Do not create it directly, use `NetlinkMux.acquire()`, that
+    returns an existing mux for the family, marshal and the
+    network namespace, or creates a new one. Every acquire()
+    call must be paired with release().
+
+    Muxes are served by `workers` threads of the shared I/O loop,
+    so a slow client of one namespace does not stall the others.
+    With `processes` > 0 the messages are parsed in a process pool.
+    Both are applied when the loop starts with the first mux.
+    '''
+    _lock = threading.Lock()
+    _registry = {}    # {(family, marshal, netns): NetlinkMux(), ...}
+    _ioloop = None
+    workers = 4
+    processes = 0
+
+    def __init__(self, family, marshal, key=None, netns=None):
+        self.key = key
+        if netns is None:
+            self.sock = NetlinkSocket(family)
+        else:
+            self.sock = netns_call(netns, NetlinkSocket, family)
+        self.sock.bind(0)
+        self.portid = self.sock.getsockname()[0]
+        self.marshal = marshal
+        self.nonce = AddrPool(minaddr=0xff, maxaddr=0xffffffff)
+        self.listeners = {}     # {nonce: Queue(), ...}
+        self.monitors = set()   # set(Queue(), Queue(), ...)
+        self.groups = 0
+        self.clients = 0
+        self.lock = threading.Lock()
+        # the kernel runs only one dump per socket at once
+        self.dump_lock = threading.Lock()
+
+    @classmethod
+    def acquire(cls, family, marshal=Marshal, netns=None):
+        '''
+        Get the shared socket. `netns` is the network namespace
+        name, path or file descriptor, by default the current
+        namespace is used.
+        '''
+        key = (family, marshal, netns_id(netns))
+        if key[2] is None and netns is not None:
+            raise OSError(2, 'network namespace not found: %s' % (netns, ))
+        with cls._lock:
+            if NetlinkMux._ioloop is None:
+                NetlinkMux._ioloop = IOLoop(edge=True,
+                                            workers=cls.workers,
+                                            processes=cls.processes)
+                NetlinkMux._ioloop.start()
+            mux = cls._registry.get(key, None)
+            if mux is None:
+                mux = cls(family, marshal, key, netns)
+                cls._registry[key] = mux
+                NetlinkMux._ioloop.register(MuxReader(mux.sock),
+                                            mux.route,
+                                            defer=True,
+                                            parse=partial(parse_buffer,
+                                                          marshal))
+            mux.clients += 1
+            return mux
+
+    def release(self):
+        '''
+        Release the shared socket. The last release() call
+        closes the socket, and if there are no sockets left,
+        the I/O loop is stopped.
+        '''
+        with self._lock:
+            self.clients -= 1
+            if self.clients > 0:
+                return
+            del self._registry[self.key]
+            NetlinkMux._ioloop.unregister(self.sock)
+            self.sock.close()
+            if not self._registry:
+                NetlinkMux._ioloop.shutdown()
+                NetlinkMux._ioloop.join()
+                NetlinkMux._ioloop = None
+
+    def route(self, sock, data):
+        '''
+        Dispatch parsed messages from the kernel: replies -- by
+        the sequence number, multicast messages -- to all the
+        monitors. Notifications, caused by own requests, carry
+        the request nonce, so the multicast groups are checked
+        first. Unicast messages with no listener, like late
+        replies, are dropped.
+        '''
+        (groups, msgs) = data
+        for msg in msgs:
+            nonce = msg['header'].get('sequence_number', 0)
+            if not groups:
+                queue = self.listeners.get(nonce, None)
+                if queue is not None:
+                    queue.put(msg)
+                    continue
+                if nonce:
+                    continue
+            for queue in tuple(self.monitors):
+                try:
+                    queue.put_nowait(msg)
+                except Queue.Full:
+                    pass
+
+    def send(self, data):
+        self.sock.sendto(data, (0, 0))
+
+    def open(self, dump):
+        '''
+        Allocate the nonce and the reply queue of a request; for
+        dumps also take the dump lock. Release with `close()`.
+        '''
+        nonce = self.nonce.alloc()
+        reply = MuxReply()
+        self.listeners[nonce] = reply
+        if dump:
+            self.dump_lock.acquire()
+        return (nonce, reply)
+
+    def close(self, nonce, reply, dump, timeout):
+        '''
+        Free the nonce and the dump lock of a request. If the
+        reply is not complete, e.g. on a timeout, the rest of it
+        is discarded first, see `MuxDrain`.
+        '''
+        if reply.complete:
+            del self.listeners[nonce]
+            self.nonce.free(nonce)
+            if dump:
+                self.dump_lock.release()
+            return
+        drain = MuxDrain(self, nonce, dump, timeout)
+        self.listeners[nonce] = drain
+        while True:
+            try:
+                drain.put(reply.get_nowait())
+            except Queue.Empty:
+                break
+
+    def subscribe(self, queue, groups):
+        '''
+        Start copying broadcast messages into the queue. Join
+        the multicast groups, if the socket is not joined yet.
+        '''
+        with self.lock:
+            self.monitors.add(queue)
+            for group in range(32):
+                mask = 1 << group
+                if (groups & mask) and not (self.groups & mask):
+                    self.sock.setsockopt(SOL_NETLINK,
+                                         NETLINK_ADD_MEMBERSHIP,
+                                         group + 1)
+                    self.groups |= mask
+
+    def unsubscribe(self, queue):
+        '''
+        Stop copying broadcast messages into the queue. Leave
+        all the groups when the last monitor is removed.
+        '''
+        with self.lock:
+            self.monitors.discard(queue)
+            if self.monitors:
+                return
+            for group in range(32):
+                if self.groups & (1 << group):
+                    self.sock.setsockopt(SOL_NETLINK,
+                                         NETLINK_DROP_MEMBERSHIP,
+                                         group + 1)
+            self.groups = 0
+
+
+class NetlinkMuxClient(NetlinkClient):
+    '''
+    Lightweight netlink client, that uses `NetlinkMux` as the
+    transport. Besides of `nlm_request()` provides `monitor()`,
+    `get()` and `release()`.
+    '''
+
+    def __init__(self, timeout=3):
+        NetlinkClient.__init__(self, timeout)
+        self.mux = self.acquire_mux()
+        self.queue = None
+
+    def acquire_mux(self):
+        return NetlinkMux.acquire(self.family, self.marshal)
+
+    def release(self):
+        '''
+        Release the shared socket
+        '''
+        self.monitor(False)
+        self.mux.release()
+
+    def monitor(self, operate=True):
+        '''
+        Start or stop receiving broadcast messages. Please
+        note, that messages in the queue are shared with other
+        clients, so do not modify them.
+        '''
+        if operate and self.queue is None:
+            self.queue = Queue.Queue(maxsize=_QUEUE_MAXSIZE)
+            self.mux.subscribe(self.queue, self.groups)
+        elif not operate and self.queue is not None:
+            self.mux.unsubscribe(self.queue)
+            self.queue = None
+
+    def get(self, timeout=None):
+        '''
+        Get the next broadcast message. Like `IOCore.get()`,
+        returns a list.
+        '''
+        while True:
+            # timeout should also be set to catch ctrl-c
+            # Bug-Url: http://bugs.python.org/issue1360
+            try:
+                return [self.queue.get(timeout=timeout or 0xffff)]
+            except Queue.Empty:
+                if timeout is not None:
+                    raise
+
+    def _request(self, msg, msg_type, msg_flags, terminate, timeout):
+        timeout = timeout or self._timeout
+        mux = self.mux
+        dump = msg_flags & NLM_F_DUMP
+        (nonce, reply) = mux.open(dump)
+        try:
+            msg['header']['sequence_number'] = nonce
+            msg['header']['pid'] = mux.portid
+            msg['header']['type'] = msg_type
+            msg['header']['flags'] = msg_flags
+            msg.reset()
+            msg.encode()
+            mux.send(msg.buf.getvalue())
+            reply.complete = False
+            return self._collect(lambda: reply.get_reply(timeout),
+                                 terminate)
+        finally:
+            mux.close(nonce, reply, dump, timeout)
+
+    def _request_batch(self, requests, timeout):
+        '''
+        Send all the requests, then collect the replies from
+        their queues
+        '''
+        mux = self.mux
+        replies = []    # [(nonce, MuxReply()), ...]
+        try:
+            for (msg, msg_type, msg_flags) in requests:
+                (nonce, reply) = mux.open(False)
+                replies.append((nonce, reply))
+                msg['header']['sequence_number'] = nonce
+                msg['header']['pid'] = mux.portid
+                msg['header']['type'] = msg_type
+                msg['header']['flags'] = msg_flags
+                msg.reset()
+                msg.encode()
+                mux.send(msg.buf.getvalue())
+                reply.complete = False
+            return self._collect_batch([partial(reply.get_reply, timeout)
+                                        for (nonce, reply) in replies])
+        finally:
+            for (nonce, reply) in replies:
+                mux.close(nonce, reply, False, timeout)
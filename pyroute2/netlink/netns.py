@@ -0,0 +1,96 @@
+'''
+Network namespaces utilities
+
+A netlink socket belongs to the network namespace it was
+created in, so to open a socket in another namespace one should
+switch the current thread into it, create the socket and switch
+back. `netns_call()` does exactly that.
+
+Namespaces can be referenced by a name (as in `ip netns`, a file
+in `/var/run/netns/`), by an absolute path or by an open file
+descriptor.
+'''
+import os
+import ctypes
+
+CLONE_NEWNET = 0x40000000
+NETNS_RUN_DIR = '/var/run/netns'
+
+_libc = ctypes.CDLL(None, use_errno=True)
+
+
+def netns_path(netns):
+    '''
+    Return the file path of a namespace by its name
+    '''
+    if netns.startswith('/'):
+        return netns
+    return os.path.join(NETNS_RUN_DIR, netns)
+
+
+def _self_path():
+    for path in ('/proc/thread-self/ns/net', '/proc/self/ns/net'):
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def netns_id(netns=None):
+    '''
+    Return the inode number, that identifies the network
+    namespace, or None if it can not be detected. By default
+    returns the id of the current namespace.
+    '''
+    try:
+        if netns is None:
+            path = _self_path()
+            if path is None:
+                return None
+            return os.stat(path).st_ino
+        elif isinstance(netns, int):
+            return os.fstat(netns).st_ino
+        else:
+            return os.stat(netns_path(netns)).st_ino
+    except OSError:
+        return None
+
+
+def listnetns():
+    '''
+    List names of the namespaces, created by `ip netns`
+    '''
+    try:
+        return os.listdir(NETNS_RUN_DIR)
+    except OSError:
+        return []
+
+
+def setns(fd):
+    '''
+    Move the current thread into the network namespace
+    '''
+    if _libc.setns(fd, CLONE_NEWNET) != 0:
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code))
+
+
+def netns_call(netns, func, *argv, **kwarg):
+    '''
+    Call the function within the network namespace and
+    switch back. Requires CAP_SYS_ADMIN.
+    '''
+    if isinstance(netns, int):
+        fd = netns
+    else:
+        fd = os.open(netns_path(netns), os.O_RDONLY)
+    saved = os.open(_self_path(), os.O_RDONLY)
+    try:
+        setns(fd)
+        try:
+            return func(*argv, **kwarg)
+        finally:
+            setns(saved)
+    finally:
+        os.close(saved)
+        if not isinstance(netns, int):
+            os.close(fd)
@@ -0,0 +1,162 @@
+'''
+Network namespaces pool
+=======================
+
+Every network namespace requires its own RTNL socket. To
+manage many namespaces, use `NetNSPool`: it opens the sockets
+lazily on the first access to a namespace, caches them and
+closes them when they are not used for `max_idle` seconds::
+
+    from pyroute2 import NetNSPool
+    from pyroute2.netlink.netns import listnetns
+
+    pool = NetNSPool(max_idle=60)
+    for name in listnetns():
+        with pool.get(name) as ip:
+            print(name, [x.get_attr('IFLA_IFNAME')
+                         for x in ip.get_links()])
+    pool.release()
+
+A namespace can be referenced by the name, by the file path or
+by an open file descriptor. Opening a socket in a namespace
+requires CAP_SYS_ADMIN.
+
+The pool provides `SharedIPRoute` clients, so if the same
+namespace is referenced in several ways, only one socket will
+be opened. A client, taken from the pool, is in use until it is
+returned with `put()` or by the end of the `with` block. Clients
+in use never expire; if such a client is evicted, it is released
+only when it is returned to the pool.
+'''
+import time
+import threading
+
+from pyroute2.netlink.iproute import SharedIPRoute
+from pyroute2.netlink.mux import NetlinkMux
+from pyroute2.netlink.netns import netns_id
+
+
+class NetNSIPRoute(SharedIPRoute):
+    '''
+    `SharedIPRoute` within another network namespace
+    '''
+
+    def __init__(self, netns, timeout=3, pool=None):
+        self.netns = netns
+        self.pool = pool
+        SharedIPRoute.__init__(self, timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.pool is not None:
+            self.pool.put(self)
+
+    def acquire_mux(self):
+        return NetlinkMux.acquire(self.family, self.marshal, self.netns)
+
+
+class NetNSPool(object):
+    '''
+    Pool of RTNL clients in network namespaces
+
+    * max_idle -- close sockets, unused for `max_idle` seconds;
+      None means never
+    * timeout -- response timeout for the clients
+    '''
+
+    def __init__(self, max_idle=60, timeout=3):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # {netns: [NetNSIPRoute(), last_used, users], ...}
+        self.clients = {}
+        # evicted clients in use: {id(client): record, ...}
+        self.retired = {}
+
+    def get(self, netns):
+        '''
+        Take the RTNL client for the namespace. Opens a new
+        socket, if there is no cached one. Every `get()` must be
+        paired with `put()`, or the client used as a context
+        manager, otherwise the socket is never closed.
+        '''
+        with self.lock:
+            now = time.time()
+            self._expire(now)
+            record = self.clients.get(netns, None)
+            # the namespace can be removed and created again
+            # with the same name
+            if (record is not None and
+                    record[0].mux.key[2] != netns_id(netns)):
+                self._evict(netns)
+                record = None
+            if record is None:
+                record = [NetNSIPRoute(netns, self.timeout, self), now, 0]
+                self.clients[netns] = record
+            record[1] = now
+            record[2] += 1
+            return record[0]
+
+    def put(self, client):
+        '''
+        Return the client, taken with `get()`, to the pool
+        '''
+        with self.lock:
+            record = self.clients.get(client.netns, None)
+            if record is None or record[0] is not client:
+                record = self.retired.get(id(client), None)
+            if record is None or record[2] <= 0:
+                return
+            record[1] = time.time()
+            record[2] -= 1
+            if record[2] == 0 and self.retired.pop(id(client), None):
+                client.release()
+
+    def __contains__(self, netns):
+        return netns in self.clients
+
+    def __len__(self):
+        return len(self.clients)
+
+    def _evict(self, netns):
+        record = self.clients.pop(netns, None)
+        if record is None:
+            return
+        if record[2] > 0:
+            # in use, release on put()
+            self.retired[id(record[0])] = record
+        else:
+            record[0].release()
+
+    def _expire(self, now):
+        if self.max_idle is None:
+            return
+        for netns, record in tuple(self.clients.items()):
+            if record[2] == 0 and now - record[1] > self.max_idle:
+                self._evict(netns)
+
+    def evict(self, netns):
+        '''
+        Close the cached socket for the namespace; if the client
+        is in use, it is closed when returned to the pool
+        '''
+        with self.lock:
+            self._evict(netns)
+
+    def expire(self):
+        '''
+        Close sockets, that are idle longer than `max_idle`
+        '''
+        with self.lock:
+            self._expire(time.time())
+
+    def release(self):
+        '''
+        Close all the sockets; clients in use are closed when
+        returned to the pool
+        '''
+        with self.lock:
+            for netns in tuple(self.clients):
+                self._evict(netns)
@@ -96,7 +96,7 @@ class Node(object):
             public = getattr(item, 'public', False)
 
             if public:
-                self._ioc.register_callback(item, predicate(name))
+                self._ioc.register_callback(item, cname=name)
 
     def serve(self, host):
         path = urlparse.urlparse(host).path
@@ -0,0 +1,29 @@
+'''
+AddrPool micro-benchmark
+
+Fill the pool up to the given occupancy and measure alloc/free
+pairs throughput. With the free-cells stack the throughput
+should not depend on the occupancy.
+
+Usage: python bench_addrpool.py [iterations]
+'''
+import sys
+import time
+from pyroute2.iocore.addrpool import AddrPool
+
+
+def bench(occupancy, iterations):
+    pool = AddrPool(minaddr=0xffff, maxaddr=0xffff + 0x10000 - 1)
+    for x in range(int(0x10000 * occupancy)):
+        pool.alloc()
+    start = time.time()
+    for x in range(iterations):
+        pool.free(pool.alloc())
+    return iterations / (time.time() - start)
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for occupancy in (0, 0.5, 0.9, 0.99, 0.9999):
+        print('occupancy %6.2f%%: %10i alloc/free pairs per second' %
+              (occupancy * 100, bench(occupancy, iterations)))
@@ -0,0 +1,35 @@
+'''
+RTNL request latency benchmark
+
+Compare the request latency of `IPRoute` (broker, envelopes and
+the I/O loop thread), `SharedIPRoute` (shared socket and the I/O
+loop thread) and `DirectIPRoute` (synchronous I/O in the calling
+thread).
+
+Usage: python bench_iproute.py [iterations]
+'''
+import sys
+import time
+from pyroute2 import IPRoute
+from pyroute2 import SharedIPRoute
+from pyroute2 import DirectIPRoute
+
+
+def bench(ip, iterations):
+    # warm up
+    ip.get_links(1)
+    start = time.time()
+    for x in range(iterations):
+        ip.get_links(1)
+    return (time.time() - start) / iterations
+
+
+if __name__ == '__main__':
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    for cls in (IPRoute, SharedIPRoute, DirectIPRoute):
+        ip = cls()
+        try:
+            print('%-14s %8.1f usec per request' %
+                  (cls.__name__, bench(ip, iterations) * 1000000))
+        finally:
+            ip.release()
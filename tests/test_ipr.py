@@ -1,7 +1,33 @@
+import time
 import uuid
+import errno
 import socket
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+import threading
+import subprocess
 from pyroute2 import IPRoute
+from pyroute2 import NetNSPool
+from pyroute2 import SharedIPRoute
+from pyroute2 import DirectIPRoute
+from pyroute2.netlink.mux import NetlinkMux
 from pyroute2.netlink import NetlinkError
+from pyroute2.netlink import NetlinkDumpInterrupted
+from pyroute2.netlink import NLM_F_MULTI
+from pyroute2.netlink import NLM_F_DUMP_INTR
+from pyroute2.netlink import NLMSG_DONE
+from pyroute2.netlink import NLM_F_REQUEST
+from pyroute2.netlink.iproute import RTM_GETLINK
+from pyroute2.netlink.iproute import RTM_NEWLINK
+from pyroute2.netlink.iproute import RTM_GETROUTE
+from pyroute2.netlink.rtnl.ifinfmsg import ifinfmsg
+from pyroute2.netlink.rtnl.rtmsg import rtmsg
+from pyroute2.iocore.iocore import DrainReply
+from pyroute2.iocore.future import Future
+from pyroute2.iocore.future import gather
+from nose.plugins.skip import SkipTest
 from utils import grep
 from utils import require_user
 from utils import get_ip_addr
@@ -17,6 +43,72 @@ def _assert_uplinks(ip, num):
     assert len(ip.uids) == num
 
 
+def _assert_dump_retries(ip, method):
+    '''
+    Stub `ip.<method>` with interrupted dumps and check the
+    retry loop of `nlm_request()`
+    '''
+    calls = []
+
+    def request(interrupts):
+        def stub(*argv, **kwarg):
+            calls.append(None)
+            if len(calls) <= interrupts:
+                raise NetlinkDumpInterrupted(['partial'])
+            msg = ifinfmsg()
+            msg['header']['type'] = RTM_NEWLINK
+            msg['index'] = 1
+            return [msg]
+        setattr(ip, method, stub)
+        del calls[:]
+
+    try:
+        # a consistent dump after two interrupted ones
+        request(2)
+        result = ip.nlm_request(ifinfmsg(), RTM_GETLINK, dump_retries=3)
+        assert [x['index'] for x in result] == [1]
+        assert 'header' not in result[0]
+        assert len(calls) == 3
+        assert ip.last_dump_retries == 2
+        # out of retries: the first request and dump_retries more
+        for (retries, kwarg) in ((2, {'dump_retries': 2}),
+                                 (0, {'dump_retries': 0}),
+                                 (ip.dump_retries, {})):
+            request(0xffff)
+            try:
+                ip.nlm_request(ifinfmsg(), RTM_GETLINK, **kwarg)
+            except NetlinkDumpInterrupted as e:
+                assert e.retries == retries
+                assert e.result == ['partial']
+            else:
+                raise AssertionError('exception not raised')
+            assert len(calls) == retries + 1
+            assert ip.last_dump_retries == retries
+        # the counter is reset by the next request
+        request(0)
+        ip.nlm_request(ifinfmsg(), RTM_GETLINK)
+        assert ip.last_dump_retries == 0
+    finally:
+        delattr(ip, method)
+
+
+def _assert_links_batch(ip, run=lambda x: x):
+    indices = [x['index'] for x in run(ip.get_links())]
+    query = list(reversed(indices * 4))
+    # pipelined requests, then the filtered dump
+    for batch_max in (len(query), 1):
+        ip.links_batch_max = batch_max
+        assert [x['index'] for x in run(ip.get_links(*query))] == query
+        try:
+            run(ip.get_links(1, 0x7ffffffe))
+        except NetlinkError as e:
+            assert e.code == 19
+        else:
+            raise AssertionError('error not raised')
+    # no replies left behind
+    assert run(ip.link_lookup(ifname='lo')) == [1]
+
+
 class TestSetup(object):
 
     def test_simple(self):
@@ -139,6 +231,277 @@ class TestMisc(object):
         for i in range(100):
             self.ip.get_addr()
 
+    def test_response_timeout(self):
+        nonce = self.ip.nonce.alloc()
+        self.ip.listeners[nonce] = Queue.Queue()
+        start = time.time()
+        try:
+            self.ip.get(nonce, timeout=0.3)
+        except Queue.Empty:
+            pass
+        else:
+            raise AssertionError('timeout not raised')
+        assert 0.3 <= time.time() - start < 3
+        assert nonce not in self.ip.listeners
+
+    def test_monitor_coalesce(self):
+        require_user('root')
+        self.ip.monitor(policy='coalesce')
+        for x in range(3):
+            subprocess.call(['ip', 'addr', 'add', '172.16.201.1/24',
+                             'dev', 'lo'])
+            subprocess.call(['ip', 'addr', 'del', '172.16.201.1/24',
+                             'dev', 'lo'])
+        time.sleep(0.3)
+        stats = self.ip.queue_stats()[0]
+        assert stats['policy'] == 'coalesce'
+        assert stats['coalesced'] > 0
+        assert stats['dropped'] == 0
+        events = []
+        while not self.ip.listeners[0].empty():
+            events.extend(self.ip.get())
+        addrs = [x for x in events
+                 if x.get_attr('IFA_ADDRESS') == '172.16.201.1']
+        assert [x['event'] for x in addrs] == ['RTM_DELADDR']
+
+    def test_mirror(self):
+        self.ip.monitor()
+        self.ip.mirror()
+        links = self.ip.get_links()
+        mirrored = []
+        while len(mirrored) < len(links):
+            mirrored.extend(self.ip.get(timeout=3))
+        assert [x['index'] for x in links] == \
+            [x['index'] for x in mirrored]
+        for (reply, copy) in zip(links, mirrored):
+            assert reply['attrs'] is not copy['attrs']
+            assert 'header' not in reply
+            assert 'header' in copy
+            # the requester owns the reply
+            reply.strip('IFLA_IFNAME')
+            reply['attrs'].append(['IFLA_MTU', 1])
+            assert copy.get_attr('IFLA_IFNAME') is not None
+
+    def test_get_batch(self):
+        self.ip.monitor()
+        self.ip.mirror()
+        links = self.ip.get_links()
+        time.sleep(0.1)
+        batch = self.ip.get(batch=True)
+        assert [x['index'] for x in links] == [x['index'] for x in batch]
+        try:
+            self.ip.get(timeout=0.1)
+        except Queue.Empty:
+            pass
+        else:
+            raise AssertionError('timeout not raised')
+
+    def test_iter(self):
+        assert [x['index'] for x in self.ip.iter_links()] == \
+            [x['index'] for x in self.ip.get_links()]
+        assert [x['index'] for x in self.ip.iter_links(1)] == [1]
+        assert len(list(self.ip.iter_routes(table=255))) == \
+            len(self.ip.get_routes(table=255))
+        assert len(list(self.ip.iter_neighbors())) == \
+            len(self.ip.get_neighbors())
+        assert 'header' not in next(self.ip.iter_links())
+
+    def test_iter_stop(self):
+        routes = self.ip.get_routes(table=255)
+        for x in range(20):
+            stream = self.ip.iter_routes(table=255)
+            next(stream)
+            stream.close()
+            # the rest of the dump must not get to the next request
+            assert len(self.ip.get_routes(table=255)) == len(routes)
+            assert self.ip.link_lookup(ifname='lo') == [1]
+        time.sleep(0.3)
+        assert not [x for x in self.ip.listeners if x != 0]
+
+    def test_iter_overrun(self):
+        self.ip.queue_size = 2
+        msg = rtmsg()
+        msg['family'] = socket.AF_INET
+        stream = self.ip.nlm_stream(msg, RTM_GETROUTE,
+                                    response_timeout=0.1)
+        try:
+            for route in stream:
+                time.sleep(0.3)
+        except NetlinkError as e:
+            assert e.code == errno.ENOBUFS
+        else:
+            raise AssertionError('overrun not detected')
+        assert self.ip.link_lookup(ifname='lo') == [1]
+
+    def test_iter_backpressure(self):
+        routes = self.ip.get_routes(table=255)
+        self.ip.queue_size = 2
+        ret = []
+        for route in self.ip.iter_routes(table=255):
+            time.sleep(0.01)
+            ret.append(route)
+        assert len(ret) == len(routes)
+
+    def test_dump_intr(self):
+        nonce = self.ip.nonce.alloc()
+        self.ip.listeners[nonce] = Queue.Queue()
+        for mtype in (16, NLMSG_DONE):
+            self.ip.listeners[nonce].put({'header': {'type': mtype,
+                                                     'flags': NLM_F_MULTI |
+                                                     NLM_F_DUMP_INTR}})
+        try:
+            self.ip.get(nonce)
+        except NetlinkDumpInterrupted as e:
+            assert len(e.result) == 1
+        else:
+            raise AssertionError('dump interruption not detected')
+
+    def test_get_links_batch(self):
+        _assert_links_batch(self.ip)
+        assert len(self.ip.listeners) == 0
+
+    def test_request_async(self):
+        indices = [x['index'] for x in self.ip.get_links()]
+        futures = []
+        for index in indices * 16:
+            msg = ifinfmsg()
+            msg['index'] = index
+            futures.append(self.ip.nlm_request_async(msg, RTM_GETLINK,
+                                                     NLM_F_REQUEST))
+        result = gather(futures, timeout=10)
+        assert [x[0]['index'] for x in result] == indices * 16
+        assert len(self.ip.listeners) == 0
+
+    def test_dump_retries(self):
+        _assert_dump_retries(self.ip, 'request')
+        assert self.ip.link_lookup(ifname='lo') == [1]
+
+    def test_request_async_retry(self):
+        replies = []
+        threads = []
+
+        def request_async(*argv, **kwarg):
+            threads.append(threading.current_thread())
+            reply = Future()
+            replies.append(reply)
+            return reply
+
+        self.ip.request_async = request_async
+        try:
+            future = self.ip.nlm_request_async(ifinfmsg(), RTM_GETLINK,
+                                               dump_retries=1)
+            replies[0].set_exception(NetlinkDumpInterrupted([]))
+            for x in range(30):
+                if len(replies) > 1:
+                    break
+                time.sleep(0.1)
+            # the retry is sent by the I/O loop, not by the callback
+            assert threads == [threading.current_thread(), self.ip.ioloop]
+            replies[1].set_exception(NetlinkDumpInterrupted([]))
+            e = future.exception(timeout=3)
+        finally:
+            del self.ip.request_async
+        assert isinstance(e, NetlinkDumpInterrupted)
+        assert e.retries == 1
+
+    def test_request_async_error(self):
+        msg = ifinfmsg()
+        msg['index'] = 0x7ffffffe
+        future = self.ip.nlm_request_async(msg, RTM_GETLINK, NLM_F_REQUEST)
+        assert isinstance(future.exception(timeout=3), NetlinkError)
+        try:
+            gather([future])
+        except NetlinkError:
+            pass
+        else:
+            raise AssertionError('exception not raised')
+
+    def test_request_async_timeout(self):
+        # the request goes nowhere, so it can only expire
+        future = self.ip.request_async(b'', port=0xfff0,
+                                       response_timeout=0.3)
+        start = time.time()
+        assert isinstance(future.exception(timeout=3), Queue.Empty)
+        assert time.time() - start < 3
+        # the nonce is reserved, until the idle timeout
+        assert [type(x) for x in self.ip.listeners.values()] == \
+            [DrainReply]
+        time.sleep(0.5)
+        assert len(self.ip.listeners) == 0
+
+    def test_request_timeout(self):
+        # a synchronous request expires as an asynchronous one
+        nonce = self.ip.nonce.alloc()
+        try:
+            self.ip.request(b'', port=0xfff0, nonce=nonce,
+                            response_timeout=0.2)
+        except Queue.Empty:
+            pass
+        else:
+            raise AssertionError('timeout not raised')
+        assert isinstance(self.ip.listeners[nonce], DrainReply)
+
+    def test_request_not_sent(self):
+        nonce = self.ip.nonce.alloc()
+        bridge = self.ip.bridge
+
+        class Broken(object):
+            def send(self, data):
+                raise IOError(32, 'broken pipe')
+
+        self.ip.bridge = Broken()
+        try:
+            self.ip.request_async(b'', port=0xfff0, nonce=nonce)
+        except IOError:
+            pass
+        else:
+            raise AssertionError('exception not raised')
+        finally:
+            self.ip.bridge = bridge
+        # nothing to wait for: the nonce is free at once
+        assert nonce not in self.ip.listeners
+        try:
+            self.ip.nonce.free(nonce)
+        except KeyError:
+            pass
+        else:
+            raise AssertionError('nonce is not freed')
+
+    def test_request_async_late(self):
+        nonce = self.ip.nonce.alloc()
+        future = self.ip.request_async(b'', port=0xfff0, nonce=nonce,
+                                       response_timeout=0.2)
+        assert isinstance(future.exception(timeout=3), Queue.Empty)
+        # late parts of the reply do not free the nonce
+        part = {'header': {'type': RTM_NEWLINK, 'flags': NLM_F_MULTI}}
+        self.ip.listeners[nonce].deliver(part)
+        time.sleep(0.1)
+        assert isinstance(self.ip.listeners[nonce], DrainReply)
+        nonces = [self.ip.nonce.alloc() for x in range(64)]
+        assert nonce not in nonces
+        for x in nonces:
+            self.ip.nonce.free(x)
+        # NLMSG_DONE does
+        done = {'header': {'type': NLMSG_DONE, 'flags': NLM_F_MULTI}}
+        self.ip.listeners[nonce].deliver(done)
+        assert nonce not in self.ip.listeners
+        try:
+            self.ip.nonce.free(nonce)
+        except KeyError:
+            pass
+        else:
+            raise AssertionError('nonce is not freed')
+
+    def test_request_terminate(self):
+        # the dump goes on after terminate()
+        msg = rtmsg()
+        result = self.ip.nlm_request(msg, RTM_GETROUTE,
+                                     terminate=lambda x: True)
+        assert result == []
+        time.sleep(0.3)
+        assert len(self.ip.listeners) == 0
+        assert self.ip.link_lookup(ifname='lo') == [1]
+
     def test_nla_compare(self):
         lvalue = self.ip.get_links()
         rvalue = self.ip.get_links()
@@ -150,6 +513,513 @@ class TestMisc(object):
         assert lvalue != 42
 
 
+class TestLinkCache(object):
+
+    def setup(self):
+        self.ip = IPRoute()
+        self.ip.link_cache()
+
+    def teardown(self):
+        self.ip.release()
+
+    def test_lookup(self):
+        lo = self.ip.get_links(1)[0]
+        address = lo.get_attr('IFLA_ADDRESS')
+        assert self.ip.link_lookup(ifname='lo') == [1]
+        assert 1 in self.ip.link_lookup(address=address.upper())
+        assert self.ip.link_lookup(ifname='bala_no_such') == []
+        # not cached: the full dump
+        assert 1 in self.ip.link_lookup(operstate='UNKNOWN')
+
+    def test_address_case(self):
+        msg = ifinfmsg()
+        msg['header'] = {'type': RTM_NEWLINK}
+        msg['index'] = 0x7ff0
+        msg['attrs'] = [['IFLA_IFNAME', 'pr2-fake'],
+                        ['IFLA_ADDRESS', 'aa:bb:cc:dd:ee:0f']]
+        self.ip.resolver.update(None, msg)
+        cached = [self.ip.link_lookup(address='AA:BB:CC:DD:EE:0F'),
+                  self.ip.link_lookup(address='aa:bb:cc:dd:ee:0f')]
+        # the same lookups by a full dump
+        self.ip.link_cache(False)
+        self.ip.get_links = lambda *argv, **kwarg: [msg]
+        try:
+            dumped = [self.ip.link_lookup(address='AA:BB:CC:DD:EE:0F'),
+                      self.ip.link_lookup(address='aa:bb:cc:dd:ee:0f')]
+        finally:
+            del self.ip.get_links
+        assert cached == dumped == [[0x7ff0], [0x7ff0]]
+
+    def test_fallback(self):
+        with self.ip.resolver.lock:
+            self.ip.resolver.links.clear()
+            self.ip.resolver.by_name.clear()
+        assert self.ip.link_lookup(ifname='lo') == [1]
+        assert self.ip.resolver.by_name['lo'] == 1
+
+    def test_update(self):
+        require_user('root')
+        ifname = 'pr2-%s' % (str(uuid.uuid4())[:6])
+        create_link(ifname, 'dummy')
+        time.sleep(0.3)
+        index = self.ip.resolver.by_name[ifname]
+        subprocess.call(['ip', 'link', 'set', 'dev', ifname,
+                         'name', ifname + 'x'])
+        time.sleep(0.3)
+        assert ifname not in self.ip.resolver.by_name
+        assert self.ip.resolver.by_name[ifname + 'x'] == index
+        remove_link(ifname + 'x')
+        time.sleep(0.3)
+        assert index not in self.ip.resolver.links
+        self.ip.resolver.fallback = False
+        assert self.ip.link_lookup(ifname=ifname + 'x') == []
+
+    def test_close(self):
+        self.ip.link_cache(False)
+        assert self.ip.resolver is None
+        assert not any(self.ip.cb_type.values())
+        assert self.ip.link_lookup(ifname='lo') == [1]
+
+
+class TestShared(object):
+
+    def test_links(self):
+        ip = IPRoute()
+        sip = SharedIPRoute()
+        try:
+            assert [x['index'] for x in ip.get_links()] == \
+                [x['index'] for x in sip.get_links()]
+            assert sip.link_lookup(ifname='lo') == [1]
+        finally:
+            sip.release()
+            ip.release()
+
+    def test_shared_socket(self):
+        ips = [SharedIPRoute() for x in range(16)]
+        assert len(set([id(x.mux) for x in ips])) == 1
+        result = []
+
+        def worker(ip):
+            for x in range(10):
+                result.append(len(ip.get_links()))
+
+        workers = [threading.Thread(target=worker, args=(x, ))
+                   for x in ips]
+        for x in workers:
+            x.start()
+        for x in workers:
+            x.join()
+        assert len(result) == 160
+        assert len(set(result)) == 1
+        for ip in ips:
+            ip.release()
+        assert not NetlinkMux._registry
+        assert NetlinkMux._ioloop is None
+
+    def test_links_batch(self):
+        ip = SharedIPRoute()
+        try:
+            _assert_links_batch(ip)
+            assert not ip.mux.listeners
+        finally:
+            ip.release()
+
+    def test_route(self):
+        ip = SharedIPRoute()
+        try:
+            ip.monitor()
+            mux = ip.mux
+            late = {'header': {'sequence_number': 0x7ffffff0,
+                               'type': 16, 'flags': 0}}
+            event = {'header': {'sequence_number': 0,
+                                'type': 16, 'flags': 0}}
+            # late unicast replies are not events
+            mux.route(None, (0, [late, event]))
+            assert ip.get(timeout=1) == [event]
+            # but multicast messages are, with any nonce
+            mux.route(None, (1, [late]))
+            assert ip.get(timeout=1) == [late]
+            assert ip.queue.empty()
+        finally:
+            ip.release()
+
+    def test_dump_retries(self):
+        ip = SharedIPRoute()
+        try:
+            _assert_dump_retries(ip, '_request')
+            assert ip.link_lookup(ifname='lo') == [1]
+        finally:
+            ip.release()
+
+    def test_drain(self):
+        ip = SharedIPRoute()
+        try:
+            mux = ip.mux
+            (nonce, reply) = mux.open(True)
+            reply.complete = False
+            mux.close(nonce, reply, True, 3)
+            # the dump goes on: the nonce and the lock are busy
+            assert nonce in mux.listeners
+            assert not mux.dump_lock.acquire(False)
+            part = {'header': {'sequence_number': nonce,
+                               'type': 16, 'flags': NLM_F_MULTI}}
+            done = {'header': {'sequence_number': nonce,
+                               'type': NLMSG_DONE, 'flags': NLM_F_MULTI}}
+            mux.route(None, (0, [part]))
+            assert nonce in mux.listeners
+            mux.route(None, (0, [done]))
+            assert nonce not in mux.listeners
+            assert mux.dump_lock.acquire(False)
+            mux.dump_lock.release()
+            assert ip.link_lookup(ifname='lo') == [1]
+        finally:
+            ip.release()
+
+    def test_error(self):
+        ip = SharedIPRoute()
+        try:
+            ip.link('set', index=0xffff, state='up')
+        except NetlinkError as e:
+            assert e.code == 19
+        else:
+            raise AssertionError('error not raised')
+        finally:
+            ip.release()
+
+
+class TestDirect(object):
+
+    def setup(self):
+        self.ip = DirectIPRoute()
+
+    def teardown(self):
+        self.ip.release()
+
+    def test_links(self):
+        ip = IPRoute()
+        try:
+            assert [x['index'] for x in ip.get_links()] == \
+                [x['index'] for x in self.ip.get_links()] == \
+                [x['index'] for x in self.ip.iter_links()]
+            assert self.ip.link_lookup(ifname='lo') == [1]
+        finally:
+            ip.release()
+
+    def test_links_batch(self):
+        _assert_links_batch(self.ip)
+        assert not self.ip.current
+
+    def test_abandoned_dump(self):
+        # terminate() ends the request, but not the dump
+        for x in range(10):
+            assert self.ip.nlm_request(rtmsg(), RTM_GETROUTE,
+                                       terminate=lambda x: True) == []
+            assert self.ip.link_lookup(ifname='lo') == [1]
+        assert not self.ip.current
+        # a reply, that never ends: the socket is replaced
+        self.ip.draining.add(0x7ffffff0)
+        sock = self.ip.sock
+        links = self.ip.nlm_request(ifinfmsg(), RTM_GETLINK,
+                                    response_timeout=0.3)
+        assert self.ip.sock is not sock
+        assert not self.ip.draining
+        assert 1 in [x['index'] for x in links]
+
+    def test_get_unlocked(self):
+        self.ip.monitor()
+        result = []
+
+        def waiter():
+            try:
+                self.ip.get(timeout=3)
+            except Queue.Empty:
+                pass
+            finally:
+                result.append(time.time())
+
+        thread = threading.Thread(target=waiter)
+        thread.start()
+        time.sleep(0.1)
+        # requests do not wait for get()
+        assert self.ip.link_lookup(ifname='lo') == [1]
+        end = time.time()
+        thread.join()
+        assert end < result[0]
+
+    def test_no_threads(self):
+        threads = threading.active_count()
+        ip = DirectIPRoute()
+        ip.get_links()
+        ip.release()
+        assert threading.active_count() == threads
+
+    def test_error(self):
+        try:
+            self.ip.link('set', index=0xffff, state='up')
+        except NetlinkError as e:
+            assert e.code == 19
+        else:
+            raise AssertionError('error not raised')
+        # the socket should be usable after an error
+        assert self.ip.link_lookup(ifname='lo') == [1]
+
+    def test_monitor(self):
+        require_user('root')
+        self.ip.monitor()
+        subprocess.call(['ip', 'addr', 'add', '172.16.200.1/24', 'dev', 'lo'])
+        try:
+            msgs = self.ip.get(timeout=3)
+            assert 'RTM_NEWADDR' in [x['event'] for x in msgs]
+        finally:
+            subprocess.call(['ip', 'addr', 'del', '172.16.200.1/24',
+                             'dev', 'lo'])
+
+
+class TestAsync(object):
+
+    def setup(self):
+        try:
+            import asyncio
+            from pyroute2 import AsyncIPRoute
+        except ImportError:
+            raise SkipTest('asyncio is not available')
+        self.loop = asyncio.new_event_loop()
+        self.ip = AsyncIPRoute(loop=self.loop)
+
+    def teardown(self):
+        self.ip.release()
+        self.loop.close()
+
+    def run(self, future):
+        return self.loop.run_until_complete(future)
+
+    def test_links(self):
+        ip = IPRoute()
+        try:
+            assert [x['index'] for x in ip.get_links()] == \
+                [x['index'] for x in self.run(self.ip.get_links())]
+            assert self.run(self.ip.link_lookup(ifname='lo')) == [1]
+            links = self.run(self.ip.get_links(1, 1))
+            assert [x['index'] for x in links] == [1, 1]
+        finally:
+            ip.release()
+
+    def test_links_batch(self):
+        _assert_links_batch(self.ip, self.run)
+        assert not self.ip.requests
+
+    def test_pipeline(self):
+        import asyncio
+        futures = [self.ip.get_routes(),
+                   self.ip.get_links(),
+                   self.ip.get_addr(),
+                   self.ip.link_lookup(ifname='lo')]
+        (routes, links, addrs, lo) = \
+            self.run(asyncio.gather(*futures))
+        assert lo == [1]
+        assert 'lo' in [x.get_attr('IFLA_IFNAME') for x in links]
+        assert 1 in [x['index'] for x in addrs]
+        assert not self.ip.requests
+        assert self.ip.dumping is None
+
+    def test_running_loop(self):
+        import warnings
+        from pyroute2 import AsyncIPRoute
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            try:
+                AsyncIPRoute()
+            except RuntimeError:
+                pass
+            else:
+                raise AssertionError('exception not raised')
+            # in the loop the running one is used
+            future = self.loop.create_future()
+            self.loop.call_soon(lambda: future.set_result(AsyncIPRoute()))
+            ip = self.run(future)
+            try:
+                assert ip.loop is self.loop
+                assert self.run(ip.link_lookup(ifname='lo')) == [1]
+            finally:
+                ip.release()
+
+    def test_abandoned_dump(self):
+        from pyroute2.netlink.aio import AsyncDrain
+        from pyroute2.netlink.aio import AsyncRequest
+        # a dump, that ends the request before the reply ends
+        request = AsyncRequest(self.ip, None, lambda x: True, 3, 0, True)
+        self.ip.dumping = request
+        request.nonce = nonce = self.ip.alloc_nonce(request)
+        request.timer = self.loop.call_later(3, request.finish)
+        part = {'header': {'type': RTM_NEWLINK, 'flags': NLM_F_MULTI}}
+        request.put(part)
+        assert self.run(request.future) == []
+        assert isinstance(self.ip.requests[nonce], AsyncDrain)
+        # the next dump waits for the end of the reply
+        links = self.ip.get_links()
+        assert len(self.ip.dumps) == 1
+        self.ip.requests[nonce].put(part)
+        assert len(self.ip.dumps) == 1
+        done = {'header': {'type': NLMSG_DONE, 'flags': NLM_F_MULTI}}
+        self.ip.requests[nonce].put(done)
+        assert nonce not in self.ip.requests
+        assert 1 in [x['index'] for x in self.run(links)]
+        assert not self.ip.requests
+        assert self.ip.dumping is None
+
+    def test_drain_timeout(self):
+        from pyroute2.netlink.aio import AsyncDrain
+        future = self.ip.nlm_request(rtmsg(), RTM_GETROUTE,
+                                     response_timeout=0.2)
+        request = self.ip.dumping
+        # the timeout, before the reply is read
+        request.finish(Queue.Empty(), False)
+        assert isinstance(self.ip.requests[request.nonce], AsyncDrain)
+        try:
+            self.run(future)
+        except Queue.Empty:
+            pass
+        else:
+            raise AssertionError('exception not raised')
+        # the rest of the reply is discarded
+        assert self.run(self.ip.link_lookup(ifname='lo')) == [1]
+        assert not self.ip.requests
+
+    def iterate(self, stream):
+        ret = []
+        while True:
+            try:
+                ret.append(self.run(stream.__anext__()))
+            except StopAsyncIteration:
+                return ret
+
+    def test_stream(self):
+        ip = IPRoute()
+        try:
+            links = self.iterate(self.ip.iter_links())
+            assert [x['index'] for x in ip.get_links()] == \
+                [x['index'] for x in links]
+            links = self.iterate(self.ip.iter_links(1, 1))
+            assert [x['index'] for x in links] == [1, 1]
+            routes = self.iterate(self.ip.iter_routes(table=255))
+            assert len(routes) == len(ip.get_routes(table=255))
+            assert set([x.get_attr('RTA_TABLE') for x in routes]) == \
+                set([255])
+            assert not self.ip.requests
+            assert self.ip.dumping is None
+        finally:
+            ip.release()
+
+    def test_stream_close(self):
+        stream = self.ip.iter_routes()
+        self.run(stream.__anext__())
+        stream.close()
+        # the rest of the dump is discarded
+        assert self.run(self.ip.link_lookup(ifname='lo')) == [1]
+        assert not self.ip.requests
+        assert not stream.buffer
+
+    def test_stream_error(self):
+        stream = self.ip.iter_links(0xffff)
+        try:
+            self.run(stream.__anext__())
+        except NetlinkError as e:
+            assert e.code == 19
+        else:
+            raise AssertionError('error not raised')
+
+    def test_no_threads(self):
+        threads = threading.active_count()
+        self.run(self.ip.get_links())
+        assert threading.active_count() == threads
+
+    def test_error(self):
+        try:
+            self.run(self.ip.link('set', index=0xffff, state='up'))
+        except NetlinkError as e:
+            assert e.code == 19
+        else:
+            raise AssertionError('error not raised')
+        assert self.run(self.ip.link_lookup(ifname='lo')) == [1]
+
+    def test_monitor(self):
+        require_user('root')
+        import asyncio
+        self.ip.monitor()
+        subprocess.call(['ip', 'addr', 'add', '172.16.200.1/24', 'dev', 'lo'])
+        try:
+            msgs = self.run(asyncio.wait_for(self.ip.get(), 3))
+            assert 'RTM_NEWADDR' in [x['event'] for x in msgs]
+        finally:
+            subprocess.call(['ip', 'addr', 'del', '172.16.200.1/24',
+                             'dev', 'lo'])
+
+
+class TestNetNSPool(object):
+
+    def setup(self):
+        require_user('root')
+        self.names = ['pr2test_ns%i' % (x) for x in range(3)]
+        for name in self.names:
+            subprocess.call(['ip', 'netns', 'add', name])
+        self.pool = NetNSPool(max_idle=None)
+
+    def teardown(self):
+        self.pool.release()
+        for name in self.names:
+            subprocess.call(['ip', 'netns', 'del', name])
+
+    def test_links(self):
+        for name in self.names:
+            with self.pool.get(name) as ip:
+                links = ip.get_links()
+            assert [x.get_attr('IFLA_IFNAME') for x in links] == ['lo']
+        assert len(self.pool) == 3
+        # sockets are cached
+        with self.pool.get(self.names[0]) as ip0:
+            assert self.pool.get(self.names[0]) is ip0
+            self.pool.put(ip0)
+            with self.pool.get(self.names[1]) as ip1:
+                assert ip0.mux is not ip1.mux
+
+    def test_evict(self):
+        with self.pool.get(self.names[0]) as ip:
+            ip.get_links()
+        self.pool.evict(self.names[0])
+        assert self.names[0] not in self.pool
+        self.pool.max_idle = 0
+        with self.pool.get(self.names[1]) as ip:
+            ip.get_links()
+        self.pool.expire()
+        assert len(self.pool) == 0
+
+    def test_busy(self):
+        self.pool.max_idle = 0
+        ip = self.pool.get(self.names[0])
+        key = ip.mux.key
+        # clients in use do not expire
+        time.sleep(0.1)
+        self.pool.expire()
+        assert self.names[0] in self.pool
+        # and are released only when returned
+        self.pool.evict(self.names[0])
+        assert self.names[0] not in self.pool
+        assert [x.get_attr('IFLA_IFNAME') for x in ip.get_links()] == ['lo']
+        assert key in NetlinkMux._registry
+        self.pool.put(ip)
+        assert key not in NetlinkMux._registry
+        assert not self.pool.retired
+
+    def test_no_getitem(self):
+        # subscript access would take a reference without put()
+        try:
+            self.pool[self.names[0]]
+        except TypeError:
+            pass
+        else:
+            raise AssertionError('exception not raised')
+
+
 def _callback(envelope, msg, obj):
     obj.cb_counter += 1
 
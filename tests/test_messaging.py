@@ -1,3 +1,12 @@
+import io
+import socket
+import struct
+import threading
+from functools import partial
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
 from pyroute2.netlink import IPRCMD_STOP
 from pyroute2.netlink import IPRCMD_RELOAD
 from pyroute2.netlink import IPRCMD_SUBSCRIBE
@@ -5,6 +14,8 @@ from pyroute2.iocore import NLT_DGRAM
 from pyroute2.rpc import public
 from pyroute2.rpc import Node
 from pyroute2 import IOCore
+from pyroute2.iocore.broker import IOBroker
+from pyroute2.iocore.frame import envframe
 
 
 class TestIOBroker(object):
@@ -85,6 +96,181 @@ class Namespace(object):
         raise RuntimeError('test exception')
 
 
+class TestForwarding(object):
+
+    def setup(self):
+        self.broker = IOBroker()
+        self.sent = []
+        self.socks = []
+        for uid in ('one', 'two'):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            link = self.broker.register_link(uid, None, sock,
+                                             established=True,
+                                             remote=True)
+            link.gate = partial(self.gate, uid)
+            self.socks.append(sock)
+
+    def teardown(self):
+        for sock in self.socks:
+            sock.close()
+
+    def gate(self, uid, envelope, sock):
+        self.sent.append(uid)
+
+    def test_flood(self):
+        self.broker.route_forward(None, envframe(dst=0x42))
+        assert sorted(self.sent) == ['one', 'two']
+
+    def test_learned(self):
+        self.broker.learn_route(0x42, 'two')
+        self.broker.route_forward(None, envframe(dst=0x42))
+        assert self.sent == ['two']
+        # datagrams are not routed via stream links
+        self.broker.route_forward(None, envframe(flags=NLT_DGRAM,
+                                                 dst=0x42))
+        assert self.sent == ['two']
+
+    def test_unicast_block(self):
+        policies = []
+
+        def send(sock, data, addr=None, policy=None):
+            policies.append(policy)
+            return True
+
+        self.broker.send = send
+        self.broker.send_envelope(self.socks[0], envframe(dst=0x42))
+        self.broker.filter_u32(b'\0' * 16)
+        assert policies == ['block']
+
+    def test_deregister(self):
+        self.broker.learn_route(0x42, 'two')
+        self.broker.deregister_link('two')
+        self.broker.route_forward(None, envframe(dst=0x42))
+        assert self.sent == ['one']
+
+
+class TestGateForward(object):
+
+    def setup(self):
+        self.broker = IOBroker()
+        self.broker.write_high = 16384
+        self.broker.write_low = 4096
+        self.broker.ioloop.start()
+        (self.left, self.right) = socket.socketpair()
+        self.left.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+
+    def teardown(self):
+        self.broker.ioloop.shutdown()
+        self.broker.ioloop.join()
+        self.left.close()
+        self.right.close()
+
+    def _read(self, ret):
+        self.right.settimeout(1)
+        try:
+            while True:
+                data = self.right.recv(65536)
+                if not data:
+                    break
+                ret.append(data)
+        except socket.timeout:
+            pass
+
+    def test_over_watermark(self):
+        # fill the queue with the broadcast policy, 'drop'
+        accepted = 0
+        while self.broker.send(self.left, b'x' * 1024):
+            accepted += 1
+        writer = self.broker.writers[self.left]
+        drops = writer.drops
+        assert writer.size + 1024 > self.broker.write_high
+        result = []
+        reader = threading.Thread(target=self._read, args=(result, ))
+        reader.start()
+        # a forwarded request waits for the queue to flush
+        assert self.broker.gate_send(self.left, envframe(dst=0x42), None)
+        reader.join()
+        assert writer.drops == drops
+        data = b''.join(result)
+        assert data[:accepted * 1024] == b'x' * accepted * 1024
+        packet = data[accepted * 1024:]
+        assert packet and struct.unpack('I', packet[:4])[0] == len(packet)
+        assert len(self.broker.masquerade) == 1
+
+
+class TestCallbacks(object):
+
+    def setup(self):
+        self.ioc = IOCore()
+        self.calls = []
+
+    def teardown(self):
+        self.ioc.release()
+
+    def callback(self, tag, envelope, msg):
+        self.calls.append(tag)
+
+    def test_cname(self):
+        for name in ('one', 'two', 'three'):
+            self.ioc.register_callback(partial(self.callback, name),
+                                       cname=name)
+        self.ioc.register_callback(partial(self.callback, 'any'))
+        self.ioc.parse(envframe(cname='two'), io.BytesIO(b'data'))
+        assert sorted(self.calls) == ['any', 'two']
+
+    def test_plain_listener(self):
+        # a plain queue as the default listener: no overflow policy,
+        # but the messages are delivered, not lost on AttributeError
+        self.ioc.listeners[0] = queue = Queue.Queue(1)
+        self.ioc.parse(envframe(cname='one'), io.BytesIO(b'one'))
+        self.ioc.parse(envframe(cname='two'), io.BytesIO(b'two'))
+        assert queue.get_nowait()['data'] == b'one'
+        assert queue.empty()
+        del self.ioc.listeners[0]
+
+    def test_predicate(self):
+        self.ioc.register_callback(partial(self.callback, 'yes'),
+                                   lambda e, x: x['data'] == b'yes',
+                                   cname='test')
+        self.ioc.parse(envframe(cname='test'), io.BytesIO(b'no'))
+        self.ioc.parse(envframe(cname='test'), io.BytesIO(b'yes'))
+        assert self.calls == ['yes']
+
+    def test_order(self):
+        def mark(envelope, msg):
+            msg['mark'] = True
+
+        def check(tag, envelope, msg):
+            self.calls.append((tag, msg.get('mark', False)))
+
+        self.ioc.register_callback(partial(check, 'first'))
+        self.ioc.register_callback(partial(check, 'keyed'), cname='one')
+        self.ioc.register_callback(mark)
+        self.ioc.register_callback(partial(check, 'last'), cname='one')
+        self.ioc.register_callback(partial(check, 'any'))
+        self.ioc.parse(envframe(cname='one'), io.BytesIO(b'data'))
+        # the registration order, keyed or not
+        assert self.calls == [('first', False), ('keyed', False),
+                              ('last', True), ('any', True)]
+
+    def test_unregister_order(self):
+        cb = partial(self.callback, 'one')
+        self.ioc.register_callback(cb, cname='one')
+        self.ioc.register_callback(cb)
+        # the first registered reference goes first
+        self.ioc.unregister_callback(cb)
+        assert not self.ioc.cb_cname
+        assert len(self.ioc.callbacks) == 1
+
+    def test_unregister(self):
+        cb = partial(self.callback, 'one')
+        self.ioc.register_callback(cb, cname='one')
+        self.ioc.unregister_callback(cb)
+        assert not self.ioc.cb_cname
+        self.ioc.parse(envframe(cname='one'), io.BytesIO(b'data'))
+        assert self.calls == []
+
+
 class TestPush(object):
 
     def setup(self):
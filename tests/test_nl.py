@@ -1,6 +1,39 @@
+import io
 import socket
+import logging
+import time
+import struct
+import threading
+from functools import partial
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
 from utils import require_user
+from pyroute2.netlink import Marshal
 from pyroute2.netlink import NetlinkSocket
+from pyroute2.netlink import NLMSG_ERROR
+from pyroute2.netlink import NLM_F_CAPPED
+from pyroute2.netlink import NLM_F_ACK_TLVS
+from pyroute2.netlink import NLMSGERR_ATTR_MSG
+from pyroute2.netlink import NLMSGERR_ATTR_OFFS
+from pyroute2.iocore.addrpool import AddrPool
+from pyroute2.iocore.loop import IOLoop
+from pyroute2.iocore.timer import TimerWheel
+from pyroute2.iocore.broker import pairPipeSockets
+from pyroute2.iocore.broker import PacketIds
+from pyroute2.iocore.broker import Subscriptions
+from pyroute2.iocore.broker import MarshalEnv
+from pyroute2.iocore.broker import WriteQueue
+from pyroute2.iocore.listener import ListenerQueue
+from pyroute2.iocore.listener import deliver
+from pyroute2.netlink.iproute import MarshalRtnl
+from pyroute2.netlink.iproute import RTM_NEWLINK
+from pyroute2.netlink.rtnl.ifinfmsg import ifinfmsg
+from pyroute2.iocore.frame import encode_frame
+from pyroute2.iocore.frame import parse_frames
+from pyroute2.iocore.frame import encode_envmsg
+from pyroute2.iocore.frame import patch_envmsg
 
 
 class TestNL(object):
@@ -69,3 +102,650 @@ class TestNL(object):
             fail.close()
         except AssertionError:
             pass
+
+
+class TestExtAck(object):
+
+    def _error(self, flags, payload=b'', tlvs=b''):
+        # original request header
+        orig = struct.pack('IHHII', 16 + len(payload), 16, 5, 42, 0)
+        body = struct.pack('i', -22) + orig + payload + tlvs
+        data = io.BytesIO()
+        data.length = data.write(struct.pack('IHHII',
+                                             16 + len(body),
+                                             NLMSG_ERROR,
+                                             flags, 42, 0) + body)
+        return Marshal().parse(data)[0]['header']['error']
+
+    def _tlvs(self):
+        text = b'invalid attribute\0'
+        text += b'\0' * ((4 - len(text) % 4) % 4)
+        return (struct.pack('HH', 4 + len(b'invalid attribute\0'),
+                            NLMSGERR_ATTR_MSG) + text +
+                struct.pack('HHI', 8, NLMSGERR_ATTR_OFFS, 24))
+
+    def test_plain(self):
+        error = self._error(0, b'\0' * 16)
+        assert error.code == 22
+        assert error.extack is None
+        assert error.offset is None
+
+    def test_capped(self):
+        error = self._error(NLM_F_CAPPED | NLM_F_ACK_TLVS,
+                            tlvs=self._tlvs())
+        assert error.code == 22
+        assert error.extack == 'invalid attribute'
+        assert error.offset == 24
+
+    def test_not_capped(self):
+        error = self._error(NLM_F_ACK_TLVS, b'\0' * 16, self._tlvs())
+        assert error.code == 22
+        assert error.extack == 'invalid attribute'
+        assert error.offset == 24
+
+
+class TestAddrPool(object):
+
+    def test_exhaust(self):
+        pool = AddrPool(minaddr=10, maxaddr=200)
+        addrs = set([pool.alloc() for x in range(191)])
+        assert addrs == set(range(10, 201))
+        try:
+            pool.alloc()
+        except KeyError:
+            pass
+        else:
+            raise AssertionError('address allocated beyond maxaddr')
+        pool.free(150)
+        assert pool.alloc() == 150
+
+    def test_reverse(self):
+        pool = AddrPool(minaddr=0, maxaddr=0x3ff, reverse=True)
+        assert pool.alloc() == 0x3ff
+        assert pool.alloc() == 0x3fe
+
+    def test_free_error(self):
+        pool = AddrPool(minaddr=10, maxaddr=200)
+        addr = pool.alloc()
+        pool.free(addr)
+        for addr in (addr, 5, 100, 1000):
+            try:
+                pool.free(addr)
+            except KeyError:
+                pass
+            else:
+                raise AssertionError('freed not allocated address')
+
+
+class TestIOLoop(object):
+
+    def setup(self):
+        self.received = []
+        self.batches = 0
+        self.done = threading.Event()
+
+    def callback(self, fd, data, count):
+        self.received.append(data)
+        if len(self.received) == count:
+            self.done.set()
+
+    def run(self, edge, count=100, kind=socket.SOCK_DGRAM):
+        ioloop = IOLoop(edge=edge, batch=16)
+        put = ioloop.buffers[0].put
+
+        def counter(item):
+            self.batches += 1
+            put(item)
+        ioloop.buffers[0].put = counter
+        (left, right) = socket.socketpair(socket.AF_UNIX, kind)
+        for x in range(count):
+            right.send(struct.pack('I', x))
+        ioloop.start()
+        ioloop.register(left, self.callback, argv=[count], defer=True)
+        self.done.wait(3)
+        batches = self.batches
+        ioloop.shutdown()
+        ioloop.join()
+        left.close()
+        right.close()
+        self.batches = batches
+        return [struct.unpack('I', x)[0] for x in self.received]
+
+    def test_level(self):
+        assert self.run(edge=False) == list(range(100))
+        assert self.batches == 100
+
+    def test_edge(self):
+        assert self.run(edge=True) == list(range(100))
+        # not more than 16 buffers per batch
+        assert 7 <= self.batches < 100
+
+    def test_edge_eof(self):
+        ioloop = IOLoop(edge=True)
+        (left, right) = socket.socketpair()
+        ioloop.start()
+        ioloop.register(left, self.callback, argv=[2], defer=True)
+        right.send(b'test')
+        right.close()
+        self.done.wait(3)
+        ioloop.shutdown()
+        ioloop.join()
+        left.close()
+        assert [len(x) for x in self.received] == [4, 0]
+
+    def test_workers(self):
+        ioloop = IOLoop(workers=2)
+        (slow, slow_peer) = socket.socketpair(socket.AF_UNIX,
+                                              socket.SOCK_DGRAM)
+        # pick a socket, that goes to the other queue thread
+        pair = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        if pair[0].fileno() % 2 == slow.fileno() % 2:
+            pair = pair[::-1]
+        (fast, fast_peer) = pair
+        release = threading.Event()
+        slow_received = []
+
+        slow_done = threading.Event()
+
+        def slow_callback(fd, data):
+            release.wait(3)
+            slow_received.append(data)
+            if len(slow_received) == 10:
+                slow_done.set()
+
+        ioloop.start()
+        ioloop.register(slow, slow_callback, defer=True)
+        ioloop.register(fast, self.callback, argv=[10], defer=True)
+        for x in range(10):
+            slow_peer.send(struct.pack('I', x))
+            fast_peer.send(struct.pack('I', x))
+        # the slow consumer does not stall the other socket
+        assert self.done.wait(3)
+        assert not slow_received
+        release.set()
+        slow_done.wait(3)
+        ioloop.shutdown()
+        ioloop.join()
+        for sock in (slow, slow_peer, fast, fast_peer):
+            sock.close()
+        assert [struct.unpack('I', x)[0] for x in self.received] == \
+            list(range(10))
+        assert [struct.unpack('I', x)[0] for x in slow_received] == \
+            list(range(10))
+
+    def test_processes(self):
+        ioloop = IOLoop(processes=2)
+        (left, right) = socket.socketpair(socket.AF_UNIX,
+                                          socket.SOCK_DGRAM)
+        ioloop.start()
+        ioloop.register(left, self.callback, argv=[10], defer=True,
+                        parse=partial(struct.unpack, 'I'))
+        for x in range(10):
+            right.send(struct.pack('I', x))
+        self.done.wait(3)
+        ioloop.shutdown()
+        ioloop.join()
+        left.close()
+        right.close()
+        assert self.received == [(x, ) for x in range(10)]
+
+    def test_schedule(self):
+        ioloop = IOLoop()
+        ioloop.start()
+        start = time.time()
+        ioloop.schedule(0.3, self.callback, None, 'late', 2)
+        ioloop.schedule(0.1, self.callback, None, 'early', 2)
+        ioloop.schedule(0.2, self.callback, None, 'cancelled', 2).cancel()
+        self.done.wait(3)
+        ioloop.shutdown()
+        ioloop.join()
+        assert self.received == ['early', 'late']
+        assert time.time() - start >= 0.3
+
+
+class TestTimerWheel(object):
+
+    def test_expire(self):
+        # small wheels to test cascades and long timers
+        wheel = TimerWheel(tick=1, bits=(4, 3, 3))
+        fired = {}
+        timers = {}
+        current = [0]
+        base = wheel.now
+
+        def callback(delay):
+            fired[delay] = current[0]
+
+        for delay in range(0, 2000, 7):
+            timers[delay] = wheel.schedule(delay, callback, delay)
+        for delay in range(0, 2000, 49):
+            assert timers[delay].cancel()
+            assert not timers[delay].cancel()
+        for tick in range(1, 2100):
+            current[0] = tick
+            wheel.expire(base + tick + 0.5)
+        assert wheel.count == 0
+        for delay, timer in timers.items():
+            if delay % 49:
+                assert fired[delay] == timer.expires - base
+            else:
+                assert delay not in fired
+
+    def test_next_expiry(self):
+        wheel = TimerWheel(tick=1, bits=(4, 3, 3))
+        assert wheel.next_expiry() is None
+        timer = wheel.schedule(300, lambda: None)
+        while wheel.count:
+            assert wheel.next_expiry() <= timer.expires
+            wheel.expire(wheel.next_expiry() + 0.5)
+        assert wheel.now == timer.expires
+
+
+class TestPipeSocket(object):
+
+    def setup(self):
+        (self.left, self.right) = pairPipeSockets()
+
+    def teardown(self):
+        self.left.close()
+        self.right.close()
+
+    def test_boundaries(self):
+        msgs = [struct.pack('I', x) * x for x in range(1, 100)]
+        for msg in msgs:
+            self.left.send(msg)
+        assert [self.right.recv() for x in msgs] == msgs
+
+    def _recv(self, sock):
+        while True:
+            ret = sock.recv()
+            if ret is not None:
+                return ret
+
+    def test_large(self):
+        # larger than the socket buffer, so the message is split
+        msgs = [encode_frame(0, x, 0, 0, 0, 0, 0, b'x' * 1048576)
+                for x in range(4)]
+        msgs.append(b''.join(encode_frame(0, x, 0, 0, 0, 0, 0, b'y' * x)
+                             for x in range(1024)))
+        sender = threading.Thread(target=lambda: [self.right.send(x)
+                                                  for x in msgs])
+        sender.start()
+        assert [self._recv(self.left) for x in msgs] == msgs
+        sender.join()
+        # the socket is ready for small messages
+        self.right.send(b'small')
+        assert self.left.recv() == b'small'
+
+    def test_partial(self):
+        msg = encode_frame(0, 1, 0, 0, 0, 0, 0, b'z' * 4194304)
+        sent = self.right.send(msg, socket.MSG_DONTWAIT)
+        assert 0 < sent < len(msg)
+        reader = threading.Thread(target=lambda: result.append(
+            self._recv(self.left)))
+        result = []
+        reader.start()
+        self.right.send(msg[sent:])
+        reader.join()
+        assert result == [msg]
+
+    def test_write_queue(self):
+        ioloop = IOLoop()
+        ioloop.start()
+        try:
+            writer = WriteQueue(self.right, ioloop, high=16777216)
+            msgs = [encode_frame(0, x, 0, 0, 0, 0, 0, b'w' * 1048576)
+                    for x in range(4)]
+            for msg in msgs:
+                assert writer.send(msg)
+            assert [self._recv(self.left) for x in msgs] == msgs
+        finally:
+            ioloop.shutdown()
+            ioloop.join()
+
+    def test_ioloop(self):
+        msg = encode_frame(0, 1, 0, 0, 0, 0, 0, b'l' * 1048576)
+        for edge in (False, True):
+            ioloop = IOLoop(edge=edge)
+            ioloop.start()
+            result = Queue.Queue()
+            ioloop.register(self.left, lambda fd, data: result.put(data),
+                            defer=True)
+            try:
+                self.right.send(msg)
+                self.right.send(b'small')
+                assert result.get(timeout=3) == msg
+                assert result.get(timeout=3) == b'small'
+            finally:
+                ioloop.unregister(self.left)
+                ioloop.shutdown()
+                ioloop.join()
+
+    def test_eof(self):
+        self.left.close()
+        assert self.right.recv() == b''
+
+
+class TestFrame(object):
+
+    def test_roundtrip(self):
+        raw = encode_frame(1, 2, 3, 4, 5, 6, 7, b'payload', 'cname')
+        (frame, ) = parse_frames(raw)
+        assert frame['header']['flags'] == 1
+        assert frame['header']['sequence_number'] == 2
+        assert frame['header']['pid'] == 3
+        assert (frame['dst'], frame['dport']) == (4, 5)
+        assert (frame['src'], frame['sport']) == (6, 7)
+        assert frame.get_attr('IPR_ATTR_CDATA') == b'payload'
+        assert frame.get_attr('IPR_ATTR_CNAME') == 'cname'
+        assert frame['id'] is None
+
+    def test_many(self):
+        data = [struct.pack('I', x) * x for x in range(10)]
+        raw = b''.join([encode_frame(0, x, 0, 0, 0, 0, 0, data[x])
+                        for x in range(10)])
+        frames = parse_frames(raw)
+        assert [x['header']['sequence_number'] for x in frames] == \
+            list(range(10))
+        assert [x['data'] for x in frames] == data
+        assert frames[0].get_attr('IPR_ATTR_CNAME') is None
+
+    def test_truncated(self):
+        raw = encode_frame(0, 1, 0, 0, 0, 0, 0, b'data')
+        assert parse_frames(raw[:-4]) == []
+
+    def test_envmsg(self):
+        raw = encode_envmsg(3, 5, 6, 1, 2, 3, 4, 16, b'x' * 16,
+                            b'abcde', 'cname')
+        data = io.BytesIO()
+        data.length = data.write(raw)
+        (envelope, ) = MarshalEnv().parse(data)
+        assert envelope['header']['sequence_number'] == 5
+        assert envelope['dst'] == 1
+        assert envelope['id'] == b'x' * 16
+        assert envelope.get_attr('IPR_ATTR_CDATA') == b'abcde'
+        assert envelope.get_attr('IPR_ATTR_CNAME') == 'cname'
+        # patch the header in place
+        data = io.BytesIO()
+        data.length = data.write(patch_envmsg(envelope.raw, 7, 8, 15))
+        (envelope, ) = MarshalEnv().parse(data)
+        assert envelope['header']['sequence_number'] == 7
+        assert envelope['header']['pid'] == 8
+        assert envelope['ttl'] == 15
+        assert envelope.get_attr('IPR_ATTR_CDATA') == b'abcde'
+
+
+class TestPacketIds(object):
+
+    def test_check(self):
+        ids = PacketIds()
+        assert not ids.check(b'one')
+        assert ids.check(b'one')
+        assert not ids.check(b'two')
+        assert len(ids) == 2
+
+    def test_maxsize(self):
+        ids = PacketIds(maxsize=400, buckets=4)
+        for x in range(10000):
+            ids.add(x)
+        assert len(ids) <= 400
+        assert 9999 in ids
+        assert 0 not in ids
+
+    def test_expire(self):
+        ids = PacketIds(timeout=4, buckets=4)
+        ids.add(b'one')
+        ids.stamp -= 2
+        ids.add(b'two')
+        assert b'one' in ids
+        ids.stamp -= 3
+        ids.add(b'three')
+        assert b'one' not in ids
+        assert b'two' in ids
+
+
+class TestSubscriptions(object):
+
+    def setup(self):
+        self.subs = Subscriptions()
+        self.subs.add(1, 'all', [(8, 0, 0)])
+        self.subs.add(2, 'link', [(4, 16, 0xffff)])
+        self.subs.add(3, 'link_lo', [(4, 16, 0xffff), (20, 1, 0xffffffff)])
+        self.subs.add(4, 'addr', [(4, 20, 0xffff)])
+
+    def test_match(self):
+        link = struct.pack('IHHIIII', 24, 16, 0, 0, 0, 0, 1)
+        addr = struct.pack('IHHIIII', 24, 20, 0, 0, 0, 0, 1)
+        assert sorted(self.subs.match(link)) == ['all', 'link', 'link_lo']
+        assert sorted(self.subs.match(addr)) == ['addr', 'all']
+
+    def test_short(self):
+        assert self.subs.match(struct.pack('IH', 6, 16)) == set(['all'])
+
+    def test_remove(self):
+        assert self.subs.remove(1)
+        assert not self.subs.remove(1)
+        assert 1 not in self.subs
+        addr = struct.pack('IHHIIII', 24, 20, 0, 0, 0, 0, 1)
+        assert self.subs.match(addr) == set(['addr'])
+
+    def test_unique(self):
+        # the same client, two matching subscriptions
+        self.subs.add(5, 'link', [(4, 16, 0xfffe)])
+        self.subs.add(6, 'all', [])
+        link = struct.pack('IHHIIII', 24, 16, 0, 0, 0, 0, 1)
+        assert sorted(self.subs.match(link)) == ['all', 'link', 'link_lo']
+
+
+class TestWriteQueue(object):
+
+    def setup(self):
+        self.ioloop = IOLoop()
+        self.ioloop.start()
+        (self.left, self.right) = socket.socketpair()
+        self.left.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+
+    def teardown(self):
+        self.ioloop.shutdown()
+        self.ioloop.join()
+        self.left.close()
+        self.right.close()
+
+    def _read(self, length):
+        ret = b''
+        while len(ret) < length:
+            ret += self.right.recv(length - len(ret))
+        return ret
+
+    def test_flush(self):
+        writer = WriteQueue(self.left, self.ioloop, high=4194304)
+        msgs = [struct.pack('I', x) * 256 for x in range(1024)]
+        for msg in msgs:
+            assert writer.send(msg)
+        assert writer.depth > 0
+        assert self._read(1024 * 1024) == b''.join(msgs)
+        time.sleep(0.1)
+        assert writer.depth == 0
+        assert writer.size == 0
+        assert writer.drops == 0
+
+    def test_drop(self):
+        writer = WriteQueue(self.left, self.ioloop, high=16384, low=4096)
+        msg = b'x' * 1024
+        results = [writer.send(msg) for x in range(256)]
+        assert writer.drops == results.count(False) > 0
+        assert writer.size <= 16384
+        # nothing is lost but the dropped messages
+        assert self._read(1024 * results.count(True)) == \
+            msg * results.count(True)
+
+    def test_block(self):
+        writer = WriteQueue(self.left, self.ioloop, high=16384, low=4096,
+                            policy='block', timeout=5)
+        msg = b'x' * 1024
+        reader = threading.Thread(target=self._read, args=(1024 * 256, ))
+        reader.start()
+        results = [writer.send(msg) for x in range(256)]
+        reader.join()
+        assert all(results)
+        assert writer.drops == 0
+
+    def test_block_override(self):
+        writer = WriteQueue(self.left, self.ioloop, high=16384, low=4096,
+                            timeout=5)
+        msg = b'x' * 1024
+        reader = threading.Thread(target=self._read, args=(1024 * 256, ))
+        reader.start()
+        results = [writer.send(msg, policy='block') for x in range(256)]
+        reader.join()
+        assert all(results)
+        assert writer.drops == 0
+
+
+class TestListenerQueue(object):
+
+    def _drain(self, queue):
+        ret = []
+        while not queue.empty():
+            ret.append(queue.get_nowait())
+        return ret
+
+    def test_drop_newest(self):
+        queue = ListenerQueue(2)
+        assert [queue.deliver(x) for x in range(4)] == \
+            [True, True, False, False]
+        assert self._drain(queue) == [0, 1]
+        stats = queue.stats()
+        assert stats['queued'] == 2
+        assert stats['dropped'] == 2
+        assert stats['high'] == 2
+
+    def test_drop_oldest(self):
+        queue = ListenerQueue(2, 'drop_oldest')
+        for x in range(4):
+            assert queue.deliver(x)
+        assert self._drain(queue) == [2, 3]
+        assert queue.stats()['dropped'] == 2
+
+    def test_block(self):
+        queue = ListenerQueue(1, 'block', timeout=3)
+        queue.deliver(0)
+        reader = threading.Timer(0.1, queue.get)
+        reader.start()
+        assert queue.deliver(1)
+        reader.join()
+        assert self._drain(queue) == [1]
+        assert queue.stats()['blocked'] == 1
+        # nobody reads: drop on timeout
+        queue.timeout = 0.1
+        queue.deliver(2)
+        assert not queue.deliver(3)
+        assert queue.stats()['dropped'] == 1
+
+    def test_coalesce(self):
+        queue = ListenerQueue(3, 'coalesce', key=lambda x: x[0])
+        for msg in (('a', 1), ('b', 1), ('a', 2), (None, 1),
+                    ('c', 1), ('b', 2)):
+            queue.deliver(msg)
+        assert self._drain(queue) == [('a', 2), ('b', 2), (None, 1)]
+        stats = queue.stats()
+        assert stats['coalesced'] == 2
+        assert stats['dropped'] == 1
+        # a fetched message is not coalesced anymore
+        queue.deliver(('a', 3))
+        assert queue.get_nowait() == ('a', 3)
+        queue.deliver(('a', 4))
+        assert self._drain(queue) == [('a', 4)]
+
+    def test_get_batch(self):
+        queue = ListenerQueue(8)
+        for x in range(5):
+            queue.deliver(x)
+        assert queue.get_batch(maxitems=2) == [0, 1]
+        assert queue.get_batch(until=lambda x: x == 3) == [2, 3]
+        assert queue.get_batch() == [4]
+        start = time.time()
+        try:
+            queue.get_batch(timeout=0.1)
+        except Queue.Empty:
+            pass
+        else:
+            raise AssertionError('timeout not raised')
+        assert time.time() - start >= 0.1
+        threading.Timer(0.1, queue.deliver, (5, )).start()
+        assert queue.get_batch() == [5]
+
+    def test_bad_policy(self):
+        for argv in ((1, 'unknown'), (1, 'coalesce')):
+            try:
+                ListenerQueue(*argv)
+            except ValueError:
+                pass
+            else:
+                raise AssertionError('ValueError not raised')
+
+    def test_plain_queue(self):
+        warnings = []
+
+        class Handler(logging.Handler):
+            def emit(self, record):
+                warnings.append(record.getMessage())
+
+        handler = Handler()
+        logging.getLogger().addHandler(handler)
+        try:
+            # a plain queue only drops new messages, and says so
+            queue = Queue.Queue(1)
+            assert deliver(queue, 0)
+            assert not deliver(queue, 1)
+            assert not deliver(queue, 2, 'drop_oldest')
+            assert not deliver(queue, 3, 'coalesce')
+            assert self._drain(queue) == [0]
+            assert len(warnings) == 3
+            assert 'policy' not in warnings[0]
+            assert 'drop_oldest policy' in warnings[1]
+            assert 'coalesce policy' in warnings[2]
+            # ListenerQueue applies its own policy
+            queue = ListenerQueue(1, 'drop_oldest')
+            assert deliver(queue, 0)
+            assert deliver(queue, 1)
+            assert self._drain(queue) == [1]
+            assert len(warnings) == 3
+        finally:
+            logging.getLogger().removeHandler(handler)
+
+
+class TestClone(object):
+
+    def setup(self):
+        msg = ifinfmsg()
+        msg['index'] = 1
+        msg['attrs'] = [['IFLA_IFNAME', 'lo'], ['IFLA_MTU', 1500]]
+        msg['header']['type'] = RTM_NEWLINK
+        msg.encode()
+        self.raw = msg.buf.getvalue()
+        data = io.BytesIO()
+        data.length = data.write(self.raw)
+        (self.msg, ) = MarshalRtnl().parse(data)
+
+    def test_clone(self):
+        clone = self.msg.clone()
+        assert clone == self.msg
+        assert clone['attrs'] is not self.msg['attrs']
+        assert clone['header'] is not self.msg['header']
+        # readers drop headers and strip NLA, it must not affect
+        # other copies
+        del clone['header']
+        clone.strip('IFLA_IFNAME')
+        assert self.msg['header']['type'] == RTM_NEWLINK
+        assert self.msg.get_attr('IFLA_IFNAME') == 'lo'
+        assert clone.get_attr('IFLA_IFNAME') is None
+        assert clone.get_attr('IFLA_MTU') == 1500
+        assert clone['event'] == 'RTM_NEWLINK'
+
+    def test_encode_clone(self):
+        clone = self.msg.clone()
+        clone.reset()
+        clone.encode()
+        assert clone.buf.getvalue() == self.raw
+        assert len(self.msg['attrs'][0]) == 2